@@ -3,6 +3,24 @@ __author__ = 'Robert James, Fiona Alder'
 __author_email__ = 'robert.james.19@ucl.ac.uk'
 
 from .utils import *
+from .metrics import *
+from .header import *
 from .socket_thread import *
+from .reply_queue import *
+from .device_readers import *
+from .shared_ring import *
+from .async_client import *
+from .replay import *
+from .simulator import *
+from .control import *
+from .conversion import *
+from .compression import *
+from .writer import *
+from .container import *
+from .reader import *
+from .catalog import *
+from .stream import *
+from .events import *
+from .dsp import *
 from .device_interface import *
 from .calibration import *
@@ -2,55 +2,70 @@
 02/22, R James, F Alder
 
 Adapted from script by https://github.com/awmlee
-"""
-from websocket import create_connection
-import requests
-import json
-import keyboard
 
+Start, configure and stop streaming on one or more Red Pitayas, all at once:
+
+    python -m PyRPStream rp-f05a98.local rp-f05a99.local --rate 120 --seconds 60
 
-class Websocket:
-    def __init__(self, socket_url=None):
-        self.rp_ip = 'rp-f05a98.local' if socket_url == '' else socket_url
-        self.socket_url = 'ws://' + self.rp_ip + '/wss'
-        self.start_app_url = 'http://' + self.rp_ip + '/bazaar?start=streaming_manager'
+Streaming stops after --seconds, or if not given on Enter when run from a
+terminal. It also stops, cleanly, on Ctrl-C (SIGINT) or SIGTERM, so it can
+run as a service or with stdin not a terminal.
+"""
 
+import argparse
+import signal
+import sys
+import time
 
+import PyRPStream as rp
 
-#------------------------------------------------------------------------------
-socket_url = input('Red Pitaya IP address (press enter for default: rp-f05a98.local):')
-WS = Websocket(socket_url)
 
-# Start streaming server
-try:
-    web = requests.get(WS.start_app_url)
-    print('Connection established')
-except:
-    raise OSError('Could not connect to Red Pitaya')
+def _wait(seconds=None):
+    """ Wait for seconds, or if None for Enter (from a terminal) or a signal,
+    returning early on Ctrl-C.
+    """
+    try:
+        if seconds is not None:
+            print('Streaming for ' + str(seconds) + ' s')
+            time.sleep(seconds)
+        elif sys.stdin.isatty():
+            input('Streaming: press Enter to stop')
+        else:
+            print('Streaming: interrupt (SIGINT) or terminate (SIGTERM) to stop')
+            while True:
+                time.sleep(3600.)
+    except (KeyboardInterrupt, EOFError):
+        pass
 
-# Create websocket connection
-ws = create_connection(WS.socket_url)
 
-# Set websocket parameters
-setbits = ({'parameters': {'SS_RESOLUTION': {'value': 2}, 'in_command': {'value': 'send_all_params'}}})
-setrate = ({'parameters': {'SS_RATE': {'value': 120}, 'in_command': {'value': 'send_all_params'}}})
-setdualchan = ({'parameters': {'SS_CHANNEL': {'value': 3},' in_command': {'value': 'send_all_params'}}})
-ws.send(json.dumps(setbits))
-ws.send(json.dumps(setrate))
-ws.send(json.dumps(setdualchan))
+def main():
+    parser = argparse.ArgumentParser(prog='python -m PyRPStream', description='Control streaming on Red Pitayas')
+    parser.add_argument('hosts', nargs='*', default=['rp-f05a98.local'], help='Red Pitaya addresses (default: rp-f05a98.local)')
+    parser.add_argument('--resolution', type=int, default=16, choices=sorted(rp.RESOLUTIONS), help='Bits per sample')
+    parser.add_argument('--rate', type=int, default=120, help='SS_RATE value')
+    parser.add_argument('--channels', type=int, default=3, choices=sorted(rp.CHANNELS), help='1, 2, or 3 for both')
+    parser.add_argument('--seconds', type=float, default=None, help='Stream for this long (default: until Enter)')
+    parser.add_argument('--timeout', type=float, default=5., help='Seconds to wait for each device')
+    args = parser.parse_args()
 
-startcmd = ({'parameters': {'SS_START': {'value': 1}, 'in_command': {'value': 'send_all_params'}}})
-stopcmd = ({'parameters': {'SS_START': {'value': 0}, 'in_command': {'value': 'send_all_params'}}})
+    control = rp.ControlPool(args.hosts, args.timeout)
+    try:
+        # Start streaming server
+        control.start_apps()
+        print('Connection established')
+        control.configure(args.resolution, args.rate, args.channels)
 
-# Start streaming data
-ws.send(json.dumps(startcmd))
+        # Start streaming data, stopping it on SIGTERM as on Ctrl-C
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        control.start()
+        _wait(args.seconds)
 
-print('Streaming: press q to stop')
-while True:
-    if keyboard.read_key() == 'q':
+        # Stop streaming data
         print('Ending streaming, closing connection')
-        break
+        control.stop()
+    finally:
+        control.close()
+
 
-# Stop streaming data and close websocket
-ws.send(json.dumps(stopcmd))
-ws.close()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+02/22, R James
+"""
+
+import asyncio
+import time
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+@export
+class AsyncSocketClient:
+    """ asyncio implementation of the socket layer: all devices are read from
+        a single event loop, with no thread per device and no polling. Blocks
+        are yielded as the same dictionaries as SocketClientThread DATA
+        replies, in untriggered or triggered mode, of samples of
+        resolution_bits bits.
+    """
+    def __init__(self, device_names, addresses, triggered=False, resolution_bits=16):
+        try:
+            assert len(device_names) == len(addresses)
+        except:
+            raise ValueError('All arguments must be of the same length')
+
+        self.device_names = device_names
+        self.addresses = dict(zip(device_names, addresses))
+        # Stream reader/writer pairs for connected devices
+        self.streams = {}
+        # Buffer reading attributes
+        self.header_size = 60
+        self.channel_size = 32768
+        self.sample_dtype = rp.sample_dtype(resolution_bits)
+        # Triggered or untriggered mode
+        self.triggered = triggered
+        # Triggering value for channel 2 for triggered mode (raw ADC counts, 30000 at 16 bits)
+        self.trigger_value = 30000 >> (16 - resolution_bits)
+
+
+    @property
+    def connected(self):
+        return [device_name in self.streams for device_name in self.device_names]
+
+
+    async def connect(self, timeout=5.):
+        """ Connect to all devices concurrently. Raises OSError, after closing
+        any sockets that did connect, if any device cannot be reached.
+        """
+        results = await asyncio.gather(*[self._connect(device_name, timeout) for device_name in self.device_names],
+                                       return_exceptions=True)
+        errors = [str(result) for result in results if isinstance(result, Exception)]
+        if errors:
+            await self.close()
+            raise OSError('Could not CONNECT: ' + '; '.join(errors))
+
+
+    async def _connect(self, device_name, timeout):
+        if device_name in self.streams:
+            return
+        host, port = self.addresses[device_name]
+        try:
+            # Reader buffer limit large enough for several frames
+            self.streams[device_name] = await asyncio.wait_for(
+                asyncio.open_connection(host, port, limit=4 * (self.header_size + 2 * self.channel_size)), timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise OSError(str(e) + '. Problem device: ' + device_name)
+        print('Socket for ' + device_name + ' connected')
+
+
+    async def close(self):
+        """ Close connection to all sockets.
+        """
+        for device_name, (_, writer) in list(self.streams.items()):
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+            del self.streams[device_name]
+
+
+    async def read_frame(self, device_name):
+        """ Read one frame from a device, returning (header, ch1, ch2) memoryviews.
+        """
+        reader, _ = self.streams[device_name]
+        try:
+            frame = memoryview(await reader.readexactly(self.header_size + 2 * self.channel_size))
+        except asyncio.IncompleteReadError:
+            raise OSError('Empty packet from socket. Problem device: ' + device_name)
+        ch2_start = self.header_size + self.channel_size
+        return frame[:self.header_size], frame[self.header_size:ch2_start], frame[ch2_start:]
+
+
+    async def _read_device(self, device_name, frame_q):
+        """ Reader task for one device: put (device_name, header, ch1, ch2, t_ns)
+        on frame_q, or (device_name, OSError) on failure.
+        """
+        try:
+            while True:
+                header_bytes, ch1_bytes, ch2_bytes = await self.read_frame(device_name)
+                t_ns = time.time_ns()
+                header = rp.parse_header(header_bytes)
+                if not self.triggered:
+                    await frame_q.put((device_name, header, ch1_bytes, ch2_bytes, t_ns))
+                    continue
+                start = rp.trigger_start(ch2_bytes, self.trigger_value, self.sample_dtype)
+                if start is not None:
+                    # Save everything on channel 1 since the first point the threshold was exceeded
+                    await frame_q.put((device_name, header, ch1_bytes[self.sample_dtype.itemsize * start::], None, t_ns))
+        except OSError as e:
+            await frame_q.put((device_name, e))
+
+
+    async def blocks(self, acq_time_s=None, max_queued=64):
+        """ Asynchronous iterator over DATA reply dictionaries, each holding at
+        most one frame per device, for acq_time_s seconds (forever if None).
+        Raises OSError if a device fails.
+        """
+        if not all(self.connected):
+            raise OSError('Cannot acquire unless connected to all devices')
+
+        frame_q = asyncio.Queue(maxsize=max_queued * len(self.device_names))
+        tasks = [asyncio.ensure_future(self._read_device(device_name, frame_q)) for device_name in self.device_names]
+        pending = None
+        t_start_ns = None
+        try:
+            while True:
+                reply = {}
+                replied = []
+                t_ns = None
+
+                item = pending if pending is not None else await frame_q.get()
+                pending = None
+                while True:
+                    if isinstance(item[1], OSError):
+                        raise OSError('Error during RECEIVE: ' + str(item[1]))
+                    device_name, header, ch1_bytes, ch2_bytes, t_ns_frame = item
+                    if device_name in replied:
+                        # Second frame from this device: hold it for the next block
+                        pending = item
+                        break
+                    replied.append(device_name)
+                    reply.update({device_name + '_header': header})
+                    reply.update({device_name + '_ch1': ch1_bytes})
+                    if ch2_bytes is not None:
+                        reply.update({device_name + '_ch2': ch2_bytes})
+                    t_ns = t_ns_frame if t_ns is None else max(t_ns, t_ns_frame)
+                    try:
+                        item = frame_q.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+
+                if t_start_ns is None:
+                    t_start_ns = t_ns
+                if acq_time_s is not None and t_ns - t_start_ns > (acq_time_s * 1e9):
+                    return
+
+                reply.update({'replied_devices': replied})
+                reply.update({'timestamp': t_ns})
+                yield reply
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,320 @@
+"""
+02/22, R James
+
+Throughput benchmarks against simulated Red Pitaya streaming servers (see
+simulator.py), so no hardware is needed:
+
+    python -m PyRPStream.benchmark engines --devices 1 2 4 8 --seconds 5
+    python -m PyRPStream.benchmark acquire --devices 4 --sample-rate 10e6
+    python -m PyRPStream.benchmark compression --codecs zlib:1 lzma:0 bz2:9
+    python -m PyRPStream.benchmark replay data --seconds 30
+
+'engines' measures the rate at which each acquisition engine delivers data to
+its reply queue. With --sample-rate, each simulated device streams at that
+rate, so aggregate throughput scales with the number of devices until an
+engine saturates.
+
+'acquire' drives RPDeviceCollection.connect/acquire end to end, writing files
+into a temporary directory, and reports MB/s written, frames dropped by the
+simulated devices because the client fell behind, and CPU per device.
+
+'compression' reports the compression ratio and MB/s of raw int16 samples
+compressed and decompressed per codec and level, with and without
+preconditioning, on simulated waveforms and on any given .bin (int16) or
+.rps files.
+
+'replay' drives acquire from recorded data in a directory (see replay.py),
+as fast as possible or at --speed times real time, looping over the
+recording, so the pipeline is measured on production data rather than on
+simulated waveforms. It reports MB/s written and CPU per device.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import os
+import tempfile
+import time
+import numpy as np
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+@export
+def benchmark_engine(engine, n_devices, duration_s=5., base_port=9900, triggered=False, sample_rate=None):
+    """ Stream from n_devices simulated devices through the given engine
+    ('select', 'threads', 'processes', 'rings' or 'asyncio') for duration_s and return
+    aggregate MB/s of channel data delivered to the reply queue.
+    """
+    device_names = ['dev' + str(i) for i in range(n_devices)]
+
+    with rp.RPStreamSimulator(n_devices, base_port, sample_rate=sample_rate) as simulator:
+        if engine == 'asyncio':
+            return asyncio.run(_benchmark_asyncio(device_names, simulator.addresses, duration_s, triggered))
+
+        if engine == 'select':
+            client = rp.SocketClientThread(device_names, triggered)
+        elif engine == 'rings':
+            client = rp.RingSocketClient(device_names, triggered)
+        else:
+            client = rp.ParallelSocketClient(device_names, triggered, processes=(engine == 'processes'))
+        client.start()
+
+        client.cmd_q.put(rp.ClientCommand('CONNECT', simulator.addresses))
+        for _ in device_names:
+            reply = client.reply_q.get()
+            if reply.key == 'ERROR':
+                client.join()
+                raise OSError(reply.reply)
+
+        n_bytes = 0
+        t_start = time.perf_counter()
+        while time.perf_counter() - t_start < duration_s:
+            reply = client.reply_q.get()
+            if reply.key != 'DATA':
+                continue
+            for device_name in reply.reply['replied_devices']:
+                n_bytes += len(reply.reply[device_name + '_ch1'])
+                if not triggered:
+                    n_bytes += len(reply.reply[device_name + '_ch2'])
+            client.release(reply)
+        elapsed = time.perf_counter() - t_start
+
+        # Close the client while the simulator is still streaming: it blocks in select until data arrives
+        client.cmd_q.put(rp.ClientCommand('CLOSE'))
+        client.join()
+
+    return n_bytes / elapsed / 1e6
+
+
+async def _benchmark_asyncio(device_names, addresses, duration_s, triggered):
+    client = rp.AsyncSocketClient(device_names, addresses, triggered)
+    await client.connect()
+    n_bytes = 0
+    t_start = time.perf_counter()
+    async for block in client.blocks(duration_s):
+        for device_name in block['replied_devices']:
+            n_bytes += len(block[device_name + '_ch1'])
+            if not triggered:
+                n_bytes += len(block[device_name + '_ch2'])
+    elapsed = time.perf_counter() - t_start
+    await client.close()
+    return n_bytes / elapsed / 1e6
+
+
+@export
+def benchmark_acquire(n_devices, acq_time_s=5., sample_rate=10e6, file_size=250e6, acquire_raw=True,
+                      triggered=False, engine='select', zero_copy=False, writer_threads=1, output='buffer', base_port=9800,
+                      data_format=None, writer_processes=0, **simulator_kwargs):
+    """ Run RPDeviceCollection.connect/acquire/disconnect against n_devices
+    simulated devices, writing into a temporary directory. Returns a dict of
+    MB/s written, frames dropped per device and CPU seconds per second per
+    device. CPU is that of this process: reader processes are not included.
+    """
+    device_names = ['dev' + str(i) for i in range(n_devices)]
+
+    with rp.RPStreamSimulator(n_devices, base_port, sample_rate=sample_rate, **simulator_kwargs) as simulator, \
+            tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            collection = rp.RPDeviceCollection(triggered=triggered, zero_copy=zero_copy, engine=engine)
+            for device_name, (address, port) in zip(device_names, simulator.addresses):
+                collection.add_device(device_name, address, port)
+            collection.initialise()
+            collection.connect()
+
+            dropped_start = simulator.frames_dropped()
+            cpu_start = time.process_time()
+            t_start = time.perf_counter()
+            collection.acquire(acq_time_s, file_size=file_size, acquire_raw=acquire_raw, writer_threads=writer_threads, output=output,
+                               data_format=data_format, writer_processes=writer_processes)
+            elapsed = time.perf_counter() - t_start
+            cpu = time.process_time() - cpu_start
+            dropped = [end - start for start, end in zip(dropped_start, simulator.frames_dropped())]
+
+            collection.disconnect()
+            n_bytes = sum(os.path.getsize(file) for file in os.listdir(directory))
+        finally:
+            os.chdir(cwd)
+
+    return {'MB_s': n_bytes / elapsed / 1e6,
+            'dropped_frames': dict(zip(device_names, dropped)),
+            'cpu_per_device': cpu / elapsed / n_devices}
+
+
+@export
+def benchmark_replay(directory, acq_time_s=5., speed=None, loop=True, rate=None, file_size=250e6, acquire_raw=True,
+                     triggered=False, writer_threads=1, output='buffer', data_format=None, writer_processes=0, bin_dtype=None):
+    """ Run RPDeviceCollection.connect/acquire/disconnect on data recorded
+    in directory replayed by a Replay (see there for speed, loop, rate and
+    bin_dtype), writing into a temporary directory. Returns a dict of MB/s
+    written and CPU seconds per second per device.
+    """
+    replay = rp.Replay(os.path.abspath(directory), speed=speed, loop=loop, rate=rate, bin_dtype=bin_dtype)
+    device_names = replay.device_names()
+
+    with tempfile.TemporaryDirectory() as output_directory:
+        cwd = os.getcwd()
+        os.chdir(output_directory)
+        try:
+            collection = rp.RPDeviceCollection(triggered=triggered, engine='replay', replay=replay)
+            for device_name in device_names:
+                collection.add_device(device_name, '127.0.0.1', 0)
+            collection.initialise()
+            collection.connect()
+
+            cpu_start = time.process_time()
+            t_start = time.perf_counter()
+            collection.acquire(acq_time_s, file_size=file_size, acquire_raw=acquire_raw, writer_threads=writer_threads, output=output,
+                               data_format=data_format, writer_processes=writer_processes)
+            elapsed = time.perf_counter() - t_start
+            cpu = time.process_time() - cpu_start
+
+            collection.disconnect()
+            n_bytes = sum(os.path.getsize(file) for file in os.listdir(output_directory))
+        finally:
+            os.chdir(cwd)
+
+    return {'MB_s': n_bytes / elapsed / 1e6,
+            'cpu_per_device': cpu / elapsed / len(device_names)}
+
+
+@export
+def benchmark_compression(samples, compression='zlib', precondition=True, chunk_samples=1048576, threads=1):
+    """ Compress and decompress samples chunk_samples at a time, by threads
+    threads, with compression (see compression.compressor), with or without
+    preconditioning. Returns a dict of compression ratio, and MB/s of
+    samples compressed and decompressed.
+    """
+    compressor = rp.compressor(compression)
+    compressor = rp.Compressor(compressor.codec, compressor.level, delta=precondition, shuffle=precondition)
+    chunks = [samples[start:start + chunk_samples] for start in range(0, len(samples), chunk_samples)]
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        t_start = time.perf_counter()
+        payloads = list(executor.map(compressor.compress, chunks))
+        t_compress = time.perf_counter() - t_start
+        t_start = time.perf_counter()
+        restored = list(executor.map(lambda payload: compressor.decompress(payload, samples.dtype), payloads))
+        t_decompress = time.perf_counter() - t_start
+
+    try:
+        assert all(np.array_equal(chunk, data) for chunk, data in zip(chunks, restored))
+    except:
+        raise RuntimeError(compressor.codec + ' did not restore the samples')
+    return {'ratio': samples.nbytes / max(sum(len(payload) for payload in payloads), 1),
+            'compress_MB_s': samples.nbytes / t_compress / 1e6,
+            'decompress_MB_s': samples.nbytes / t_decompress / 1e6}
+
+
+def _benchmark_waveforms(waveforms, n_samples, files):
+    """ Channel 2 of simulated waveforms, and the samples of files.
+    """
+    data = {}
+    channel_size = 32768
+    n_frames = -(-n_samples // (channel_size // 2))
+    for waveform in waveforms:
+        frames = rp.simulator._frame_bank(waveform, n_frames, channel_size, 100., 20000, 0.1, np.random.default_rng(0))
+        data[waveform] = frames[:, -channel_size:].copy().view('<i2').ravel()[:n_samples]
+    for filename in files:
+        if filename.endswith('.rps'):
+            with rp.ContainerReader(filename) as container:
+                data[os.path.basename(filename)] = container.read()[:n_samples]
+        else:
+            data[os.path.basename(filename)] = np.fromfile(filename, dtype=np.int16, count=n_samples)
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PyRPStream throughput benchmarks against simulated devices')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    engines = subparsers.add_parser('engines', help='Reply queue throughput of each acquisition engine')
+    engines.add_argument('--engines', nargs='+', default=['select', 'threads', 'processes', 'rings', 'asyncio'])
+    engines.add_argument('--devices', nargs='+', type=int, default=[1, 2, 4, 8])
+    engines.add_argument('--seconds', type=float, default=5.)
+    engines.add_argument('--sample-rate', type=float, default=None, help='Samples/s per channel per device (default: unlimited)')
+
+    acquire = subparsers.add_parser('acquire', help='End-to-end RPDeviceCollection.acquire throughput')
+    acquire.add_argument('--devices', nargs='+', type=int, default=[1, 2, 4])
+    acquire.add_argument('--seconds', type=float, default=5.)
+    acquire.add_argument('--sample-rate', type=float, default=10e6, help='Samples/s per channel per device')
+    acquire.add_argument('--file-size', type=float, default=250e6)
+    acquire.add_argument('--engine', default='select')
+    acquire.add_argument('--zero-copy', action='store_true')
+    acquire.add_argument('--writer-threads', type=int, default=1, help='Background writer threads (0: save inline)')
+    acquire.add_argument('--writer-processes', type=int, default=0, help='Writer worker processes (0: use writer threads)')
+    acquire.add_argument('--output', default='buffer', choices=['buffer', 'memmap', 'container'])
+    acquire.add_argument('--calibrated', action='store_true', help='Convert to volts rather than saving raw ADC values')
+    acquire.add_argument('--data-format', default=None, choices=rp.DATA_FORMATS, help='Overrides --calibrated')
+    replay = subparsers.add_parser('replay', help='acquire throughput on replayed recordings')
+    replay.add_argument('directory', help='Directory of frame captures or segment files')
+    replay.add_argument('--seconds', type=float, default=5.)
+    replay.add_argument('--speed', type=float, default=None, help='Times real time (default: as fast as possible)')
+    replay.add_argument('--rate', type=float, default=None, help='Samples/s of .bin segment files, which do not record it')
+    replay.add_argument('--bin-dtype', default=None, choices=['int8', 'int16', 'float16', 'float32'],
+                        help='dtype of .bin segment files, which do not record it either')
+    replay.add_argument('--no-loop', action='store_true', help='Stop at the end of the recording')
+    replay.add_argument('--file-size', type=float, default=250e6)
+    replay.add_argument('--writer-threads', type=int, default=1, help='Background writer threads (0: save inline)')
+    replay.add_argument('--output', default='buffer', choices=['buffer', 'memmap', 'container'])
+    replay.add_argument('--calibrated', action='store_true', help='Convert to volts rather than saving raw ADC values')
+
+    compression = subparsers.add_parser('compression', help='Compression ratio and MB/s per codec and level')
+    compression.add_argument('--codecs', nargs='+', default=['zlib:1', 'zlib:6', 'lzma:0', 'bz2:9'])
+    compression.add_argument('--waveforms', nargs='*', default=['noise', 'pulses', 'sine'])
+    compression.add_argument('--files', nargs='*', default=[], help='Recorded .bin (int16) or .rps files')
+    compression.add_argument('--samples', type=int, default=8388608, help='Samples per waveform or file')
+    compression.add_argument('--threads', type=int, default=1, help='Threads compressing chunks in parallel')
+    args = parser.parse_args()
+
+    if args.benchmark == 'engines':
+        results = {}
+        for i, engine in enumerate(args.engines):
+            for j, n_devices in enumerate(args.devices):
+                # New ports for each run, so that closed sockets in TIME_WAIT are not reused
+                base_port = 9900 + 100 * (i * len(args.devices) + j)
+                results[(engine, n_devices)] = benchmark_engine(engine, n_devices, args.seconds, base_port, sample_rate=args.sample_rate)
+
+        print()
+        print('engine      devices    MB/s   MB/s/device')
+        for (engine, n_devices), mb_s in results.items():
+            print(f'{engine:<10} {n_devices:>8} {mb_s:>7.1f} {mb_s / n_devices:>10.1f}')
+
+    elif args.benchmark == 'acquire':
+        results = {}
+        for j, n_devices in enumerate(args.devices):
+            results[n_devices] = benchmark_acquire(n_devices, args.seconds, args.sample_rate, args.file_size,
+                                                   acquire_raw=not args.calibrated, engine=args.engine,
+                                                   zero_copy=args.zero_copy, writer_threads=args.writer_threads, output=args.output,
+                                                   base_port=9800 + 100 * j, data_format=args.data_format,
+                                                   writer_processes=args.writer_processes)
+
+        print()
+        print('devices    MB/s   dropped frames   CPU/device')
+        for n_devices, result in results.items():
+            print(f'{n_devices:>7} {result["MB_s"]:>7.1f} {sum(result["dropped_frames"].values()):>16} {result["cpu_per_device"]:>12.2f}')
+
+    elif args.benchmark == 'replay':
+        result = benchmark_replay(args.directory, args.seconds, args.speed, not args.no_loop, args.rate, args.file_size,
+                                  acquire_raw=not args.calibrated, writer_threads=args.writer_threads, output=args.output,
+                                  bin_dtype=args.bin_dtype)
+
+        print()
+        print('   MB/s   CPU/device')
+        print(f'{result["MB_s"]:>7.1f} {result["cpu_per_device"]:>12.2f}')
+
+    elif args.benchmark == 'compression':
+        print('data         codec     precondition   ratio   compress MB/s   decompress MB/s')
+        for name, samples in _benchmark_waveforms(args.waveforms, args.samples, args.files).items():
+            for codec in args.codecs:
+                for precondition in (False, True):
+                    result = benchmark_compression(samples, codec, precondition, threads=args.threads)
+                    print(f'{name:<12} {codec:<9} {str(precondition):<12} {result["ratio"]:>7.2f} {result["compress_MB_s"]:>15.1f}'
+                          f' {result["decompress_MB_s"]:>17.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,225 @@
 """
 02/22, R James
+
+Calibration of the gain and offset of each channel, from the live stream of
+every device at once: the inputs are held at known DC levels in turn, and
+the raw ADC values at each are accumulated into running statistics, with no
+data saved. A straight line through the points gives the calibration
+(V = gain * (ADC * input_range_V / 2**input_bits + offset), as AdcConverter):
+
+    calibrator = rp.Calibrator(collection, duration_s=1.)
+    calibrator.measure(0.)      # inputs grounded
+    calibrator.measure(0.5)     # inputs at 0.5 V DC
+    calibrator.fit()            # applied to the devices of the collection
+    calibrator.save()           # <device>_calibration.json, loaded by RPDevice
 """
 
+import json
+import os
+import time
 import numpy as np
 import paramiko
-import subprocess
 
 import PyRPStream as rp
 export, __all__ = rp.exporter()
 
 
 @export
-class CalibUtil:
+class RunningStats:
+    """ Count, mean and variance of the samples added so far, updated a block
+        at a time by Welford's method (merging each block's own mean and sum
+        of squared deviations), in float64.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+
+    def add(self, data):
+        n = len(data)
+        if not n:
+            return
+        data = np.asarray(data, dtype=np.float64)
+        mean = data.mean()
+        m2 = np.square(data - mean).sum()
+        delta = mean - self.mean
+        count = self.count + n
+        self.mean += delta * n / count
+        self.m2 += m2 + delta ** 2 * self.count * n / count
+        self.count = count
+
+
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.
+
+
+    def std(self):
+        return self.variance() ** 0.5
+
+
+
+@export
+class CalibrationRecord:
+    """ Calibration of one device: the gain and offset of each channel, the
+        ADC parameters they apply to, and the points they were fitted to,
+        each a dict of level_V and, per channel, mean_adc, std_adc and
+        n_samples. Saved as JSON to <device>_calibration.json.
+    """
+    def __init__(self, device_name, ch1_gain=1., ch1_offset=0., ch2_gain=1., ch2_offset=0., input_range_V=2., input_bits=16,
+                 points=(), t_ns=None):
+        self.device_name = device_name
+        self.ch1_gain = ch1_gain
+        self.ch1_offset = ch1_offset
+        self.ch2_gain = ch2_gain
+        self.ch2_offset = ch2_offset
+        self.input_range_V = input_range_V
+        self.input_bits = input_bits
+        self.points = list(points)
+        self.t_ns = time.time_ns() if t_ns is None else t_ns
+
+
+    @staticmethod
+    def filename(device_name, directory='.'):
+        return os.path.join(directory, device_name + '_calibration.json')
+
+
+    def save(self, directory='.'):
+        with open(self.filename(self.device_name, directory), 'w') as file:
+            json.dump(vars(self), file, indent=1)
+
+
+    @classmethod
+    def load(cls, device_name, directory='.'):
+        """ The saved record of device_name, or None if there is none.
+        """
+        filename = cls.filename(device_name, directory)
+        if not os.path.isfile(filename):
+            return None
+        with open(filename, 'r') as file:
+            return cls(**json.load(file))
+
+
+
+@export
+def fit_gain_offset(levels_V, adc_means, input_range_V=2., input_bits=16, gain=1., offset=0.):
+    """ Gain and offset of one channel from the mean ADC values adc_means
+    read at input levels levels_V: a least squares line through two or more
+    levels, or from one level, the offset (at 0 V) or the gain (otherwise)
+    alone, keeping the given gain or offset.
+    """
+    volts = np.asarray(adc_means, dtype=np.float64) * input_range_V / 2. ** input_bits
+    levels_V = np.asarray(levels_V, dtype=np.float64)
+    if len(np.unique(levels_V)) >= 2:
+        slope, intercept = np.polyfit(volts, levels_V, 1)
+        return float(slope), float(intercept / slope)
+    if not len(levels_V):
+        return gain, offset
+    if levels_V[0] == 0.:
+        return gain, float(-volts.mean())
+    return float(levels_V[0] / (volts.mean() + offset)), offset
+
+
+
+@export
+class Calibrator:
+    """ Calibrates every device of a connected RPDeviceCollection at once.
+        Each measure() streams raw ADC values for duration_s seconds (or
+        until each device has n_samples samples, if given) into RunningStats
+        per device and channel; fit() fits the points measured to give a
+        CalibrationRecord per device, applied to the devices.
     """
+    def __init__(self, collection, duration_s=1., n_samples=None):
+        try:
+            assert duration_s > 0 or n_samples is not None
+        except:
+            raise ValueError('duration_s must be positive, or n_samples given')
+
+        self.collection = collection
+        self.duration_s = duration_s
+        self.n_samples = n_samples
+        # Per device, a dict per point measured
+        self.points = {device_name: [] for device_name in collection.device_collection}
+        self.records = {}
+
+
+    def measure(self, level_V=None):
+        """ Accumulate the statistics of each channel of each device, as a
+        point at input level level_V if given. Returns {device name:
+        {channel: RunningStats}}.
+        """
+        stats = {device_name: {1: RunningStats(), 2: RunningStats()} for device_name in self.collection.device_collection}
+        blocks = self.collection.stream(self.duration_s if self.n_samples is None else None)
+        try:
+            for block in blocks:
+                channels = stats[block.device_name]
+                n = len(block)
+                if self.n_samples is not None:
+                    n = min(n, self.n_samples - channels[1].count)
+                channels[1].add(block.ch1[:n])
+                if block.ch2 is not None:
+                    channels[2].add(block.ch2[:n])
+                if self.n_samples is not None and all(channels[1].count >= self.n_samples for channels in stats.values()):
+                    break
+        finally:
+            blocks.close()
+
+        if level_V is not None:
+            for device_name, channels in stats.items():
+                point = {'level_V': level_V}
+                for channel, channel_stats in channels.items():
+                    if channel_stats.count:
+                        point['ch' + str(channel)] = {'mean_adc': channel_stats.mean, 'std_adc': channel_stats.std(),
+                                                      'n_samples': channel_stats.count}
+                self.points[device_name].append(point)
+                print(device_name + ' at ' + str(level_V) + ' V: ' + ', '.join(
+                    'ch' + str(channel) + ' ' + f'{channel_stats.mean:.1f} +- {channel_stats.std():.1f}'
+                    for channel, channel_stats in channels.items() if channel_stats.count) + ' ADC')
+        return stats
+
+
+    def fit(self):
+        """ Fit the points measured for each device, and apply the results to
+        the devices. Returns {device name: CalibrationRecord}.
+        """
+        for device_name, points in self.points.items():
+            device = self.collection.device_collection[device_name]
+            calibration = {}
+            for channel in (1, 2):
+                key = 'ch' + str(channel)
+                measured = [point for point in points if key in point]
+                calibration[key + '_gain'], calibration[key + '_offset'] = fit_gain_offset(
+                    [point['level_V'] for point in measured], [point[key]['mean_adc'] for point in measured],
+                    device.input_range_V, device.input_bits, getattr(device, key + '_gain'), getattr(device, key + '_offset'))
+            record = CalibrationRecord(device_name, input_range_V=device.input_range_V, input_bits=device.input_bits, points=points,
+                                       **calibration)
+            device.apply_calibration(record)
+            self.records[device_name] = record
+        return self.records
+
+
+    def save(self, directory='.'):
+        """ Save the record of each device fitted, for RPDevice to load.
+        """
+        for record in self.records.values():
+            record.save(directory)
+
+
+
+@export
+class CalibUtil:
+    """ Calibration of a single device, by streaming from it with the inputs
+        grounded, then at a DC level.
     """
-    def __init__(self, device_name, device_address, device_port):
-        # RP device
+    def __init__(self, device_name, device_address, device_port, duration_s=1.):
+        # RP device, in a collection of its own to stream from
         self.device_name = device_name
-        self.device = rp.RPDevice(device_name, device_address, device_port)
+        self.collection = rp.RPDeviceCollection()
+        self.collection.add_device(device_name, device_address, device_port)
+        self.device = self.collection.device_collection[device_name]
+        self.calibrator = Calibrator(self.collection, duration_s)
+        # The collection's socket thread is started again (by initialise) only to measure, so it does not keep scripts running
+        self.collection.client.join()
         # RP device SSH connection information
         self.user_host_password = ('root', device_address, 'root')
         # Calibration parameters
@@ -28,69 +230,46 @@ class CalibUtil:
 
 
     def reset_calib(self):
-        """
+        """ Reset the device's own calibration, and remove any saved here.
         """
         ssh = paramiko.SSHClient()
         ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         ssh.connect(self.user_host_password[1], username=self.user_host_password[0], password=self.user_host_password[2])
         ssh_stdin, ssh_stdout, ssh_stderr = ssh.exec_command('/opt/redpitaya/bin/calib -d')
-        subprocess.Popen("rm -f {filename}".format(filename=self.device_name + '_calib.txt'),
-                         shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+        for filename in (CalibrationRecord.filename(self.device_name), self.device_name + '_calib.txt'):
+            if os.path.isfile(filename):
+                os.remove(filename)
 
 
     def write_calib(self):
+        """ Save the calibration, for RPDevice to load.
         """
-        """
-        file = open(self.device_name + '_calib.txt', 'w')
-        lines = [str(self.ch1_offset), str(self.ch1_gain), str(self.ch2_offset), str(self.ch2_gain)]
-        file.writelines('%s\n' % l for l in lines)
+        CalibrationRecord(self.device_name, self.ch1_gain, self.ch1_offset, self.ch2_gain, self.ch2_offset,
+                          self.device.input_range_V, self.device.input_bits, self.calibrator.points[self.device_name]).save()
+
+
+    def _measure(self, level_V):
+        self.collection.initialise()
+        self.collection.connect()
+        try:
+            self.calibrator.measure(level_V)
+        finally:
+            self.collection.disconnect()
+        record = self.calibrator.fit()[self.device_name]
+        self.ch1_gain, self.ch1_offset = record.ch1_gain, record.ch1_offset
+        self.ch2_gain, self.ch2_offset = record.ch2_gain, record.ch2_offset
 
 
     def ground_inputs(self):
-        """
+        """ Offsets, from the inputs grounded.
         """
         print('NOTE: this will only work if inputs are grounded')
+        self._measure(0.)
 
-        self.device.connect()
-        self.device.acquire_calib(acquire_raw=True)
-        self.device.disconnect()
-
-        data = np.loadtxt('red_pitaya_data_ch1_calib.txt')
-        mean_reading = np.mean(data)
-        offset = - mean_reading * self.device.input_range_V / (2. ** self.device.input_bits)
-        self.ch1_offset = offset
-
-        data = np.loadtxt('red_pitaya_data_ch2_calib.txt')
-        mean_reading = np.mean(data)
-        offset = - mean_reading * self.device.input_range_V / (2. ** self.device.input_bits)
-        self.ch2_offset = offset
 
-        subprocess.Popen("rm -f red_pitaya_data_ch1_calib.txt",
-                         shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-        subprocess.Popen("rm -f red_pitaya_data_ch2_calib.txt",
-                         shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-
-
-    def DC_inputs(self):
-        """
+    def DC_inputs(self, level_V=0.5):
+        """ Gains, from the inputs at level_V DC (and offsets too, with
+        ground_inputs measured first).
         """
-        print('NOTE: this will only work if inputs are given 0.5 V DC signals')
-
-        self.device.connect()
-        self.device.acquire_calib(acquire_raw=True)
-        self.device.disconnect()
-
-        data = np.loadtxt('red_pitaya_data_ch1_calib.txt')
-        mean_reading = np.mean(data)
-        gain = 0.5 / (mean_reading * self.device.input_range_V / 2. ** self.device.input_bits + self.ch1_offset)
-        self.ch1_gain = gain
-
-        data = np.loadtxt('red_pitaya_data_ch2_calib.txt')
-        mean_reading = np.mean(data)
-        gain = 0.5 / (mean_reading * self.device.input_range_V / 2. ** self.device.input_bits + self.ch2_offset)
-        self.ch2_gain = gain
-
-        subprocess.Popen("rm -f red_pitaya_data_ch1_calib.txt",
-                         shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-        subprocess.Popen("rm -f red_pitaya_data_ch2_calib.txt",
-                         shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+        print('NOTE: this will only work if inputs are given ' + str(level_V) + ' V DC signals')
+        self._measure(level_V)
@@ -0,0 +1,117 @@
+"""
+02/22, R James
+"""
+
+import sqlite3
+import threading
+import os
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    t_start_ns INTEGER NOT NULL,
+    acq_time_s REAL,
+    devices TEXT,
+    data_format TEXT,
+    output TEXT
+);
+CREATE TABLE IF NOT EXISTS segments (
+    segment_id INTEGER PRIMARY KEY,
+    run_id INTEGER REFERENCES runs(run_id),
+    device TEXT NOT NULL,
+    channel INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    t_start_ns INTEGER NOT NULL,
+    t_end_ns INTEGER NOT NULL,
+    n_samples INTEGER NOT NULL,
+    n_bytes INTEGER NOT NULL,
+    dtype TEXT NOT NULL,
+    data_format TEXT,
+    rate INTEGER,
+    lost_samples INTEGER
+);
+CREATE INDEX IF NOT EXISTS segments_device_time ON segments (device, channel, t_start_ns, t_end_ns);
+'''
+
+
+@export
+class RunCatalog:
+    """ SQLite catalog of acquisition runs and the segment files they wrote,
+        so that data can be found without listing or opening data files:
+
+            catalog = RunCatalog('red_pitaya_catalog.sqlite')
+            catalog.segments('dev0', t0_ns=t0, t1_ns=t1)
+
+        Each segment is recorded once its file has been written, and
+        committed straight away, so the catalog is complete up to any crash.
+        Segments may be added from several threads.
+    """
+    def __init__(self, filename='red_pitaya_catalog.sqlite'):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.executescript(_SCHEMA)
+
+
+    def add_run(self, t_start_ns, acq_time_s=None, devices=(), data_format=None, output=None):
+        """ Record the start of a run, returning its run_id.
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO runs (t_start_ns, acq_time_s, devices, data_format, output) VALUES (?, ?, ?, ?, ?)',
+                (t_start_ns, acq_time_s, ','.join(devices), data_format, output))
+            return cursor.lastrowid
+
+
+    def add_segment(self, run_id, device_name, channel, filename, t_start_ns, t_end_ns, n_samples, dtype,
+                    data_format=None, rate=None, lost_samples=None):
+        """ Record a segment file, which must have been written.
+        """
+        n_bytes = os.path.getsize(filename)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT INTO segments (run_id, device, channel, filename, t_start_ns, t_end_ns, n_samples, n_bytes, dtype, '
+                'data_format, rate, lost_samples) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (run_id, device_name, channel, os.path.abspath(filename), t_start_ns, t_end_ns, n_samples, n_bytes, str(dtype),
+                 data_format, rate, lost_samples))
+
+
+    def runs(self):
+        """ All runs, oldest first, as dictionaries.
+        """
+        with self.lock:
+            return [dict(row) for row in self.connection.execute('SELECT * FROM runs ORDER BY t_start_ns')]
+
+
+    def segments(self, device_name=None, channel=None, t0_ns=None, t1_ns=None, run_id=None):
+        """ Segments, as dictionaries in order of start time, of device_name
+        and channel (by default, all) holding data between t0_ns and t1_ns.
+        """
+        conditions, parameters = [], []
+        for condition, parameter in (('device = ?', device_name), ('channel = ?', channel), ('t_end_ns > ?', t0_ns),
+                                     ('t_start_ns < ?', t1_ns), ('run_id = ?', run_id)):
+            if parameter is not None:
+                conditions.append(condition)
+                parameters.append(parameter)
+        query = 'SELECT * FROM segments' + (' WHERE ' + ' AND '.join(conditions) if conditions else '') + ' ORDER BY t_start_ns, device, channel'
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(query, parameters)]
+
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,119 @@
+"""
+02/22, R James
+
+Lossless compression of chunks of samples with the standard library codecs,
+after preconditioning that makes ADC streams compress better. The samples
+stored come back unchanged: raw ADC values exactly, but volts only as
+already rounded to float16 or float32 when converted (float16 has 11
+significant bits, too few to tell 16-bit ADC values apart).
+
+    delta       samples are replaced by their differences from the previous
+                sample (integer dtypes only, wrapping), zigzag encoded so
+                that small negative differences have small unsigned values
+    shuffle     the bytes of the samples are regrouped by significance (all
+                low bytes, then all high bytes), so that the mostly-zero high
+                bytes of small values form long runs
+"""
+
+import bz2
+import lzma
+import zlib
+import numpy as np
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+COMPRESSION_CODECS = ('zlib', 'lzma', 'bz2')
+__all__.extend(['COMPRESSION_CODECS'])
+
+
+@export
+def precondition(samples, delta=True, shuffle=True):
+    """ Bytes of samples (an array), delta and zigzag encoded and/or byte
+    shuffled.
+    """
+    samples = np.ascontiguousarray(samples)
+    if delta and samples.dtype.kind == 'i' and len(samples):
+        unsigned = np.dtype('u' + str(samples.dtype.itemsize))
+        differences = np.empty_like(samples)
+        differences[0] = samples[0]
+        np.subtract(samples[1:], samples[:-1], out=differences[1:])
+        # Zigzag: 0, -1, 1, -2, ... -> 0, 1, 2, 3, ...
+        samples = ((differences << 1) ^ (differences >> (8 * samples.dtype.itemsize - 1))).view(unsigned)
+    data = samples.view(np.uint8)
+    if shuffle and samples.dtype.itemsize > 1:
+        data = data.reshape(-1, samples.dtype.itemsize).T
+    return np.ascontiguousarray(data).tobytes()
+
+
+@export
+def restore(data, dtype, delta=True, shuffle=True):
+    """ Inverse of precondition: samples of dtype from preconditioned bytes.
+    """
+    dtype = np.dtype(dtype)
+    data = np.frombuffer(data, dtype=np.uint8)
+    if shuffle and dtype.itemsize > 1:
+        data = data.reshape(dtype.itemsize, -1).T
+    samples = np.ascontiguousarray(data).view(dtype).ravel()
+    if delta and dtype.kind == 'i' and len(samples):
+        unsigned = samples.view('u' + str(dtype.itemsize))
+        differences = ((unsigned >> 1) ^ -(unsigned & 1)).view(dtype)
+        samples = np.cumsum(differences, dtype=dtype)
+    return samples
+
+
+
+@export
+class Compressor:
+    """ Compression of chunks of samples with codec (one of
+        COMPRESSION_CODECS) at level (by default the codec's own default),
+        after preconditioning. The codecs release the GIL while compressing,
+        so chunks can be compressed in parallel by threads.
+    """
+    def __init__(self, codec='zlib', level=None, delta=True, shuffle=True):
+        try:
+            assert codec in COMPRESSION_CODECS
+        except:
+            raise ValueError('codec must be one of ' + ', '.join(COMPRESSION_CODECS))
+        self.codec = codec
+        self.level = level
+        self.delta = delta
+        self.shuffle = shuffle
+
+
+    def description(self):
+        """ Description, from which the compressor can be recreated.
+        """
+        return {'codec': self.codec, 'level': self.level, 'delta': self.delta, 'shuffle': self.shuffle}
+
+
+    def compress(self, samples):
+        data = precondition(samples, self.delta, self.shuffle)
+        if self.codec == 'zlib':
+            return zlib.compress(data, -1 if self.level is None else self.level)
+        elif self.codec == 'lzma':
+            return lzma.compress(data, preset=self.level)
+        return bz2.compress(data, 9 if self.level is None else self.level)
+
+
+    def decompress(self, payload, dtype):
+        if self.codec == 'zlib':
+            data = zlib.decompress(payload)
+        elif self.codec == 'lzma':
+            data = lzma.decompress(payload)
+        else:
+            data = bz2.decompress(payload)
+        return restore(data, dtype, self.delta, self.shuffle)
+
+
+
+@export
+def compressor(compression):
+    """ Compressor for compression: None, a Compressor, or a codec name
+    optionally followed by ':' and a level, e.g. 'zlib:1' or 'lzma'.
+    """
+    if compression is None or isinstance(compression, Compressor):
+        return compression
+    codec, _, level = compression.partition(':')
+    return Compressor(codec, int(level) if level else None)
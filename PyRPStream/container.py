@@ -0,0 +1,368 @@
+"""
+02/22, R James
+
+Chunked container for the samples of one device channel (.rps):
+
+    file header     'RPSTREAM', uint32 version, uint32 length, then a JSON
+                    object of that length (device, channel, data_format,
+                    dtype, calibration, rate, chunk_samples, t_file,
+                    compression), padded with spaces so that chunks start
+                    64-byte aligned
+    chunks          32-byte chunk header ('RPCK', uint32 flags, uint64 first
+                    sample, uint64 number of samples, int64 timestamp of the
+                    first sample in ns) followed by the samples, or, for
+                    compressed chunks (flag CHUNK_COMPRESSED), by a uint64
+                    length and the compressed samples (see compression.py)
+    index           one CHUNK_DTYPE record per chunk
+    footer          'RPSINDEX', uint64 offset of the index, uint64 number of
+                    chunks
+
+Chunks hold at most chunk_samples samples, all consecutive: a chunk ends
+early where samples were lost. Chunks are only ever appended, and the index
+and footer written on finalize(), so a file left without them by a crash is
+read by scanning the chunk headers.
+"""
+
+import collections
+import concurrent.futures
+import json
+import os
+import struct
+import numpy as np
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+CONTAINER_MAGIC = b'RPSTREAM'
+CONTAINER_VERSION = 2
+CHUNK_MAGIC = b'RPCK'
+INDEX_MAGIC = b'RPSINDEX'
+CHUNK_COMPRESSED = 1
+_FILE_HEADER = struct.Struct('<8sII')
+_CHUNK_HEADER = struct.Struct('<4sIQQq')
+_LENGTH = struct.Struct('<Q')
+_FOOTER = struct.Struct('<8sQQ')
+# Index record of each chunk: file offset of its samples (or compressed length), first sample, number of samples, timestamp of the first sample
+CHUNK_DTYPE = np.dtype([('offset', '<u8'), ('sample', '<u8'), ('n_samples', '<u8'), ('timestamp', '<i8')])
+__all__.extend(['CHUNK_DTYPE', 'CHUNK_COMPRESSED'])
+
+
+@export
+class ContainerWriter:
+    """ Writes raw ADC blocks from one device channel to a container
+        file, converted by converter (an AdcConverter) to its dtype, with the
+        calibration and sample rate needed to interpret them.
+
+        With compressor (a Compressor), chunks are compressed, by a pool of
+        compress_threads threads so that several chunks are compressed at
+        once, and written in order as they complete.
+    """
+    def __init__(self, filename, device_name, channel, converter, data_format, rate=None, t_file=None, chunk_samples=1048576,
+                 compressor=None, compress_threads=2):
+        self.filename = filename
+        self.converter = converter
+        self.dtype = converter.dtype
+        self.rate = rate
+        self.chunk_samples = chunk_samples
+        self.compressor = compressor
+        self.header = {'device': device_name, 'channel': channel, 'data_format': data_format, 'dtype': self.dtype.name,
+                       'calibration': converter.calibration(), 'rate': rate, 'chunk_samples': chunk_samples, 't_file': t_file,
+                       'compression': compressor.description() if compressor is not None else None}
+        # Chunks being compressed, oldest first
+        self.executor = concurrent.futures.ThreadPoolExecutor(compress_threads) if compressor is not None else None
+        self.max_pending = 2 * compress_threads
+        self.pending = collections.deque()
+
+        self.file = open(filename, 'wb')
+        header = json.dumps(self.header).encode()
+        length = len(header) + (-(_FILE_HEADER.size + len(header)) % 64)
+        self.file.write(_FILE_HEADER.pack(CONTAINER_MAGIC, CONTAINER_VERSION, length) + header.ljust(length))
+        self.file.flush()
+
+        # Chunk being filled, and the first sample and timestamp it started with
+        self.buffer = np.empty(chunk_samples, dtype=self.dtype)
+        self.size = 0
+        self.sample = 0
+        self.timestamp = 0
+        self.index = []
+        self.n_samples = 0
+
+
+    def append(self, block, sample=None, timestamp=None):
+        """ Append a block of raw ADC samples (any buffer, of the converter's
+        sample_dtype), whose first sample has the given stream sample number
+        (by default, following on from the last block) and timestamp in ns.
+        """
+        samples = np.frombuffer(block, dtype=self.converter.sample_dtype)
+        if sample is None:
+            sample = self.sample + self.size
+        if timestamp is None:
+            timestamp = self.timestamp
+        if self.size and sample != self.sample + self.size:
+            # Samples were lost: the chunk ends here
+            self._write_chunk()
+
+        start = 0
+        while start < len(samples):
+            if not self.size:
+                self.sample = sample + start
+                self.timestamp = timestamp + ((start * 1000000000) // self.rate if self.rate else 0)
+            n = min(len(samples) - start, self.chunk_samples - self.size)
+            self.converter.convert(samples[start:start + n], self.buffer[self.size:self.size + n])
+            self.size += n
+            self.n_samples += n
+            start += n
+            if self.size == self.chunk_samples:
+                self._write_chunk()
+
+
+    def _write_chunk(self):
+        if self.compressor is not None:
+            future = self.executor.submit(self.compressor.compress, self.buffer[:self.size].copy())
+            self.pending.append((self.sample, self.size, self.timestamp, future))
+            self.size = 0
+            self._write_compressed(len(self.pending) > self.max_pending)
+            return
+        self.file.write(_CHUNK_HEADER.pack(CHUNK_MAGIC, 0, self.sample, self.size, self.timestamp))
+        self.index.append((self.file.tell(), self.sample, self.size, self.timestamp))
+        self.buffer[:self.size].tofile(self.file)
+        # Each chunk reaches the file as it is completed
+        self.file.flush()
+        self.size = 0
+
+
+    def _write_compressed(self, wait=False):
+        """ Write the compressed chunks that are done, in order, waiting for
+        the oldest if wait.
+        """
+        while self.pending and (wait or self.pending[0][3].done()):
+            sample, size, timestamp, future = self.pending.popleft()
+            payload = future.result()
+            self.file.write(_CHUNK_HEADER.pack(CHUNK_MAGIC, CHUNK_COMPRESSED, sample, size, timestamp))
+            self.index.append((self.file.tell(), sample, size, timestamp))
+            self.file.write(_LENGTH.pack(len(payload)))
+            self.file.write(payload)
+            self.file.flush()
+            wait = False
+
+
+    def finalize(self):
+        """ Write the last chunk, the index and the footer, and close the file.
+        """
+        if self.size:
+            self._write_chunk()
+        while self.pending:
+            self._write_compressed(wait=True)
+        if self.executor is not None:
+            self.executor.shutdown()
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.index, dtype=CHUNK_DTYPE).tobytes())
+        self.file.write(_FOOTER.pack(INDEX_MAGIC, index_offset, len(self.index)))
+        self.file.close()
+
+
+
+@export
+class ContainerReader:
+    """ Reads a container file. Samples are addressed by stream sample number,
+        as written, or by time; the chunks holding them are found from the
+        index without scanning the file.
+
+        complete is False for a file with no index, e.g. after a crash, whose
+        chunks were found by scanning the chunk headers instead.
+
+        Compressed chunks are decompressed whole as they are read.
+        iter_chunks() streams through a file chunk by chunk, decompressing
+        chunks ahead in threads.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+
+        magic, version, length = _FILE_HEADER.unpack(self.file.read(_FILE_HEADER.size))
+        try:
+            assert magic == CONTAINER_MAGIC
+        except:
+            raise ValueError(filename + ' is not a container file')
+
+        try:
+            assert version <= CONTAINER_VERSION
+        except:
+            raise ValueError(filename + ' has container version ' + str(version) + ', newer than ' + str(CONTAINER_VERSION))
+        self.header = json.loads(self.file.read(length).decode())
+        self.data_start = _FILE_HEADER.size + length
+
+        self.device_name = self.header['device']
+        self.channel = self.header['channel']
+        self.data_format = self.header['data_format']
+        self.dtype = np.dtype(self.header['dtype'])
+        self.rate = self.header['rate']
+        self.calibration = self.header['calibration']
+        compression = self.header.get('compression')
+        self.compressor = rp.Compressor(**compression) if compression is not None else None
+
+        self.index = self._read_index()
+        self.complete = self.index is not None
+        if self.index is None:
+            self.index = self._scan_chunks()
+
+
+    def _read_index(self):
+        size = os.path.getsize(self.filename)
+        if size < self.data_start + _FOOTER.size:
+            return None
+        self.file.seek(size - _FOOTER.size)
+        magic, index_offset, n_chunks = _FOOTER.unpack(self.file.read(_FOOTER.size))
+        if magic != INDEX_MAGIC or index_offset + n_chunks * CHUNK_DTYPE.itemsize + _FOOTER.size != size:
+            return None
+        self.file.seek(index_offset)
+        return np.fromfile(self.file, dtype=CHUNK_DTYPE, count=n_chunks)
+
+
+    def _scan_chunks(self):
+        """ Index the complete chunks of a file that was not finalized.
+        """
+        size = os.path.getsize(self.filename)
+        index = []
+        offset = self.data_start
+        while offset + _CHUNK_HEADER.size <= size:
+            self.file.seek(offset)
+            magic, flags, sample, n_samples, timestamp = _CHUNK_HEADER.unpack(self.file.read(_CHUNK_HEADER.size))
+            if magic == CHUNK_MAGIC and flags & CHUNK_COMPRESSED:
+                length = self.file.read(_LENGTH.size)
+                end = offset + _CHUNK_HEADER.size + _LENGTH.size + (_LENGTH.unpack(length)[0] if len(length) == _LENGTH.size else size)
+            else:
+                end = offset + _CHUNK_HEADER.size + n_samples * self.dtype.itemsize
+            if magic != CHUNK_MAGIC or end > size:
+                # Partly written chunk
+                break
+            index.append((offset + _CHUNK_HEADER.size, sample, n_samples, timestamp))
+            offset = end
+        return np.array(index, dtype=CHUNK_DTYPE)
+
+
+    def __len__(self):
+        return int(self.index['n_samples'].sum())
+
+
+    def converter(self, dtype):
+        """ AdcConverter from the stored raw ADC values to V in dtype.
+        """
+        return rp.AdcConverter(dtype=dtype, **self.calibration)
+
+
+    def _convert(self, data, dtype):
+        if dtype is None or np.dtype(dtype) == self.dtype:
+            return data
+        if self.dtype.kind != 'i':
+            # Already in V
+            return data.astype(dtype)
+        return self.converter(dtype).convert(data)
+
+
+    def chunk(self, i, dtype=None):
+        """ The samples of chunk i, in dtype (by default as stored, otherwise
+        converted to V).
+        """
+        return self._convert(self._decompress(self._payload(i)), dtype)
+
+
+    def _payload(self, i):
+        """ Stored samples of chunk i, or their compressed bytes.
+        """
+        offset, _, n_samples, _ = self.index[i]
+        self.file.seek(int(offset))
+        if self.compressor is None:
+            return np.fromfile(self.file, dtype=self.dtype, count=int(n_samples))
+        length, = _LENGTH.unpack(self.file.read(_LENGTH.size))
+        return self.file.read(length)
+
+
+    def _decompress(self, payload):
+        if self.compressor is None:
+            return payload
+        return self.compressor.decompress(payload, self.dtype)
+
+
+    def iter_chunks(self, dtype=None, threads=2):
+        """ Iterate over (first sample, timestamp, samples) of each chunk in
+        order, with samples in dtype as for chunk(). The file is read
+        sequentially; compressed chunks are decompressed by threads threads,
+        up to threads chunks ahead of the one returned.
+        """
+        if self.compressor is None:
+            for i in range(len(self.index)):
+                yield int(self.index['sample'][i]), int(self.index['timestamp'][i]), self.chunk(i, dtype)
+            return
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            pending = collections.deque()
+            for i in range(len(self.index)):
+                pending.append((i, executor.submit(self._decompress, self._payload(i))))
+                if len(pending) > threads:
+                    yield self._pending_chunk(pending.popleft(), dtype)
+            while pending:
+                yield self._pending_chunk(pending.popleft(), dtype)
+
+
+    def _pending_chunk(self, job, dtype):
+        i, future = job
+        return int(self.index['sample'][i]), int(self.index['timestamp'][i]), self._convert(future.result(), dtype)
+
+
+    def sample_at(self, t_ns):
+        """ Number of the first sample at or after time t_ns. Without a sample
+        rate, this is the first sample of the chunk holding t_ns.
+        """
+        i = np.searchsorted(self.index['timestamp'], t_ns, side='right') - 1
+        if i < 0:
+            return int(self.index['sample'][0]) if len(self.index) else 0
+        _, sample, n_samples, timestamp = (int(value) for value in self.index[i])
+        if not self.rate:
+            return sample
+        # Round up to the next sample, or past the end of the chunk if t_ns falls in a gap
+        return sample + min(n_samples, -((-(t_ns - timestamp) * self.rate) // 1000000000))
+
+
+    def read(self, start=None, stop=None, dtype=None):
+        """ Samples with stream sample numbers from start to stop (by default,
+        all), in dtype as for chunk(). Lost samples are skipped.
+        """
+        if start is None:
+            start = 0
+        if stop is None:
+            stop = np.iinfo(np.int64).max
+        first = self.index['sample'].astype(np.int64)
+        end = first + self.index['n_samples'].astype(np.int64)
+        i_start = np.searchsorted(end, start, side='right')
+        i_stop = np.searchsorted(first, stop, side='left')
+
+        parts = []
+        for i in range(i_start, i_stop):
+            a = max(start - first[i], 0)
+            b = min(stop - first[i], end[i] - first[i])
+            if self.compressor is not None:
+                parts.append(self._decompress(self._payload(i))[a:b])
+                continue
+            self.file.seek(int(self.index['offset'][i]) + int(a) * self.dtype.itemsize)
+            parts.append(np.fromfile(self.file, dtype=self.dtype, count=int(b - a)))
+        data = np.concatenate(parts) if parts else np.empty(0, dtype=self.dtype)
+        return self._convert(data, dtype)
+
+
+    def read_time(self, t_start_ns, t_stop_ns, dtype=None):
+        """ Samples from time t_start_ns to t_stop_ns, as for read().
+        """
+        return self.read(self.sample_at(t_start_ns), self.sample_at(t_stop_ns), dtype)
+
+
+    def close(self):
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
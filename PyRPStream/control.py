@@ -0,0 +1,207 @@
+"""
+02/22, R James, F Alder
+
+Control of the streaming_manager app of each Red Pitaya through its web
+interface: the app is started over HTTP, then configured, started and
+stopped through a websocket kept open per device. Each change is sent as one
+message with in_command send_all_params, to which the device replies with
+all its parameters, so changes are confirmed by reading them back:
+
+    control = rp.ControlPool(['rp-f05a98.local', 'rp-f05a99.local'])
+    control.start_apps()
+    control.configure(resolution_bits=16, rate=120, channels=3)
+    control.start()
+    ...
+    control.stop()
+    control.close()
+
+Devices are controlled concurrently, so a rack takes about as long as one
+board.
+"""
+
+import concurrent.futures
+import json
+import time
+import zlib
+import requests
+from websocket import create_connection, WebSocketTimeoutException
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+# SS_RESOLUTION values by bits per sample, and SS_CHANNEL values by channels streamed
+RESOLUTIONS = {8: 1, 16: 2}
+CHANNELS = {1: 1, 2: 2, 3: 3}
+__all__.extend(['RESOLUTIONS', 'CHANNELS'])
+
+
+def _parameters(message):
+    """ The parameters of a message from the web interface (text, or
+    zlib-compressed binary JSON), as {name: value}, or None if it has none.
+    """
+    if isinstance(message, bytes):
+        try:
+            message = zlib.decompress(message)
+        except zlib.error:
+            pass
+        message = message.decode()
+    try:
+        parameters = json.loads(message).get('parameters')
+    except (ValueError, AttributeError):
+        return None
+    if not isinstance(parameters, dict):
+        return None
+    return {name: value.get('value') if isinstance(value, dict) else value for name, value in parameters.items()}
+
+
+
+@export
+class StreamingControl:
+    """ Control of the streaming_manager app of one device at host (an
+        address or name, optionally with :port), whose websocket is opened
+        on first use and kept open until close(). Every operation waits up
+        to timeout_s seconds, then raises OSError.
+    """
+    def __init__(self, host, timeout_s=5.):
+        self.host = host
+        self.timeout_s = timeout_s
+        self.socket_url = 'ws://' + host + '/wss'
+        self.start_app_url = 'http://' + host + '/bazaar?start=streaming_manager'
+        self.ws = None
+        # Parameters last read back from the device
+        self.parameters = {}
+
+
+    def start_app(self):
+        """ Start the streaming_manager app (and its streaming server).
+        """
+        try:
+            response = requests.get(self.start_app_url, timeout=self.timeout_s)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise OSError('Could not start streaming app on ' + self.host + ': ' + str(e))
+
+
+    def _connect(self):
+        if self.ws is None:
+            try:
+                self.ws = create_connection(self.socket_url, timeout=self.timeout_s)
+            except Exception as e:
+                raise OSError('Could not open websocket to ' + self.host + ': ' + str(e))
+        return self.ws
+
+
+    def set(self, **parameters):
+        """ Set parameters (SS_* names, with their values), confirmed by
+        reading them back. Returns all the device's parameters.
+        """
+        ws = self._connect()
+        message = {'parameters': {name: {'value': value} for name, value in parameters.items()}}
+        message['parameters']['in_command'] = {'value': 'send_all_params'}
+        t_end = time.monotonic() + self.timeout_s
+        try:
+            ws.send(json.dumps(message))
+            while time.monotonic() < t_end:
+                ws.settimeout(max(t_end - time.monotonic(), 0.001))
+                try:
+                    received = _parameters(ws.recv())
+                except WebSocketTimeoutException:
+                    break
+                if received is None:
+                    continue
+                self.parameters.update(received)
+                if all(self.parameters.get(name) == value for name, value in parameters.items()):
+                    return dict(self.parameters)
+        except Exception as e:
+            self.close()
+            raise OSError('Lost websocket to ' + self.host + ': ' + str(e))
+        raise OSError('Parameters not confirmed by ' + self.host + ': ' + str(
+            {name: self.parameters.get(name) for name, value in parameters.items() if self.parameters.get(name) != value}))
+
+
+    def configure(self, resolution_bits=None, rate=None, channels=None, **parameters):
+        """ Set the resolution (8 or 16 bits), rate (SS_RATE) and channels
+        (1, 2, or 3 for both) to stream, and any other SS_* parameters.
+        """
+        if resolution_bits is not None:
+            try:
+                parameters['SS_RESOLUTION'] = RESOLUTIONS[resolution_bits]
+            except KeyError:
+                raise ValueError('resolution_bits must be one of ' + ', '.join(str(bits) for bits in RESOLUTIONS))
+        if rate is not None:
+            parameters['SS_RATE'] = rate
+        if channels is not None:
+            try:
+                parameters['SS_CHANNEL'] = CHANNELS[channels]
+            except KeyError:
+                raise ValueError('channels must be 1, 2 or 3')
+        return self.set(**parameters)
+
+
+    def start(self):
+        return self.set(SS_START=1)
+
+
+    def stop(self):
+        return self.set(SS_START=0)
+
+
+    def close(self):
+        if self.ws is not None:
+            try:
+                self.ws.close()
+            finally:
+                self.ws = None
+
+
+
+@export
+class ControlPool:
+    """ StreamingControls of many devices (hosts, or StreamingControls),
+        whose operations run concurrently on up to max_workers threads. An
+        operation that fails on any device raises OSError naming each
+        device that failed, once all have finished.
+    """
+    def __init__(self, hosts, timeout_s=5., max_workers=16):
+        self.controls = [host if isinstance(host, StreamingControl) else StreamingControl(host, timeout_s) for host in hosts]
+        self.executor = concurrent.futures.ThreadPoolExecutor(max(1, min(max_workers, len(self.controls))))
+
+
+    def _all(self, operation, *args, **kwargs):
+        futures = {control.host: self.executor.submit(getattr(control, operation), *args, **kwargs) for control in self.controls}
+        results, errors = {}, []
+        for host, future in futures.items():
+            try:
+                results[host] = future.result()
+            except (OSError, ValueError) as e:
+                errors.append(str(e))
+        if errors:
+            raise OSError(operation + ' failed: ' + '; '.join(errors))
+        return results
+
+
+    def start_apps(self):
+        return self._all('start_app')
+
+
+    def set(self, **parameters):
+        return self._all('set', **parameters)
+
+
+    def configure(self, resolution_bits=None, rate=None, channels=None, **parameters):
+        return self._all('configure', resolution_bits, rate, channels, **parameters)
+
+
+    def start(self):
+        return self._all('start')
+
+
+    def stop(self):
+        return self._all('stop')
+
+
+    def close(self):
+        for control in self.controls:
+            control.close()
+        self.executor.shutdown()
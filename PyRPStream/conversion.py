@@ -0,0 +1,167 @@
+"""
+02/22, R James
+"""
+
+import json
+import os
+import numpy as np
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+# Formats data can be saved in: raw ADC values, volts, or raw ADC values with the calibration to convert them on reading
+DATA_FORMATS = ('int8', 'int16', 'float16', 'float32', 'lazy')
+# dtype of raw ADC samples by bits per sample streamed (SS_RESOLUTION)
+SAMPLE_DTYPES = {8: np.dtype(np.int8), 16: np.dtype(np.int16)}
+__all__.extend(['DATA_FORMATS', 'SAMPLE_DTYPES'])
+
+
+@export
+def sample_dtype(input_bits=16):
+    """ dtype of raw ADC samples of input_bits bits (8 or 16).
+    """
+    try:
+        return SAMPLE_DTYPES[input_bits]
+    except KeyError:
+        raise ValueError('input_bits must be one of ' + ', '.join(str(bits) for bits in SAMPLE_DTYPES))
+
+
+@export
+def data_format_dtype(data_format, input_bits=16):
+    """ dtype that data of input_bits bit ADC samples is saved with in
+    data_format. Raw formats may widen samples, but not narrow them.
+    """
+    try:
+        assert data_format in DATA_FORMATS
+    except:
+        raise ValueError('data_format must be one of ' + ', '.join(DATA_FORMATS))
+    if data_format == 'lazy':
+        return sample_dtype(input_bits)
+    dtype = np.dtype(data_format)
+    try:
+        assert dtype.kind != 'i' or dtype.itemsize >= sample_dtype(input_bits).itemsize
+    except:
+        raise ValueError('data_format ' + data_format + ' cannot hold ' + str(input_bits) + ' bit samples')
+    return dtype
+
+
+
+@export
+class AdcConverter:
+    """ ADC -> V conversion for one channel, with calibration factors:
+
+        V = gain * (ADC * input_range_V / 2**input_bits + offset)
+
+        computed as ADC * scale + shift in float32, chunk_size samples at a
+        time into a reused work buffer, so converting a segment allocates no
+        temporaries beyond its output. Raw values are of sample_dtype (int8
+        or int16, by input_bits); with an integer dtype, they are copied
+        unconverted. Volts in float16 are rounded to 11 significant bits, so
+        16-bit ADC values cannot be recovered from them exactly.
+    """
+    def __init__(self, gain=1., offset=0., input_range_V=2., input_bits=16, dtype=np.float16, chunk_size=65536):
+        self.gain = gain
+        self.offset = offset
+        self.input_range_V = input_range_V
+        self.input_bits = input_bits
+        self.sample_dtype = sample_dtype(input_bits)
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        # float32 scalars keep the arithmetic in float32
+        self.scale = np.float32(gain * input_range_V / 2. ** input_bits)
+        self.shift = np.float32(gain * offset)
+
+
+    def calibration(self):
+        """ Calibration metadata, from which the converter can be recreated.
+        """
+        return {'gain': self.gain, 'offset': self.offset, 'input_range_V': self.input_range_V, 'input_bits': self.input_bits}
+
+
+    def convert(self, data, out=None):
+        """ Convert raw ADC values (an array or any buffer) into out, or a new
+        array of dtype, and return it.
+        """
+        if not isinstance(data, np.ndarray):
+            data = np.frombuffer(data, dtype=self.sample_dtype)
+        if out is None:
+            out = np.empty(len(data), dtype=self.dtype)
+
+        if self.dtype.kind == 'i':
+            out[:] = data
+            return out
+
+        # float32 output is converted in place; narrower output through a work buffer
+        work = np.empty(min(self.chunk_size, len(data)), dtype=np.float32) if out.dtype != np.float32 else None
+        for start in range(0, len(data), self.chunk_size):
+            stop = min(start + self.chunk_size, len(data))
+            chunk = out[start:stop] if work is None else work[:stop - start]
+            np.multiply(data[start:stop], self.scale, out=chunk)
+            np.add(chunk, self.shift, out=chunk)
+            if work is not None:
+                out[start:stop] = chunk
+        return out
+
+
+    def to_adc(self, volts, out=None):
+        """ Convert V back to raw ADC values (the inverse of convert), into
+        out or a new array of sample_dtype, rounded to the nearest value and
+        clipped to its range. Values are only as exact as the volts: from
+        float16, 16-bit values are off by up to the float16 rounding.
+        """
+        if out is None:
+            out = np.empty(len(volts), dtype=self.sample_dtype)
+        limits = np.iinfo(self.sample_dtype)
+        counts = np.subtract(volts, self.shift, dtype=np.float32)
+        np.divide(counts, self.scale, out=counts)
+        np.rint(counts, out=counts)
+        np.clip(counts, limits.min, limits.max, out=counts)
+        out[:] = counts
+        return out
+
+
+    def chunks(self, data):
+        """ Iterate over data converted chunk_size samples at a time. Each
+        chunk reuses the same buffer, so must be used before the next.
+        """
+        if not isinstance(data, np.ndarray):
+            data = np.frombuffer(data, dtype=self.sample_dtype)
+        buffer = np.empty(min(self.chunk_size, len(data)), dtype=self.dtype)
+        for start in range(0, len(data), self.chunk_size):
+            stop = min(start + self.chunk_size, len(data))
+            yield self.convert(data[start:stop], out=buffer[:stop - start])
+
+
+
+@export
+def calibration_filename(filename):
+    """ Name of the calibration metadata file saved with raw data in 'lazy'
+    data_format.
+    """
+    return os.path.splitext(filename)[0] + '_calib.json'
+
+
+@export
+def save_calibration(filename, converter):
+    """ Save the calibration of converter alongside the raw data file filename.
+    """
+    with open(calibration_filename(filename), 'w') as file:
+        json.dump(converter.calibration(), file)
+
+
+@export
+def load_data(filename, dtype=np.float32, mmap=False):
+    """ Load a .bin data file. Files saved in 'lazy' data_format are converted
+    to volts in dtype with their saved calibration; other files are read as
+    dtype, which must be the dtype they were saved in. With mmap, raw data is
+    memory mapped rather than read in full before conversion.
+    """
+    calibration = calibration_filename(filename)
+    if not os.path.isfile(calibration):
+        return np.memmap(filename, dtype=dtype, mode='r') if mmap else np.fromfile(filename, dtype=dtype)
+
+    with open(calibration, 'r') as file:
+        converter = AdcConverter(dtype=dtype, **json.load(file))
+    data = np.memmap(filename, dtype=converter.sample_dtype, mode='r') if mmap else np.fromfile(filename, dtype=converter.sample_dtype)
+    return converter.convert(data)
@@ -5,53 +5,186 @@
 import numpy as np
 import time
 import os
+import queue
+import warnings
 
 import PyRPStream as rp
 export, __all__ = rp.exporter()
 
 
+def _reply_queue_depth(collection):
+    return collection.client.reply_q.qsize()
+
+
+def _frames_dropped(collection):
+    return sum(collection.client.reply_q.counters()['dropped'].values())
+
+
 class RPDevice:
     """
     """
-    def __init__(self, name, address, port):
+    def __init__(self, name, address, port, control_host=None, input_bits=16):
         # Device name
         self.name = name
-        # Calibration parameters
-        if os.path.isfile(self.name + '_calib.txt'):
+        # Connection information, and host of the web interface through which streaming is controlled
+        self.address_port = (address, port)
+        self.control_host = address if control_host is None else control_host
+        # Device information: bits per sample streamed, and the dtype of the raw ADC values
+        self.input_range_V = 2.
+        self.input_bits = input_bits
+        self.sample_dtype = rp.sample_dtype(input_bits)
+        # Calibration parameters: from the saved CalibrationRecord, or a calibration file of the older format
+        self.ch1_offset = 0.
+        self.ch1_gain = 1.
+        self.ch2_offset = 0.
+        self.ch2_gain = 1.
+        record = rp.CalibrationRecord.load(self.name)
+        if record is not None:
+            self.apply_calibration(record)
+        elif os.path.isfile(self.name + '_calib.txt'):
             file = open(self.name + '_calib.txt', 'r')
             calib_consts = file.readlines()
             self.ch1_offset = float(calib_consts[0])
             self.ch1_gain = float(calib_consts[1])
             self.ch2_offset = float(calib_consts[2])
             self.ch2_gain = float(calib_consts[3])
-        else:
-            self.ch1_offset = 0.
-            self.ch1_gain = 1.
-            self.ch2_offset = 0.
-            self.ch2_gain = 1.
-        # Connection information
-        self.address_port = (address, port)
-        # Device information
-        self.input_range_V = 2.
-        self.input_bits = 16
+
+
+    def apply_calibration(self, record):
+        """ Use the gains and offsets of a CalibrationRecord.
+        """
+        self.ch1_gain, self.ch1_offset = record.ch1_gain, record.ch1_offset
+        self.ch2_gain, self.ch2_offset = record.ch2_gain, record.ch2_offset
+
+
+    def converter(self, channel, dtype=None):
+        """ AdcConverter from raw ADC values on channel to V in dtype (by
+        default utils.DTYPE), with calibration factors.
+        """
+        gain, offset = (self.ch1_gain, self.ch1_offset) if channel == 1 else (self.ch2_gain, self.ch2_offset)
+        return rp.AdcConverter(gain, offset, self.input_range_V, self.input_bits, rp.dtype() if dtype is None else dtype)
+
+
+    def adc_to_volts(self, data, channel, out=None, dtype=None):
+        """ Convert raw ADC values from channel to V, with calibration factors,
+        into out if given.
+        """
+        return self.converter(channel, dtype).convert(data, out)
+
+
+class SegmentBuffer:
+    """ Preallocated byte buffer that channel blocks are copied into until a
+    segment is saved, then reused for the next segment.
+    """
+    def __init__(self, capacity):
+        self.data = bytearray(capacity)
+        self.view = memoryview(self.data)
+        self.size = 0
+
+
+    def append(self, block):
+        block = memoryview(block).cast('B')
+        n = len(block)
+        self.view[self.size:self.size + n] = block
+        self.size += n
+
+
+    def contents(self):
+        return self.view[:self.size]
+
+
+    def clear(self):
+        self.size = 0
+
 
 
 @export
 class RPDeviceCollection:
     """
     """
-    def __init__(self, triggered=False):
+    def __init__(self, triggered=False, zero_copy=False, engine='select', reply_q_size=0, overflow='block', spill_dir=None,
+                 metrics=None, connect_timeout_s=5., reconnect=None, group_size=8, resolution_bits=16, replay=None):
+        try:
+            assert engine in ('select', 'threads', 'processes', 'rings', 'replay')
+        except:
+            raise ValueError("engine must be 'select', 'threads', 'processes', 'rings' or 'replay'")
+
+        try:
+            assert (engine == 'replay') == (replay is not None)
+        except:
+            raise ValueError("engine 'replay' needs replay (a Replay), and replay needs engine 'replay'")
+
+        try:
+            assert reconnect is None or reconnect is False or engine == 'select'
+        except:
+            raise ValueError("reconnect needs engine 'select'")
+
+        try:
+            assert resolution_bits in rp.SAMPLE_DTYPES
+        except:
+            raise ValueError('resolution_bits must be 8 or 16')
+
+        # Bits per sample streamed by every device (SS_RESOLUTION): 8-bit samples halve bandwidth and storage
+        self.resolution_bits = resolution_bits
         # Device collection
         self.device_collection = {}
         # Triggered or untriggered mode
         self.triggered = triggered
+        # Receive into preallocated, reusable buffers (select engine only)
+        self.zero_copy = zero_copy
+        # Acquisition engine: one select loop over all sockets, one reader thread/process per device, a reader process per
+        # group_size devices writing into shared memory rings, or the replay of recorded data (a Replay)
+        self.engine = engine
+        self.group_size = group_size
+        self.replay = replay
+        # Buffer between socket client and consumer: size (0 for unbounded) and BoundedReplyQueue overflow policy
+        self.reply_q_options = {'reply_q_size': reply_q_size, 'overflow': overflow, 'spill_dir': spill_dir}
+        # Time allowed for each device to connect, and ReconnectPolicy for devices lost while streaming (True for the default)
+        self.connect_timeout_s = connect_timeout_s
+        self.reconnect = rp.ReconnectPolicy() if reconnect is True else (reconnect or None)
+        # Background segment writer, during acquisition
+        self.writer = None
+        # Catalog of runs and segment files, during acquisition
+        self.catalog = None
+        # Compressor of segment files, during acquisition
+        self.compressor = None
+        # Streaming control of every device, once used
+        self.control = None
+        # Metrics of the acquisition pipeline (see metrics.py), with reply queue depth and drops read when wanted, summed with
+        # those of any other collections using the registry (which holds the collection weakly, so does not keep it alive)
+        self.metrics = rp.metrics() if metrics is None else metrics
+        self.metrics.gauge('rp_reply_queue_depth').add_source(self, _reply_queue_depth)
+        self.metrics.gauge('rp_frames_dropped').add_source(self, _frames_dropped)
+        self.consumer_lag = self.metrics.histogram('rp_consumer_lag_seconds')
+        self.inline_write_metrics = rp.WriteMetrics(self.metrics, 'inline')
         # Socket thread
-        self.client = rp.SocketClientThread([], self.triggered)
+        self.client = self._new_client([])
         # Start the socket thread
         self.client.start()
 
 
-    def add_device(self, device_name, device_address, device_port):
+    def _new_client(self, device_names):
+        """ Create the socket client for the chosen acquisition engine.
+        """
+        if self.engine == 'select':
+            return rp.SocketClientThread(device_names, self.triggered, zero_copy=self.zero_copy, metrics=self.metrics,
+                                         connect_timeout_s=self.connect_timeout_s, reconnect=self.reconnect,
+                                         resolution_bits=self.resolution_bits, **self.reply_q_options)
+        if self.engine == 'replay':
+            # To convert segments saved in volts back to raw ADC values
+            devices = [self.device_collection[device_name] for device_name in device_names]
+            converters = {device.name: (device.converter(1), device.converter(2)) for device in devices}
+            return rp.ReplayClient(device_names, self.replay, self.triggered, metrics=self.metrics, resolution_bits=self.resolution_bits,
+                                   converters=converters, **self.reply_q_options)
+        if self.engine == 'rings':
+            return rp.RingSocketClient(device_names, self.triggered, group_size=self.group_size, metrics=self.metrics,
+                                       connect_timeout_s=self.connect_timeout_s, resolution_bits=self.resolution_bits, **self.reply_q_options)
+        return rp.ParallelSocketClient(device_names, self.triggered, processes=(self.engine == 'processes'), metrics=self.metrics,
+                                       connect_timeout_s=self.connect_timeout_s, resolution_bits=self.resolution_bits,
+                                       **self.reply_q_options)
+
+
+    def add_device(self, device_name, device_address, device_port, control_host=None):
         try:
             assert isinstance(device_name, str)
         except:
@@ -68,7 +201,74 @@ class RPDeviceCollection:
             raise ValueError('device_port must be int')
 
         # Add new device to device collection
-        self.device_collection[device_name] = RPDevice(device_name, device_address, device_port)
+        self.device_collection[device_name] = RPDevice(device_name, device_address, device_port, control_host, self.resolution_bits)
+        if self.control is not None:
+            self.control.close()
+            self.control = None
+
+
+    def _control(self):
+        if self.control is None:
+            self.control = rp.ControlPool([device.control_host for device in self.device_collection.values()])
+        return self.control
+
+
+    def configure_streaming(self, resolution_bits=None, rate=None, channels=3, start_app=True, **parameters):
+        """ Start the streaming_manager app of every device (if start_app),
+        and set its resolution, rate, channels and any other SS_* parameters,
+        on all devices at once (see control.py). Raises OSError if any
+        device does not confirm them.
+
+        resolution_bits is by default that of the collection; otherwise the
+        collection is set to receive it too (see set_resolution).
+        """
+        if resolution_bits is None:
+            resolution_bits = self.resolution_bits
+        elif resolution_bits != self.resolution_bits:
+            self.set_resolution(resolution_bits)
+        control = self._control()
+        if start_app:
+            control.start_apps()
+        control.configure(resolution_bits, rate, channels, **parameters)
+        print('Configured streaming on ' + ', '.join(self.device_collection))
+
+
+    def set_resolution(self, resolution_bits):
+        """ Receive, convert and save samples of resolution_bits (8 or 16)
+        bits, as the devices stream them. The socket client is recreated, so
+        no devices may be connected.
+        """
+        try:
+            assert resolution_bits in rp.SAMPLE_DTYPES
+        except:
+            raise ValueError('resolution_bits must be 8 or 16')
+
+        if any(self.client.connected):
+            raise OSError('Cannot change resolution while connected to devices')
+        self.resolution_bits = resolution_bits
+        for device in self.device_collection.values():
+            device.input_bits = resolution_bits
+            device.sample_dtype = rp.sample_dtype(resolution_bits)
+        if self.client.alive.isSet():
+            self.initialise()
+
+
+    def start_streaming(self):
+        """ Start streaming on every device at once.
+        """
+        self._control().start()
+        print('Started streaming on ' + ', '.join(self.device_collection))
+
+
+    def stop_streaming(self):
+        """ Stop streaming on every device at once, and close the websockets.
+        """
+        try:
+            self._control().stop()
+            print('Stopped streaming on ' + ', '.join(self.device_collection))
+        finally:
+            self.control.close()
+            self.control = None
 
 
     def initialise(self):
@@ -77,17 +277,21 @@ class RPDeviceCollection:
             self.client.join()
 
         # Socket thread
-        self.client = rp.SocketClientThread(list(self.device_collection.keys()), self.triggered)
+        self.client = self._new_client(list(self.device_collection.keys()))
         # Start the socket thread
         self.client.start()
 
 
     def connect(self):
+        """ Connect the socket client to every device, all at once. Devices
+        that fail are tried again, after the backoff of the reconnect policy
+        if there is one. The time taken is recorded in the
+        rp_connect_seconds metric.
         """
-        """
+        t_start = time.perf_counter()
         if not self.client.alive.isSet():
             # Create new socket thread
-            self.client = rp.SocketClientThread(list(self.device_collection.keys()), self.triggered)
+            self.client = self._new_client(list(self.device_collection.keys()))
             # Start the socket thread
             self.client.start()
 
@@ -102,12 +306,15 @@ class RPDeviceCollection:
 
             if any(client_reply.key == 'ERROR' for client_reply in client_replies):
                 print('Trying to CONNECT again')
+                if self.reconnect is not None:
+                    time.sleep(self.reconnect.delay_s(i))
             elif all(client_reply.key == 'MESSAGE' for client_reply in client_replies):
                 break
             else:
                 # Don't know how to handle this: disconnect from all connected sockets, end the thread
                 self.disconnect()
                 raise OSError('Unknown error when attempting to CONENCT: exiting')
+        self.metrics.histogram('rp_connect_seconds').observe(time.perf_counter() - t_start)
 
         # # Check if we are connected by attempting to RECEIVE
         # self.client.cmd_q.put(rp.ClientCommand('RECEIVE'))
@@ -124,159 +331,644 @@ class RPDeviceCollection:
 
 
     def disconnect(self):
-        """
+        """ Close every socket and end the socket client. The client handles
+        CLOSE as soon as it is sent, so this takes about as long as the
+        frame being received; the time taken is recorded in the
+        rp_disconnect_seconds metric.
         """
         print('Trying to CLOSE socket connection')
+        t_start = time.perf_counter()
 
         if not self.client.alive.isSet():
             # There is no thread
             return
 
-        if all(connected == False for connected in self.client.connected):
-            # We aren't connected to any devices: end the thread
+        if all(connected == False for connected in self.client.connected) and not getattr(self.client, 'reconnecting', None):
+            # We aren't connected to any devices, or reconnecting them: end the thread
             self.client.join()
             return
 
         self.client.cmd_q.put(rp.ClientCommand('CLOSE'))
 
-        time.sleep(1)
-
-        # Get reply upon socket closure
+        # Get reply upon socket closure, skipping any DATA (or end of replay) still queued
         client_reply = self.client.reply_q.get()
+        while client_reply.key in ('DATA', 'END'):
+            self.client.release(client_reply)
+            client_reply = self.client.reply_q.get()
         print(client_reply.reply)
 
         # End the thread
         self.client.join()
+        self.metrics.histogram('rp_disconnect_seconds').observe(time.perf_counter() - t_start)
+
+
+    async def async_connect(self, timeout=5.):
+        """ Connect to all devices from the running event loop, as an
+        alternative to connect() and the socket thread.
+        """
+        self.async_client = rp.AsyncSocketClient(list(self.device_collection.keys()),
+                                                 [device.address_port for device in self.device_collection.values()],
+                                                 self.triggered, self.resolution_bits)
+        print('Trying to CONNECT to sockets')
+        await self.async_client.connect(timeout)
 
 
-    def acquire(self, acq_time_s, file_size=250e6, acquire_raw=False):
+    async def async_disconnect(self):
         """
         """
+        print('Trying to CLOSE socket connection')
+        if getattr(self, 'async_client', None) is not None:
+            await self.async_client.close()
+            self.async_client = None
+
+
+    def async_blocks(self, acq_time_s=None):
+        """ Asynchronous iterator over received blocks, after async_connect():
+
+            async for block in collection.async_blocks(acq_time_s):
+                ch1 = np.frombuffer(block[device_name + '_ch1'], dtype=collection.async_client.sample_dtype)
+
+        Each block has the same layout as a SocketClientThread DATA reply.
+        """
+        if getattr(self, 'async_client', None) is None:
+            raise OSError('Cannot acquire when not connected to any devices')
+        return self.async_client.blocks(acq_time_s)
+
+
+    def __aiter__(self):
+        return self.async_blocks()
+
+
+    def stream(self, acq_time_s=None, batch_samples=None, batch_time_s=None, calibrated=False, stages=()):
+        """ Iterator over StreamBlocks of numpy arrays, per device, as frames
+        arrive, for acq_time_s seconds (forever if None):
+
+            for block in collection.stream(10., batch_samples=2**20):
+                process(block.device_name, block.ch1, block.ch2)
+
+        Without batching, each block is one frame, whose arrays may view
+        receive buffers reused once the next block is requested: copy them to
+        keep them. With batch_samples or batch_time_s, blocks are gathered by
+        BlockBatcher into batches of that size. With calibrated, arrays are
+        in volts rather than raw ADC values, which are int8 or int16 by the
+        collection's resolution_bits.
+
+        Frame headers give each device's sample rate and frame sequence: the
+        stream then holds exactly acq_time_s worth of samples per device,
+        timestamps are those of the first sample of each block, and samples
+        lost by the device or by the reply queue are listed in block.losses.
+        Devices whose headers carry no sequence information are timed by
+        host clock instead. A device whose headers give a resolution other
+        than resolution_bits raises OSError.
+
+        Each block is also passed to the process() of each of stages (see
+        dsp.Stage), which are closed when the stream ends.
+
+        With a reconnect policy, a device lost during the stream is
+        reconnected while the others carry on. Its first block afterwards is
+        marked resumed, its samples placed by host time, and the samples
+        missed listed in its losses.
+
+        With engine 'replay', the stream replays the recording from its
+        start (see replay.py), and also ends when the recording does.
+        """
         if not self.client.alive.isSet():
-            # There is no thread
+            # There is no thread
             raise OSError('Cannot acquire when not connected to any devices')
 
-        if any(connected == False for connected in self.client.connected):
-            # We aren't connected to at least one device: disconnect from all connected sockets, end the thread
+        if any(connected == False for connected in self.client.connected) and not (self.reconnect is not None and self.client.started):
+            # We aren't connected to at least one device: disconnect from all connected sockets, end the thread
             self.disconnect()
             raise OSError('Cannot aquire unless connected to all devices: exiting')
 
         try:
-            assert(acq_time_s > 0)
+            assert(acq_time_s is None or acq_time_s > 0)
         except:
             raise TypeError('Invalid acquisition time value')
 
+        batcher = rp.BlockBatcher(batch_samples, batch_time_s) if batch_samples is not None or batch_time_s is not None else None
+
         # Clear the queue before beginning acquisition
-        self.client.reply_q.queue.clear()
+        t_stream = time.perf_counter()
+        self.client.clear_replies()
+        if self.engine == 'replay':
+            self.client.restart()
 
         t_start_ns = None
-
-        device_data_ch1 = {key: bytearray() for key in list(self.device_collection.keys())}
-        device_data_ch2 = {key: bytearray() for key in list(self.device_collection.keys())}
-        device_reads = {key: 0 for key in list(self.device_collection.keys())}
-        device_timestamps = {key: None for key in list(self.device_collection.keys())}
+        # Sample counting from frame headers: index gaps are expected in triggered mode, where untriggered frames are not sent
+        sample_size = self.client.sample_dtype.itemsize
+        samples_per_frame = self.client.channel_size // sample_size
+        clocks = {key: rp.SampleClock(samples_per_frame, count_gaps=not self.triggered) for key in list(self.device_collection.keys())}
+        device_done = {key: False for key in list(self.device_collection.keys())}
+        resumed = {key: False for key in list(self.device_collection.keys())}
+        conversion_metrics = {key: self.metrics.histogram('rp_conversion_seconds', device=key) for key in list(self.device_collection.keys())}
 
         # Loop to RECEIVE DATA, unless an ERROR occurs
-        while True:
-            # Get reply from reply queue
-            client_reply = self.client.reply_q.get()
+        client_reply = None
+        try:
+            while True:
+                # Get reply from reply queue
+                if self.reconnect is None:
+                    client_reply = self.client.reply_q.get()
+                else:
+                    # Devices may all be lost: stop on host time regardless
+                    try:
+                        client_reply = self.client.reply_q.get(timeout=0.5)
+                    except queue.Empty:
+                        if acq_time_s is not None and t_start_ns is not None and time.time_ns() - t_start_ns > ((acq_time_s + 2.) * 1e9):
+                            break
+                        continue
+
+                if client_reply.key == 'LOST':
+                    # The socket client is reconnecting the device: its next block resumes after a gap
+                    device_name, error = client_reply.reply
+                    print('Lost ' + device_name + ' (' + error + '): reconnecting')
+                    clocks[device_name].resume()
+                    resumed[device_name] = True
+                    client_reply = None
+                    continue
+
+                elif client_reply.key == 'MESSAGE':
+                    print(client_reply.reply)
+                    client_reply = None
+                    continue
+
+                elif client_reply.key == 'END':
+                    # A replay has no more data
+                    print(client_reply.reply)
+                    client_reply = None
+                    break
 
-            if client_reply.key == 'ERROR':
-                # Disconnect from all connected sockets, end the thread if we receive ERROR
-                print(client_reply.reply)
-                self.disconnect()
-                raise OSError('Error during RECEIVE: exiting')
+                elif client_reply.key == 'ERROR':
+                    # Disconnect from all connected sockets, end the thread if we receive ERROR
+                    print(client_reply.reply)
+                    client_reply = None
+                    self.disconnect()
+                    raise OSError('Error during RECEIVE: exiting')
+
+                elif client_reply.key != 'DATA':
+                    continue
 
-            elif client_reply.key == 'DATA':
-                # If we have DATA, exit if we have exceeded acquisition time
+                # If we have DATA, exit once every device has acquired for the acquisition time
                 t_ns = client_reply.reply['timestamp']
+                self.consumer_lag.observe((time.time_ns() - t_ns) / 1e9)
                 if t_start_ns is None:
                     t_start_ns = t_ns
-                if t_ns - t_start_ns > (acq_time_s * 1e9):
-                    for device_name, ch1_data in device_data_ch1.items():
-                        self.save_data(ch1_data, channel=1, acquire_raw=acquire_raw, t_file=device_timestamps[device_name], device=self.device_collection[device_name])
-                    if not self.triggered:
-                        for device_name, ch2_data in device_data_ch2.items():
-                            self.save_data(ch2_data, channel=2, acquire_raw=acquire_raw, t_file=device_timestamps[device_name], device=self.device_collection[device_name])
-                    break
+                    self.metrics.histogram('rp_start_seconds').observe(time.perf_counter() - t_stream)
+                if acq_time_s is not None:
+                    for device_name, clock in clocks.items():
+                        # Devices without sample counting are done on host time
+                        if not clock.valid and t_ns - t_start_ns > (acq_time_s * 1e9):
+                            device_done[device_name] = True
+                    # Stop on host time regardless if a device stops sending
+                    if all(device_done.values()) or t_ns - t_start_ns > ((acq_time_s + 2.) * 1e9):
+                        break
+
+                blocks = []
+                for device_name in client_reply.reply['replied_devices']:
+                    if device_done[device_name]:
+                        continue
+                    ch1_bytes = client_reply.reply[device_name + '_ch1']
+                    ch2_bytes = client_reply.reply[device_name + '_ch2'] if not self.triggered else None
+                    timestamp = t_ns
+
+                    header = client_reply.reply[device_name + '_header']
+                    if rp.header_valid(header) and header['resolution'] and header['resolution'] != self.resolution_bits:
+                        # Samples would be misread: disconnect from all connected sockets, end the thread
+                        self.client.release(client_reply)
+                        client_reply = None
+                        self.disconnect()
+                        raise OSError(device_name + ' streams ' + str(header['resolution']) + '-bit samples, not '
+                                      + str(self.resolution_bits) + '-bit: exiting')
+
+                    clock = clocks[device_name]
+                    sample = clock.update(header, t_ns)
+                    if sample is not None:
+                        # Sample number of the first sample of the block: triggered blocks start part way through the frame
+                        n_block = len(ch1_bytes) // sample_size
+                        sample += samples_per_frame - n_block
+                        keep = n_block
+                        if acq_time_s is not None:
+                            n_target = round(acq_time_s * clock.rate)
+                            keep = min(n_block, max(0, n_target - sample))
+                            if sample + keep >= n_target:
+                                device_done[device_name] = True
+                        if keep == 0:
+                            continue
+                        if keep < n_block:
+                            ch1_bytes = ch1_bytes[:sample_size * keep]
+                            if ch2_bytes is not None:
+                                ch2_bytes = ch2_bytes[:sample_size * keep]
+                        timestamp = clock.time_ns(sample)
+
+                    device = self.device_collection[device_name]
+                    ch1 = np.frombuffer(ch1_bytes, dtype=self.client.sample_dtype)
+                    ch2 = np.frombuffer(ch2_bytes, dtype=self.client.sample_dtype) if ch2_bytes is not None else None
+                    if calibrated:
+                        t_convert = time.perf_counter()
+                        ch1 = device.adc_to_volts(ch1, 1)
+                        ch2 = device.adc_to_volts(ch2, 2) if ch2 is not None else None
+                        conversion_metrics[device_name].observe(time.perf_counter() - t_convert)
+                    block = rp.StreamBlock(device_name, ch1, ch2, sample, clock.rate if clock.valid else None, timestamp, clock.losses,
+                                           resumed[device_name])
+                    clock.losses = []
+                    resumed[device_name] = False
+                    blocks.extend(batcher.add(block) if batcher is not None else [block])
+
+                for block in blocks:
+                    for stage in stages:
+                        stage.process(block)
+                    yield block
+
+                # Blocks have been consumed or copied: return any pooled receive buffers
+                self.client.release(client_reply)
+                client_reply = None
+
+            if batcher is not None:
+                for block in batcher.flush():
+                    for stage in stages:
+                        stage.process(block)
+                    yield block
+
+        finally:
+            if client_reply is not None:
+                self.client.release(client_reply)
+            for stage in stages:
+                stage.close()
+
+        for device_name, clock in clocks.items():
+            if clock.valid and clock.lost_samples:
+                print('Lost ' + str(clock.lost_samples) + ' samples for ' + device_name)
+
+        counters = self.client.reply_q.counters()
+        if counters['dropped'] or counters['spilled']:
+            print('Reply queue overflow: dropped frames ' + str(counters['dropped']) + ', spilled frames ' + str(counters['spilled']))
+
+
+    def acquire(self, acq_time_s, file_size=250e6, acquire_raw=False, writer_threads=1, writer_queue=2, output='buffer',
+                data_format=None, catalog=None, stages=(), writer_processes=0, compression=None):
+        """ Write the blocks of stream(acq_time_s) to segment files of up to
+        file_size bytes per device and channel.
+
+        With output='buffer', segments accumulate in memory. With
+        writer_threads > 0, full segments are then saved by a background
+        SegmentWriter (self.writer) while acquisition fills a spare buffer;
+        with writer_threads=0 they are saved inline. With writer_processes > 0,
+        segments are instead held in shared memory and converted and written
+        by a ProcessSegmentWriter of that many worker processes, with up to
+        writer_queue segments in flight, so that conversion of many devices'
+        segments uses as many cores.
+
+        With output='memmap', each block is written straight into a
+        preallocated MemmapSegment file, so memory use does not grow with
+        file_size. With output='container', blocks are written in chunks to
+        self-describing container files (.rps, see container.py), with their
+        sample numbers, timestamps and calibration. With output=None, no raw
+        data is saved: only stages (see stream) process the stream.
+
+        data_format is one of DATA_FORMATS: raw ADC values ('int8' or
+        'int16', no narrower than resolution_bits), volts ('float16' or
+        'float32'), or raw ADC values with calibration metadata for load_data
+        to convert on reading ('lazy'). Only raw formats keep the ADC values
+        exactly: volts are rounded to their dtype, and float16 does not
+        resolve every 16-bit ADC value. By default, it is raw ADC values as
+        streamed with acquire_raw, and utils.DTYPE otherwise. Segments are of
+        up to file_size bytes of raw ADC values, so 8-bit segments hold twice
+        the samples.
+
+        With compression (a codec name such as 'zlib', 'lzma:6' or 'bz2', or
+        a Compressor), segments are saved as container files with chunks
+        compressed losslessly in data_format (see compression.py), with
+        output='buffer' by the writer, or with output='container' as they
+        fill.
+
+        With catalog (a filename, e.g. 'red_pitaya_catalog.sqlite'), the
+        run, and each segment file once written, are recorded in that
+        RunCatalog, to find segments by device and time.
+
+        File timestamps are those of the first sample of each segment. Where
+        frame headers carry sequence information, the samples lost during a
+        segment are listed in red_pitaya_losses_<device>_<timestamp>.txt, if
+        any were.
+        A device reconnected after being lost (see stream) starts a new
+        segment, whose losses begin with the gap.
+
+        If acquisition is interrupted (e.g. by KeyboardInterrupt) or fails,
+        segments already handed to the writer are still written, and the
+        segment files being filled (output 'memmap' or 'container') are kept
+        with the samples they hold; samples in buffers not yet saved are lost.
+        """
+        try:
+            assert(acq_time_s > 0)
+        except:
+            raise TypeError('Invalid acquisition time value')
 
-                # If this is the first read for any device, save the timestamp for that device
-                for device_name, reads in device_reads.items():
-                    if reads == 0:
-                        device_timestamps[device_name] = t_ns
+        try:
+            assert output in ('buffer', 'memmap', 'container', None)
+        except:
+            raise ValueError("output must be 'buffer', 'memmap', 'container' or None")
 
-                for device_name in client_reply.reply['replied_devices']:
-                    device_data_ch1[device_name] += client_reply.reply[device_name + '_ch1']
+        if data_format is None:
+            data_format = rp.sample_dtype(self.resolution_bits).name if acquire_raw else np.dtype(rp.dtype()).name
+        rp.data_format_dtype(data_format, self.resolution_bits)
+
+        try:
+            assert compression is None or output in ('buffer', 'container')
+        except:
+            raise ValueError("compression needs output 'buffer' or 'container'")
+        self.compressor = rp.compressor(compression)
+
+        # Segments are saved once reads * channel_size exceeds file_size: preallocate that many blocks
+        segment_capacity = (int(file_size // self.client.channel_size) + 1) * self.client.channel_size
+        if output != 'buffer':
+            # Segment files are opened on the first block of each segment
+            device_data_ch1 = {key: None for key in list(self.device_collection.keys())}
+            device_data_ch2 = {key: None for key in list(self.device_collection.keys())}
+            writer_threads = 0
+            writer_processes = 0
+        # Segment buffers in shared memory, for worker processes, are freed at the end
+        shared_buffers = []
+        def new_buffer(capacity):
+            if writer_processes <= 0:
+                return SegmentBuffer(capacity)
+            shared_buffers.append(rp.SharedSegmentBuffer(capacity))
+            return shared_buffers[-1]
+        if output == 'buffer':
+            device_data_ch1 = {key: new_buffer(segment_capacity) for key in list(self.device_collection.keys())}
+            device_data_ch2 = {key: new_buffer(segment_capacity if not self.triggered else 0) for key in list(self.device_collection.keys())}
+
+        # Background writer, with a spare buffer per channel to fill while the previous segment is written
+        if writer_processes > 0:
+            self.writer = rp.ProcessSegmentWriter(writer_processes, writer_queue, self.metrics)
+        else:
+            self.writer = rp.SegmentWriter(self.save_data, writer_threads, writer_queue, self.metrics) if writer_threads > 0 else None
+        spares_ch1 = {key: queue.Queue() for key in list(self.device_collection.keys())}
+        spares_ch2 = {key: queue.Queue() for key in list(self.device_collection.keys())}
+        if self.writer is not None:
+            for key in list(self.device_collection.keys()):
+                spares_ch1[key].put(new_buffer(segment_capacity))
+                if not self.triggered:
+                    spares_ch2[key].put(new_buffer(segment_capacity))
+        device_reads = {key: 0 for key in list(self.device_collection.keys())}
+        device_timestamps = {key: None for key in list(self.device_collection.keys())}
+        # Losses during the current segment, if the device's frame headers give them
+        device_losses = {key: None for key in list(self.device_collection.keys())}
+        # End time and sample rate of the current segment, for the catalog
+        device_t_end = {key: None for key in list(self.device_collection.keys())}
+        device_rates = {key: None for key in list(self.device_collection.keys())}
+        # Conversion into segment files, and segment rotations
+        conversion_metrics = {key: self.metrics.histogram('rp_conversion_seconds', device=key) for key in list(self.device_collection.keys())}
+        rotation_metrics = {key: self.metrics.counter('rp_segments_rotated', device=key) for key in list(self.device_collection.keys())}
+
+        self.catalog = rp.RunCatalog(catalog) if catalog is not None else None
+        if self.catalog is not None:
+            self.catalog_run_id = self.catalog.add_run(time.time_ns(), acq_time_s, list(self.device_collection.keys()), data_format, output)
+
+        def end_segment(device_name):
+            info = self._segment_info(device_losses[device_name], device_t_end[device_name], device_rates[device_name])
+            self._save_segment(device_data_ch1, spares_ch1, device_name, 1, data_format, device_timestamps[device_name], info)
+            self._save_losses(device_losses, device_name, device_timestamps[device_name])
+            if not self.triggered:
+                self._save_segment(device_data_ch2, spares_ch2, device_name, 2, data_format, device_timestamps[device_name], info)
+
+        blocks = self.stream(acq_time_s, stages=stages)
+        try:
+            for block in blocks:
+                if output is None:
+                    continue
+                device_name = block.device_name
+                if block.resumed and device_reads[device_name] > 0:
+                    # The device was reconnected: end the segment before the gap
+                    end_segment(device_name)
+                    device_reads[device_name] = 0
+                    rotation_metrics[device_name].inc()
+                # If this is the first read for the segment, save the timestamp of its first sample
+                if device_reads[device_name] == 0:
+                    device_timestamps[device_name] = block.timestamp
+                if block.sample is not None:
+                    device_losses[device_name] = (device_losses[device_name] or []) + block.losses
+                device_t_end[device_name] = block.timestamp + ((len(block) * 1000000000) // block.rate if block.rate else 0)
+                device_rates[device_name] = block.rate
+
+                if output != 'buffer' and device_data_ch1[device_name] is None:
+                    device_data_ch1[device_name] = self._open_segment(device_name, 1, data_format, device_timestamps[device_name],
+                                                                      segment_capacity, output, block.rate)
+                    if not self.triggered:
+                        device_data_ch2[device_name] = self._open_segment(device_name, 2, data_format, device_timestamps[device_name],
+                                                                          segment_capacity, output, block.rate)
+                t_append = time.perf_counter()
+                if output == 'container':
+                    device_data_ch1[device_name].append(block.ch1, block.sample, block.timestamp)
+                    if not self.triggered:
+                        device_data_ch2[device_name].append(block.ch2, block.sample, block.timestamp)
+                else:
+                    device_data_ch1[device_name].append(block.ch1)
                     if not self.triggered:
-                        device_data_ch2[device_name] += client_reply.reply[device_name + '_ch2']
-                    device_reads[device_name] += 1
-
-                for device_name, reads in device_reads.items():
-                    if (reads * self.client.channel_size > file_size):
-                        self.save_data(device_data_ch1[device_name], channel=1, acquire_raw=acquire_raw, t_file=device_timestamps[device_name], device=self.device_collection[device_name])
-                        device_data_ch1[device_name] = bytearray()
-                        if not self.triggered:
-                            self.save_data(device_data_ch2[device_name], channel=2, acquire_raw=acquire_raw, t_file=device_timestamps[device_name], device=self.device_collection[device_name])
-                            device_data_ch2[device_name] = bytearray()
-                        device_reads[device_name] = 0
-
-
-    # def acquire_calib(self, acquire_raw=False):
-    #     """
-    #     """
-    #     if not self.client.alive.isSet():
-    #         # There is no thread
-    #         raise OSError('Cannot calibrate when not connected to device')
-    #
-    #     if not self.client.connected:
-    #         # We aren't connected: end the thread
-    #         self.client.join()
-    #         raise OSError('Cannot calibrate when not connected to device')
-    #
-    #     # Get reply from reply queue to obtain start time
-    #     client_reply = self.client.reply_q.get()
-    #
-    #     if client_reply.key == 'ERROR':
-    #         # End the thread if we receive ERROR
-    #         print(client_reply.reply)
-    #         self.client.join()
-    #         raise OSError('Error during RECEIVE: exiting')
-    #
-    #     elif client_reply.key == 'DATA':
-    #         # If we have DATA, get the start acquisition time
-    #         t_start_ns = client_reply.reply['timestamp']
-    #
-    #     ch1_data = bytearray()
-    #     ch2_data = bytearray()
-    #
-    #     # Loop to RECEIVE DATA, unless an ERROR occurs
-    #     while True:
-    #         # Get reply from reply queue
-    #         client_reply = self.client.reply_q.get()
-    #
-    #         if client_reply.key == 'ERROR':
-    #             # End the thread if we receive ERROR
-    #             print(client_reply.reply)
-    #             self.client.join()
-    #             raise OSError('Error during RECEIVE: exiting')
-    #
-    #         elif client_reply.key == 'DATA':
-    #             # If we have DATA, exit if we have exceeded acquisition time
-    #             t_ns = client_reply.reply['timestamp']
-    #             if t_ns - t_start_ns > 1e9: # Acquire for 1 second
-    #                 break
-    #
-    #             # Otherwise, append data
-    #             ch1_data += client_reply.reply['ch1_data']
-    #             ch2_data += client_reply.reply['ch2_data']
-    #
-    #     self.save_data(ch1_data, channel=1, calib=True, acquire_raw=acquire_raw)
-    #     self.save_data(ch2_data, channel=2, calib=True, acquire_raw=acquire_raw)
-    #
-    #
-    def save_data(self, data_bytes, channel=1, calib=False, acquire_raw=False, t_file=None, device=None):
+                        device_data_ch2[device_name].append(block.ch2)
+                if output != 'buffer':
+                    # Blocks are converted into segment files as they are appended
+                    conversion_metrics[device_name].observe(time.perf_counter() - t_append)
+                device_reads[device_name] += 1
+
+                if (device_reads[device_name] * self.client.channel_size > file_size):
+                    end_segment(device_name)
+                    device_reads[device_name] = 0
+                    rotation_metrics[device_name].inc()
+
+            for device_name in device_data_ch1:
+                if device_reads[device_name] > 0:
+                    # Not yet saved by a rotation on the last block
+                    end_segment(device_name)
+
+        finally:
+            # However acquisition ends (also on KeyboardInterrupt, or an error converting or writing), segments already
+            # handed to the writer are written, shared memory is freed, and what is in open segment files is kept
+            blocks.close()
+            try:
+                if self.writer is not None:
+                    # Wait for the last segments to be written
+                    self.writer.close()
+            finally:
+                for buffer in shared_buffers:
+                    buffer.close()
+                for device_name, segment in device_data_ch1.items():
+                    if isinstance(segment, (rp.MemmapSegment, rp.ContainerWriter)):
+                        end_segment(device_name)
+                if self.catalog is not None:
+                    self.catalog.close()
+
+        if self.writer is not None:
+            stats = self.writer.stats()
+            print('Wrote ' + str(stats['segments_written']) + ' segments: mean write ' + f"{stats['mean_write_s']:.3f}"
+                  + ' s, max latency ' + f"{stats['max_latency_s']:.3f}" + ' s, max queue depth ' + str(stats['max_queue_depth']))
+
+
+    def acquire_events(self, acq_time_s, pre_samples=1024, post_samples=3072, threshold=None, hysteresis=0, holdoff_samples=0,
+                       rising=True, trigger_channel=2, record_channels=(1,)):
+        """ Build events from stream(acq_time_s) with an EventBuilder (see
+        there for the parameters), writing for each device:
+
+            red_pitaya_events_<device>_<timestamp>.bin  fixed-length raw ADC
+                records (int8 or int16, by resolution) of shape
+                (len(record_channels), pre_samples + post_samples)
+            red_pitaya_events_<device>_<timestamp>.txt  the event index: one row
+                of event number, trigger sample number and timestamp per record
+
+        Events are written as they complete, with the timestamp of each
+        device's first block in the file names. Event building needs the
+        pre-trigger samples that triggered mode discards, so the collection
+        must be untriggered. threshold is in raw ADC values, by default
+        30000 at 16 bits, or the same level at resolution_bits.
+        """
+        if self.triggered:
+            raise ValueError('Event building needs the untriggered stream: create the collection with triggered=False')
+
+        if threshold is None:
+            threshold = 30000 >> (16 - self.resolution_bits)
+
+        builder = rp.EventBuilder(pre_samples, post_samples, threshold, hysteresis, holdoff_samples, rising,
+                                  trigger_channel, record_channels)
+        record_files = {}
+        index_files = {}
+        try:
+            for block in self.stream(acq_time_s):
+                device_name = block.device_name
+                if device_name not in record_files:
+                    name = 'red_pitaya_events_' + device_name + '_' + str(block.timestamp)
+                    record_files[device_name] = open(name + '.bin', 'wb')
+                    index_files[device_name] = open(name + '.txt', 'w')
+                    index_files[device_name].write('# event sample timestamp_ns\n')
+
+                events = builder.add(block)
+                # Events are numbered from 0 for each device
+                first = builder.recorded[device_name] - len(events)
+                for i, event in enumerate(events):
+                    event.record.tofile(record_files[device_name])
+                    index_files[device_name].write(f'{first + i} {event.sample} {event.timestamp}\n')
+            builder.flush()
+        finally:
+            for file in list(record_files.values()) + list(index_files.values()):
+                file.close()
+
+        for device_name in builder.recorded:
+            print(device_name + ': ' + str(builder.recorded[device_name]) + ' events, ' + str(builder.incomplete[device_name]) + ' incomplete')
+        return builder
+
+
+    def _segment_info(self, losses, t_end_ns, rate):
+        """ Catalog information about a segment not given by its file.
         """
+        return {'t_end_ns': t_end_ns, 'rate': rate, 'lost_samples': None if losses is None else int(sum(loss[2] for loss in losses))}
+
+
+    def _save_segment(self, device_data, spares, device_name, channel, data_format, t_file, info=None):
+        """ Save the segment in device_data[device_name]. With a background
+        writer, the full buffer is handed over and replaced by a spare, which
+        blocks only if the writer is still busy with every spare. Segment
+        files are finalized, and the next opened on its first block. Each
+        file is recorded in the catalog once written.
         """
+        segment = device_data[device_name]
+        if segment is None:
+            # No blocks for this segment file
+            return
+        if isinstance(segment, (rp.MemmapSegment, rp.ContainerWriter)):
+            segment.finalize()
+            device_data[device_name] = None
+            self._catalog_segment(segment.filename, segment.size if isinstance(segment, rp.MemmapSegment) else segment.n_samples,
+                                  device_name, channel, data_format, t_file, info)
+            return
+
+        filename = self._segment_filename(device_name, channel, t_file, 'rps' if self.compressor is not None else 'bin')
+        n_samples = segment.size // self.device_collection[device_name].sample_dtype.itemsize
+        rate = (info or {}).get('rate')
+        if self.writer is None:
+            t_write = time.perf_counter()
+            self.save_data(segment.contents(), channel=channel, t_file=t_file, device=self.device_collection[device_name], data_format=data_format,
+                           compression=self.compressor, rate=rate)
+            self.inline_write_metrics.record(segment.size, time.perf_counter() - t_write)
+            segment.clear()
+            self._catalog_segment(filename, n_samples, device_name, channel, data_format, t_file, info)
+            return
+
+        def on_done():
+            segment.clear()
+            spares[device_name].put(segment)
+            self._catalog_segment(filename, n_samples, device_name, channel, data_format, t_file, info)
+
+        if isinstance(self.writer, rp.ProcessSegmentWriter):
+            device = self.device_collection[device_name]
+            self.writer.submit(segment, on_done=on_done, filename=filename, data_format=data_format,
+                               converter=device.converter(channel, rp.data_format_dtype(data_format, device.input_bits)),
+                               compression=self.compressor, device_name=device_name, channel=channel, rate=rate, t_file=t_file)
+        else:
+            self.writer.submit(segment.contents(), on_done=on_done, channel=channel, t_file=t_file,
+                               device=self.device_collection[device_name], data_format=data_format,
+                               compression=self.compressor, rate=rate)
+        device_data[device_name] = spares[device_name].get()
+
+
+    def _save_losses(self, device_losses, device_name, t_file):
+        """ Save the samples lost during the segment beginning at t_file, one
+        row of frame index, sample number and samples lost per loss, if any.
+        """
+        losses = device_losses[device_name]
+        device_losses[device_name] = None
+        if not losses:
+            # No sequence information, no blocks for this segment, or nothing lost
+            return
+        filename = 'red_pitaya_losses_' + device_name + '_' + str(t_file) + '.txt'
+        np.savetxt(filename, np.array(losses, dtype=np.uint64).reshape(-1, 3), fmt='%d',
+                   header='frame_index sample lost_samples')
+
+
+    def _catalog_segment(self, filename, n_samples, device_name, channel, data_format, t_file, info):
+        if self.catalog is None:
+            return
+        info = info or {}
+        dtype = rp.data_format_dtype(data_format, self.device_collection[device_name].input_bits)
+        self.catalog.add_segment(self.catalog_run_id, device_name, channel, filename, t_file,
+                                 info.get('t_end_ns') if info.get('t_end_ns') is not None else t_file,
+                                 n_samples, dtype.name, data_format, info.get('rate'), info.get('lost_samples'))
+
+
+    def _segment_filename(self, device_name, channel, t_file, extension='bin'):
+        return f'red_pitaya_data_ch{channel}_{device_name}_{t_file}.{extension}'
+
+
+    def _open_segment(self, device_name, channel, data_format, t_file, segment_capacity, output='memmap', rate=None):
+        """ Open a segment file for one channel: a container file, or a
+        preallocated file with the same name and contents save_data would
+        give it.
+        """
+        device = self.device_collection[device_name]
+        dtype = rp.data_format_dtype(data_format, device.input_bits)
+        converter = device.converter(channel, dtype)
+        if output == 'container':
+            return rp.ContainerWriter(self._segment_filename(device_name, channel, t_file, 'rps'), device.name, channel,
+                                      converter, data_format, rate, t_file, compressor=self.compressor)
+
+        filename = self._segment_filename(device_name, channel, t_file)
+        if data_format == 'lazy':
+            rp.save_calibration(filename, device.converter(channel))
+        return rp.MemmapSegment(filename, segment_capacity // device.sample_dtype.itemsize, dtype,
+                                convert=None if dtype == device.sample_dtype else converter.convert, sample_dtype=device.sample_dtype)
+
+
+    def save_data(self, data_bytes, channel=1, calib=False, acquire_raw=False, t_file=None, device=None, data_format=None,
+                  compression=None, rate=None):
+        """ Save raw ADC data_bytes from channel of device, in data_format
+        (see acquire), converting chunk by chunk as it is written. With
+        compression, they are saved to a compressed container file (.rps)
+        with sample rate rate.
+
+        calib is deprecated, and ignored: calibration data is no longer
+        saved, but measured from the stream (see calibration.py).
+        """
+        if calib:
+            warnings.warn('save_data(calib=True) is deprecated and does nothing: calibrate with rp.Calibrator',
+                          DeprecationWarning, stacklevel=2)
+
         try:
             assert(device is not None)
         except:
@@ -287,25 +979,16 @@ class RPDeviceCollection:
         except:
             raise ValueError('channel must be 1 or 2')
 
-        data = np.frombuffer(data_bytes, dtype=np.int16)
+        if data_format is None:
+            data_format = device.sample_dtype.name if acquire_raw else np.dtype(rp.dtype()).name
+        dtype = rp.data_format_dtype(data_format, device.input_bits)
 
-        if not acquire_raw:
-        # Convert from ADC -> V, with calibration factors, by default
-            if channel == 1:
-                data = np.float16(device.ch1_gain * (data * device.input_range_V / 2. ** device.input_bits + device.ch1_offset))
-            elif channel == 2:
-                data = np.float16(device.ch2_gain * (data * device.input_range_V / 2. ** device.input_bits + device.ch2_offset))
+        data = np.frombuffer(data_bytes, dtype=device.sample_dtype)
 
-        if calib:
-        # Save calibration data to files
-            if channel == 1:
-                np.savetxt('red_pitaya_data_ch1_calib.txt', data)
-            elif channel == 2:
-                np.savetxt('red_pitaya_data_ch2_calib.txt', data)
-        else:
-        # Save acquired data to files
-            try:
-                assert(t_file is not None)
-            except:
-                raise ValueError('Must supply timestamp when saving data outside of calibration mode')
-            data.tofile(f'red_pitaya_data_ch{channel}_{device.name}_{t_file}.bin')
+        try:
+            assert(t_file is not None)
+        except:
+            raise ValueError('Must supply timestamp when saving data')
+        # Convert from ADC -> V, with calibration factors, a chunk at a time
+        filename = self._segment_filename(device.name, channel, t_file, 'rps' if compression is not None else 'bin')
+        rp.save_segment(data, filename, device.converter(channel, dtype), data_format, compression, device.name, channel, rate, t_file)
@@ -0,0 +1,326 @@
+"""
+02/22, R James, F Alder
+"""
+
+import collections
+import socket
+import threading
+import multiprocessing
+import queue
+import select
+import time
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+def _read_device(device_name, address_port, triggered, trigger_value, header_size, channel_size, sample_dtype, frame_q, stop,
+                 connect_timeout_s=5.):
+    """ Reader worker for a single device, run in its own thread or process.
+    Connects, giving up after connect_timeout_s, then puts ('DATA', device_name, header,
+    ch1, ch2, t_ns) items on frame_q until stop (the read end of a pipe) becomes
+    readable, blocking while frame_q is full. Connection status and errors are
+    reported as ('MESSAGE' / 'ERROR', device_name, string) items.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(connect_timeout_s)
+    try:
+        sock.connect(address_port)
+    except OSError as e:
+        frame_q.put(('ERROR', device_name, str(e) + '. Problem device: ' + device_name))
+        sock.close()
+        return
+    sock.settimeout(None)
+    frame_q.put(('MESSAGE', device_name, 'Socket for ' + device_name + ' connected'))
+
+    frame_size = header_size + 2 * channel_size
+    try:
+        while not stop.poll():
+            # Wait on stop too, so that it is seen at once even if the device stalls
+            readable, _, _ = select.select([sock, stop], [], [])
+            if sock not in readable:
+                continue
+
+            # Receive the whole frame in one buffer, then split without copying
+            frame = bytearray(frame_size)
+            view = memoryview(frame)
+            n_read = 0
+            while n_read < frame_size:
+                n_packet = sock.recv_into(view[n_read:], frame_size - n_read)
+                if not n_packet:
+                    raise OSError('Empty packet from socket.recv_into()')
+                n_read += n_packet
+            t_ns = time.time_ns()
+
+            header = rp.parse_header(view[:header_size])
+            ch1_bytes = view[header_size:header_size + channel_size]
+            ch2_bytes = view[header_size + channel_size:]
+
+            if not triggered:
+                frame_q.put(('DATA', device_name, header, ch1_bytes, ch2_bytes, t_ns))
+                continue
+
+            start = rp.trigger_start(ch2_bytes, trigger_value, sample_dtype)
+            if start is not None:
+                # Save everything on channel 1 since the first point the threshold was exceeded
+                frame_q.put(('DATA', device_name, header, ch1_bytes[sample_dtype.itemsize * start::], None, t_ns))
+
+    except OSError as e:
+        frame_q.put(('ERROR', device_name, str(e) + '. Problem device: ' + device_name))
+    finally:
+        sock.close()
+
+
+def _read_device_process(device_name, address_port, triggered, trigger_value, header_size, channel_size, sample_dtype, frame_q, stop,
+                         connect_timeout_s=5.):
+    """ Process entry point: memoryviews cannot be pickled, so frames are sent as bytes.
+    """
+    class _BytesQueue:
+        def put(self, item):
+            frame_q.put(tuple(bytes(x) if isinstance(x, memoryview) else x for x in item))
+
+    _read_device(device_name, address_port, triggered, trigger_value, header_size, channel_size, sample_dtype, _BytesQueue(), stop,
+                 connect_timeout_s)
+
+
+
+@export
+class ParallelSocketClient(threading.Thread):
+    """ Drop-in alternative to SocketClientThread in which each device is read
+        by its own worker (a thread, or a process if processes=True), so one
+        slow device does not stall the others. The workers feed a shared
+        frame queue; this thread collects frames into the same DATA replies
+        as SocketClientThread, so RPDeviceCollection.acquire is unchanged.
+        Each reply holds at most one frame per device. The frame queue holds
+        at most max_queued frames per device, so workers wait for the
+        collector rather than get arbitrarily far ahead of it, and the reply
+        queue's size and overflow policy bound memory. Workers give up
+        connecting after connect_timeout_s. Frames and bytes received are
+        recorded in metrics (by default rp.metrics()). Samples are of
+        resolution_bits bits, as SocketClientThread.
+    """
+    def __init__(self, device_names, triggered=False, processes=False, reply_q_size=0, overflow='block', spill_dir=None,
+                 metrics=None, resolution_bits=16, max_queued=64, connect_timeout_s=5.):
+        super(ParallelSocketClient, self).__init__()
+
+        # Command and reply queues for communicating with the collector thread: commands wake it from waiting for frames
+        self.cmd_q = rp.CommandQueue()
+        self.reply_q = rp.BoundedReplyQueue(reply_q_size, overflow, spill_dir)
+        # Thread run control
+        self.alive = threading.Event()
+        self.alive.set()
+        # Reader worker attributes
+        self.processes = processes
+        frame_q_size = max_queued * len(device_names)
+        self.frame_q = multiprocessing.Queue(frame_q_size) if processes else queue.Queue(frame_q_size)
+        self.cmd_q.on_put = self._wake
+        self.connect_timeout_s = connect_timeout_s
+        # Workers stop once the pipe has data, which they wait on with their sockets
+        self.stop, self.stop_w = multiprocessing.Pipe(duplex=False)
+        self.workers = {}
+        self.connected = [False] * len(device_names)
+        self.device_names = device_names
+        # Items taken off frame_q to be handled before it: a frame held back for the next reply, when a device
+        # already has a frame in the current one, and frames received while connecting
+        self.pending = collections.deque()
+        # Buffer reading attributes
+        self.header_size = 60
+        self.channel_size = 32768
+        self.sample_dtype = rp.sample_dtype(resolution_bits)
+        # Triggered or untriggered mode
+        self.triggered = triggered
+        # Triggering value for channel 2 for triggered mode (raw ADC counts, 30000 at 16 bits)
+        self.trigger_value = 30000 >> (16 - resolution_bits)
+        # Metrics
+        self.metrics = rp.metrics() if metrics is None else metrics
+        self.receive_metrics = {device_name: rp.ReceiveMetrics(self.metrics, device_name) for device_name in device_names}
+        # Thread control handlers
+        self.handlers = {
+            'CONNECT': self._handle_CONNECT,
+            'CLOSE': self._handle_CLOSE
+        }
+
+        print('Starting ' + ('process' if processes else 'thread') + ' readers with ' + str(len(device_names)) + ' devices')
+
+
+    def run(self):
+        """ Thread control function. Waiting for frames is interrupted by
+        commands, so they are handled as soon as they are sent.
+        """
+        while self.alive.isSet():
+            if all(self.connected) and self.connected:
+                self._collect()
+            else:
+                # Don't do anything until a command is sent if all devices not connected
+                select.select([self.cmd_q], [], [])
+            # Commands last, so that the end of the thread is seen before waiting again
+            self._handle_commands()
+        self.cmd_q.close()
+
+
+    def _wake(self):
+        """ Wake the collector to handle a command. A full frame queue needs
+        no wakeup, as the collector does not wait on it, and blocking here
+        could deadlock with a collector waiting on the reply queue.
+        """
+        try:
+            self.frame_q.put_nowait(('WAKE',))
+        except queue.Full:
+            pass
+
+
+    def _handle_commands(self):
+        """ Handle every command sent to the thread.
+        """
+        self.cmd_q.clear_wakeups()
+        while True:
+            try:
+                command = self.cmd_q.get(block=False)
+            except queue.Empty:
+                return
+            if command is not None:
+                self.metrics.histogram('rp_command_seconds', command=command.key).observe(time.perf_counter() - command.t_sent)
+                self.handlers[command.key](command)
+
+
+    def join(self, timeout=None):
+        """ Invoking this will end the thread, and any reader workers.
+        """
+        print('Ending ' + ('process' if self.processes else 'thread') + ' readers with ' + str(len(self.device_names)) + ' devices')
+
+        self.alive.clear()
+        # Wake the thread to see that it should end
+        self.cmd_q.put(None)
+        threading.Thread.join(self, timeout)
+        self._stop_workers()
+
+
+    def _handle_CONNECT(self, client_command):
+        """ Start a reader worker for each device not already connected.
+        client_command should be an array of (host, port) tuples.
+        """
+        try:
+            assert len(self.device_names) == len(self.connected) == len(client_command.command)
+        except:
+            raise ValueError('All arguments must be of the same length')
+
+        starting = set()
+        for i, device_name in enumerate(self.device_names):
+            if self.connected[i]:
+                # We are already connected, do nothing
+                self.reply_q.put(rp.ClientReply('MESSAGE', 'Socket for ' + device_name + ' already connected'))
+                continue
+            args = (device_name, tuple(client_command.command[i]), self.triggered, self.trigger_value,
+                    self.header_size, self.channel_size, self.sample_dtype, self.frame_q, self.stop, self.connect_timeout_s)
+            if self.processes:
+                worker = multiprocessing.Process(target=_read_device_process, args=args, daemon=True)
+            else:
+                worker = threading.Thread(target=_read_device, args=args, daemon=True)
+            worker.start()
+            self.workers[device_name] = worker
+            starting.add(device_name)
+
+        # Each worker reports whether it connected before sending any data: frames from
+        # devices already connected are held, rather than put back on a queue that may be full
+        while starting:
+            item = self.frame_q.get()
+            if item[0] == 'WAKE':
+                continue
+            if item[0] == 'DATA':
+                self.pending.append(item)
+                continue
+            starting.discard(item[1])
+            self.connected[self.device_names.index(item[1])] = (item[0] == 'MESSAGE')
+            self.reply_q.put(rp.ClientReply(item[0], item[2]))
+
+
+    def _collect(self):
+        """ Gather frames from the workers into a single DATA reply.
+        """
+        reply = {}
+        replied = []
+        t_ns = None
+
+        try:
+            item = self.pending.popleft() if self.pending else self.frame_q.get()
+            while True:
+                if item[0] == 'WAKE':
+                    # A command was sent: reply with what has been collected so far
+                    break
+                if item[0] == 'ERROR':
+                    self.connected[self.device_names.index(item[1])] = False
+                    self.reply_q.put(rp.ClientReply('ERROR', item[2]))
+                elif item[0] == 'DATA':
+                    _, device_name, header, ch1_bytes, ch2_bytes, t_ns_frame = item
+                    if device_name in replied:
+                        # Second frame from this device: hold it for the next reply
+                        self.pending.appendleft(item)
+                        break
+                    replied.append(device_name)
+                    self.receive_metrics[device_name].record(self.header_size + 2 * self.channel_size)
+                    reply.update({device_name + '_header': header})
+                    reply.update({device_name + '_ch1': ch1_bytes})
+                    if ch2_bytes is not None:
+                        reply.update({device_name + '_ch2': ch2_bytes})
+                    t_ns = t_ns_frame if t_ns is None else max(t_ns, t_ns_frame)
+                item = self.pending.popleft() if self.pending else self.frame_q.get(block=False)
+        except queue.Empty:
+            pass
+
+        if not replied:
+            return
+
+        # Store the names of all devices that replied, and the latest frame timestamp, in the reply
+        reply.update({'replied_devices': replied})
+        reply.update({'timestamp': t_ns})
+        self.reply_q.put(rp.ClientReply('DATA', reply), block=True)
+
+
+    def _stop_workers(self, timeout=2.):
+        """ Stop and join all reader workers. Frames still in flight are
+        discarded while waiting: a reader process cannot exit until its
+        frames have been taken off frame_q.
+        """
+        self.stop_w.send_bytes(b'stop')
+        t_end = time.time() + timeout
+        while any(worker.is_alive() for worker in self.workers.values()) and time.time() < t_end:
+            try:
+                self.frame_q.get(timeout=0.01)
+            except queue.Empty:
+                pass
+        for worker in self.workers.values():
+            worker.join(max(0., t_end - time.time()))
+        self.workers = {}
+        self.connected = [False] * len(self.device_names)
+        self.pending.clear()
+        while self.stop.poll():
+            self.stop.recv_bytes()
+        while True:
+            try:
+                self.frame_q.get(block=False)
+            except queue.Empty:
+                break
+
+
+    def _handle_CLOSE(self, client_command):
+        """ Stop all reader workers, closing their sockets.
+        """
+        devices_closed = ''
+        for i in range(len(self.device_names)):
+            if self.connected[i]:
+                devices_closed += (self.device_names[i] + ', ')
+        self._stop_workers()
+        self.clear_replies()
+        self.reply_q.put(rp.ClientReply('MESSAGE', 'Sockets closed for: ' + devices_closed))
+
+
+    def release(self, client_reply):
+        """ Replies do not reference pooled buffers: nothing to release.
+        """
+        pass
+
+
+    def clear_replies(self):
+        """ Discard all queued replies.
+        """
+        self.reply_q.clear()
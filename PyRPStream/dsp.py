@@ -0,0 +1,247 @@
+"""
+02/22, R James
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+@export
+class Stage:
+    """ Base class of processing stages attached to RPDeviceCollection.stream
+        (or acquire) with stages=[...]. Each StreamBlock is passed to
+        process(), which handles each of channels for each device, keeping
+        any state needed across blocks per (device, channel), and returns a
+        StreamBlock of output (or None). Outputs are passed to sink, if
+        given, and with save_prefix appended as float32 to
+        <save_prefix>_ch<channel>_<device>.bin.
+
+        Blocks following lost samples reset the state of their device.
+    """
+    def __init__(self, channels=(1, 2), sink=None, save_prefix=None):
+        self.channels = tuple(channels)
+        self.sink = sink
+        self.save_prefix = save_prefix
+        # State per (device, channel), and the next input sample number expected per device
+        self.states = {}
+        self.next_sample = {}
+        self.files = {}
+
+
+    def process(self, block):
+        sample = block.sample if block.sample is not None else self.next_sample.get(block.device_name, 0)
+        if self.next_sample.get(block.device_name, sample) != sample:
+            # Samples were lost: start again
+            for channel in self.channels:
+                self._reset((block.device_name, channel))
+        self.next_sample[block.device_name] = sample + len(block)
+
+        outputs = {}
+        for channel in self.channels:
+            data = block.ch1 if channel == 1 else block.ch2
+            if data is None:
+                continue
+            key = (block.device_name, channel)
+            if key not in self.states:
+                self.states[key] = self._new_state(sample, block)
+            outputs[channel] = self._process(self.states[key], data)
+
+        output = self._output(block, sample, outputs)
+        if output is not None:
+            self._save(output)
+            if self.sink is not None:
+                self.sink(output)
+        return output
+
+
+    def _new_state(self, sample, block):
+        return {}
+
+
+    def _reset(self, key):
+        self.states.pop(key, None)
+
+
+    def _process(self, state, data):
+        raise NotImplementedError
+
+
+    def _output(self, block, sample, outputs):
+        return None
+
+
+    def _save(self, output):
+        if self.save_prefix is None:
+            return
+        for channel, data in ((1, output.ch1), (2, output.ch2)):
+            if data is None:
+                continue
+            key = (output.device_name, channel)
+            if key not in self.files:
+                self.files[key] = open(f'{self.save_prefix}_ch{channel}_{output.device_name}.bin', 'ab')
+            np.asarray(data, dtype=np.float32).tofile(self.files[key])
+
+
+    def close(self):
+        """ End of the stream: close any output files.
+        """
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+
+
+
+@export
+class Decimator(Stage):
+    """ Decimation by factor with an anti-alias low-pass FIR filter (a
+        Hamming-windowed sinc with cutoff at the output Nyquist frequency,
+        numtaps long, by default 20 * factor + 1). Only the outputs that are
+        kept are computed: each is the product of a sliding window of the
+        last numtaps inputs with the filter. The last numtaps - 1 inputs are
+        carried over between blocks, and outputs are the samples whose
+        sample numbers are multiples of factor, so blocks of any size
+        decimate seamlessly. Output samples are float32 at rate / factor.
+    """
+    def __init__(self, factor, numtaps=None, channels=(1, 2), sink=None, save_prefix=None):
+        super(Decimator, self).__init__(channels, sink, save_prefix)
+        try:
+            assert int(factor) >= 1
+        except:
+            raise ValueError('factor must be a positive integer')
+        self.factor = int(factor)
+        numtaps = 20 * self.factor + 1 if numtaps is None else numtaps
+        m = np.arange(numtaps) - (numtaps - 1) / 2.
+        taps = np.sinc(m / self.factor) * np.hamming(numtaps)
+        self.taps = (taps / taps.sum()).astype(np.float32)
+
+
+    def _new_state(self, sample, block):
+        # Inputs start at rest
+        return {'history': np.zeros(len(self.taps) - 1, dtype=np.float32), 'sample': sample}
+
+
+    def _process(self, state, data):
+        buffer = np.concatenate([state['history'], data.astype(np.float32)])
+        # Window k ends at input sample state['sample'] + k; keep those on multiples of factor
+        first = -state['sample'] % self.factor
+        windows = sliding_window_view(buffer, len(self.taps))[first::self.factor]
+        state['history'] = buffer[len(buffer) - len(state['history']):]
+        state['sample'] += len(data)
+        # The taps are symmetric, so need not be reversed
+        return windows @ self.taps
+
+
+    def _output(self, block, sample, outputs):
+        if not outputs:
+            return None
+        first = -sample % self.factor
+        rate = block.rate // self.factor if block.rate else None
+        timestamp = block.timestamp + ((first * 1000000000) // block.rate if block.rate else 0)
+        return rp.StreamBlock(block.device_name, outputs.get(1), outputs.get(2), (sample + first) // self.factor,
+                              rate, timestamp, block.losses)
+
+
+
+@export
+class Envelope(Stage):
+    """ Min/max envelope: the minimum and maximum of each factor consecutive
+        samples, with samples left over from a block carried into the next.
+        Output arrays have shape (n, 2) of (min, max) pairs, at rate / factor.
+    """
+    def __init__(self, factor, channels=(1, 2), sink=None, save_prefix=None):
+        super(Envelope, self).__init__(channels, sink, save_prefix)
+        self.factor = int(factor)
+
+
+    def _new_state(self, sample, block):
+        return {'remainder': np.empty(0, dtype=block.ch1.dtype), 'carried': 0}
+
+
+    def _process(self, state, data):
+        buffer = np.concatenate([state['remainder'], data]) if len(state['remainder']) else data
+        n_bins = len(buffer) // self.factor
+        bins = buffer[:n_bins * self.factor].reshape(n_bins, self.factor)
+        state['carried'] = len(state['remainder'])
+        state['remainder'] = buffer[n_bins * self.factor:].copy()
+        return np.stack([bins.min(axis=1), bins.max(axis=1)], axis=1)
+
+
+    def _output(self, block, sample, outputs):
+        if not outputs or not len(next(iter(outputs.values()))):
+            return None
+        # The first bin began with the samples carried over from the last block
+        carried = self.states[(block.device_name, next(iter(outputs)))]['carried']
+        rate = block.rate // self.factor if block.rate else None
+        timestamp = block.timestamp - ((carried * 1000000000) // block.rate if block.rate else 0)
+        return rp.StreamBlock(block.device_name, outputs.get(1), outputs.get(2), None, rate, timestamp, block.losses)
+
+
+
+@export
+class WelchPSD(Stage):
+    """ Running power spectral density by Welch's method: segments of
+        nperseg samples overlapping by noverlap (by default half), Hann
+        windowed with their mean removed, whose periodograms are averaged.
+        Samples not yet making up a whole segment are carried over, so
+        segments span block boundaries. psd() gives the average so far;
+        with save_prefix, it is saved on close() to
+        <save_prefix>_psd_<device>.txt.
+    """
+    def __init__(self, nperseg=16384, noverlap=None, rate=None, channels=(1, 2), sink=None, save_prefix=None):
+        super(WelchPSD, self).__init__(channels, sink, save_prefix)
+        self.nperseg = nperseg
+        self.step = nperseg - (nperseg // 2 if noverlap is None else noverlap)
+        try:
+            assert 0 < self.step <= nperseg
+        except:
+            raise ValueError('noverlap must be less than nperseg')
+        self.window = np.hanning(nperseg + 1)[:-1] # periodic Hann
+        self.rate = rate
+
+
+    def _new_state(self, sample, block):
+        return {'carry': np.empty(0, dtype=np.float64), 'power': np.zeros(self.nperseg // 2 + 1), 'count': 0,
+                'rate': self.rate or block.rate or 1.}
+
+
+    def _reset(self, key):
+        # Keep the average so far: only segments spanning the loss are dropped
+        if key in self.states:
+            self.states[key]['carry'] = np.empty(0, dtype=np.float64)
+
+
+    def _process(self, state, data):
+        buffer = np.concatenate([state['carry'], data])
+        n_segments = (len(buffer) - self.nperseg) // self.step + 1 if len(buffer) >= self.nperseg else 0
+        if n_segments:
+            segments = sliding_window_view(buffer, self.nperseg)[:n_segments * self.step:self.step]
+            segments = (segments - segments.mean(axis=1, keepdims=True)) * self.window
+            state['power'] += (np.abs(np.fft.rfft(segments, axis=1)) ** 2).sum(axis=0)
+            state['count'] += n_segments
+        state['carry'] = buffer[n_segments * self.step:]
+        return None
+
+
+    def psd(self, device_name, channel):
+        """ Frequencies and one-sided power spectral density (units^2/Hz) of
+        device_name channel, averaged over the segments so far.
+        """
+        state = self.states[(device_name, channel)]
+        density = state['power'] / max(state['count'], 1) / (state['rate'] * (self.window ** 2).sum())
+        # One-sided: double all but DC (and Nyquist, for even nperseg)
+        density[1:-1 if self.nperseg % 2 == 0 else None] *= 2.
+        return np.fft.rfftfreq(self.nperseg, 1. / state['rate']), density
+
+
+    def close(self):
+        if self.save_prefix is not None:
+            for device_name in sorted({device_name for device_name, _ in self.states}):
+                channels = [channel for channel in self.channels if (device_name, channel) in self.states]
+                frequencies = self.psd(device_name, channels[0])[0]
+                np.savetxt(f'{self.save_prefix}_psd_{device_name}.txt',
+                           np.column_stack([frequencies] + [self.psd(device_name, channel)[1] for channel in channels]),
+                           header='frequency_Hz ' + ' '.join(f'psd_ch{channel}' for channel in channels))
+        super(WelchPSD, self).close()
@@ -0,0 +1,202 @@
+"""
+02/22, R James
+"""
+
+import numpy as np
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+@export
+class RingBuffer:
+    """ The last capacity samples of a stream, addressed by sample number.
+    """
+    def __init__(self, capacity, dtype=np.int16):
+        self.data = np.zeros(capacity, dtype=dtype)
+        # Sample number after the last sample written, and of the first sample still held
+        self.end = 0
+        self.start = 0
+
+
+    def reset(self, sample):
+        """ Empty the buffer, to continue from sample.
+        """
+        self.end = self.start = sample
+
+
+    def write(self, samples):
+        capacity = len(self.data)
+        if len(samples) > capacity:
+            self.end += len(samples) - capacity
+            samples = samples[-capacity:]
+        position = self.end % capacity
+        first = min(len(samples), capacity - position)
+        self.data[position:position + first] = samples[:first]
+        self.data[:len(samples) - first] = samples[first:]
+        self.end += len(samples)
+        self.start = max(self.start, self.end - capacity)
+
+
+    def read(self, sample, n, out):
+        """ Copy samples sample to sample + n, which must be held, into out.
+        """
+        capacity = len(self.data)
+        position = sample % capacity
+        first = min(n, capacity - position)
+        out[:first] = self.data[position:position + first]
+        out[first:n] = self.data[:n - first]
+
+
+
+@export
+class Event:
+    """ A fixed-length waveform record around one trigger.
+
+        device_name:  Name of the device
+        sample:       Sample number of the trigger
+        timestamp:    Time of the trigger (ns since the epoch)
+        record:       Array of shape (channels, pre_samples + post_samples),
+                      starting pre_samples before the trigger
+    """
+    def __init__(self, device_name, sample, timestamp, record):
+        self.device_name = device_name
+        self.sample = sample
+        self.timestamp = timestamp
+        self.record = record
+
+
+
+@export
+class EventBuilder:
+    """ Builds events from the StreamBlocks of an untriggered stream of raw
+        ADC values. A trigger is a crossing of threshold on trigger_channel
+        (upwards if rising, otherwise downwards); it re-arms once the signal
+        returns beyond threshold by hysteresis, and triggers within
+        holdoff_samples of the last accepted trigger are ignored. Crossings
+        are found with array operations over each block, so a block may hold
+        any number of triggers.
+
+        Each device has a ring buffer of recent samples, from which the
+        record of each trigger is read once post_samples samples after it
+        have arrived. Events whose window is not wholly available, at the
+        start of the stream or across lost samples, are counted in
+        incomplete rather than recorded.
+    """
+    def __init__(self, pre_samples=1024, post_samples=3072, threshold=30000, hysteresis=0, holdoff_samples=0, rising=True,
+                 trigger_channel=2, record_channels=(1,)):
+        try:
+            assert pre_samples >= 0 and post_samples > 0
+        except:
+            raise ValueError('pre_samples must not be negative and post_samples must be positive')
+
+        try:
+            assert trigger_channel in (1, 2) and all(channel in (1, 2) for channel in record_channels)
+        except:
+            raise ValueError('Channels must be 1 or 2')
+
+        self.pre_samples = pre_samples
+        self.post_samples = post_samples
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+        self.holdoff_samples = holdoff_samples
+        self.rising = rising
+        self.trigger_channel = trigger_channel
+        self.record_channels = tuple(record_channels)
+        self.devices = {}
+        # Per-device counts of events recorded and of those lost for lack of data
+        self.recorded = {}
+        self.incomplete = {}
+
+
+    def _device(self, block):
+        device = self.devices.get(block.device_name)
+        if device is None:
+            # Room for the record window of a trigger anywhere in a block of up to max_block samples
+            max_block = max(len(block), 16384)
+            sample = block.sample if block.sample is not None else 0
+            # Records keep the dtype of the raw ADC values: int8 or int16, by resolution
+            rings = {channel: RingBuffer(self.pre_samples + self.post_samples + max_block, block.ch1.dtype) for channel in (1, 2)}
+            for ring in rings.values():
+                ring.reset(sample)
+            device = self.devices[block.device_name] = {'rings': rings, 'max_block': max_block, 'armed': True,
+                                                        'last_trigger': None, 'pending': [], 'dtype': block.ch1.dtype}
+            self.recorded[block.device_name] = 0
+            self.incomplete[block.device_name] = 0
+        return device
+
+
+    def _triggers(self, device, samples):
+        """ Positions in samples of triggers, with hysteresis, updating whether
+        the device is armed.
+        """
+        if self.rising:
+            over = samples > self.threshold
+            rearm = samples < self.threshold - self.hysteresis
+        else:
+            over = samples < self.threshold
+            rearm = samples > self.threshold + self.hysteresis
+        # Only samples over threshold or beyond the re-arm level change state: a trigger is an over sample following a re-arm sample
+        decisive = np.flatnonzero(over | rearm)
+        if not len(decisive):
+            return decisive
+        state = over[decisive]
+        previous = np.empty_like(state)
+        previous[0] = not device['armed']
+        previous[1:] = state[:-1]
+        device['armed'] = not state[-1]
+        return decisive[state & ~previous]
+
+
+    def add(self, block):
+        """ Add a block of raw ADC values (block.ch2 is needed unless only
+        channel 1 is used), returning the list of completed events.
+        """
+        device = self._device(block)
+        if len(block) > device['max_block']:
+            head, tail = block.split(device['max_block'])
+            return self.add(head) + self.add(tail)
+
+        rings = device['rings']
+        sample = block.sample if block.sample is not None else rings[self.trigger_channel].end
+        if sample != rings[self.trigger_channel].end:
+            # Samples were lost: events needing them cannot be completed
+            self.incomplete[block.device_name] += len(device['pending'])
+            device['pending'] = []
+            for ring in rings.values():
+                ring.reset(sample)
+
+        channels = {1: block.ch1, 2: block.ch2}
+        for channel in set(self.record_channels + (self.trigger_channel,)):
+            rings[channel].write(channels[channel])
+
+        for position in self._triggers(device, channels[self.trigger_channel]):
+            trigger = sample + int(position)
+            if device['last_trigger'] is not None and trigger - device['last_trigger'] < self.holdoff_samples:
+                continue
+            device['last_trigger'] = trigger
+            if trigger - self.pre_samples < rings[self.trigger_channel].start:
+                self.incomplete[block.device_name] += 1
+                continue
+            timestamp = block.timestamp + ((int(position) * 1000000000) // block.rate if block.rate else 0)
+            device['pending'].append((trigger, timestamp))
+
+        events = []
+        end = rings[self.trigger_channel].end
+        while device['pending'] and device['pending'][0][0] + self.post_samples <= end:
+            trigger, timestamp = device['pending'].pop(0)
+            record = np.empty((len(self.record_channels), self.pre_samples + self.post_samples), dtype=device['dtype'])
+            for row, channel in enumerate(self.record_channels):
+                rings[channel].read(trigger - self.pre_samples, self.pre_samples + self.post_samples, record[row])
+            events.append(Event(block.device_name, trigger, timestamp, record))
+        self.recorded[block.device_name] += len(events)
+        return events
+
+
+    def flush(self):
+        """ End the stream: triggers still waiting for post-trigger samples
+        are counted as incomplete.
+        """
+        for device_name, device in self.devices.items():
+            self.incomplete[device_name] += len(device['pending'])
+            device['pending'] = []
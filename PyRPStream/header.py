@@ -0,0 +1,129 @@
+"""
+02/22, R James
+
+Layout of the 60-byte header sent before each pair of channel blocks
+(little-endian):
+
+    prefix      16 bytes    'STREAMpackIDv1.0'
+    index       uint64      sequence number of frames sent
+    lost        uint64      samples the device could not send since the previous frame
+    rate        uint32      sample rate (samples/s per channel)
+    resolution  uint32      bits per sample
+    adc_mode    uint32      ADC mode
+    ch1_size    uint64      bytes of channel 1 data that follow
+    ch2_size    uint64      bytes of channel 2 data that follow
+"""
+
+import numpy as np
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+HEADER_PREFIX = b'STREAMpackIDv1.0'
+HEADER_DTYPE = np.dtype([('prefix', 'S16'), ('index', '<u8'), ('lost', '<u8'), ('rate', '<u4'),
+                         ('resolution', '<u4'), ('adc_mode', '<u4'), ('ch1_size', '<u8'), ('ch2_size', '<u8')])
+__all__.extend(['HEADER_PREFIX', 'HEADER_DTYPE'])
+
+
+@export
+def parse_header(header_bytes):
+    """ Decode a 60-byte header into a HEADER_DTYPE record (a copy, so the
+    header buffer may be reused).
+    """
+    return np.frombuffer(header_bytes, dtype=HEADER_DTYPE, count=1)[0].copy()
+
+
+@export
+def header_valid(header):
+    """ True if a decoded header carries sequence and rate information.
+    """
+    return header['prefix'] == HEADER_PREFIX and header['rate'] > 0
+
+
+@export
+def pack_header(buffer, index, lost, rate, resolution, adc_mode, ch1_size, ch2_size):
+    """ Encode a header into the first 60 bytes of buffer (a uint8 array).
+    """
+    buffer[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0] = (HEADER_PREFIX, index, lost, rate, resolution, adc_mode, ch1_size, ch2_size)
+
+
+
+@export
+class SampleClock:
+    """ Sample-accurate timing and loss accounting for one device, from the
+        decoded header of each frame. The sample number of a frame is its
+        position since the first frame, counting samples lost by the device
+        (the header lost field) and, if count_gaps, whole frames missing from
+        the index sequence (lost after leaving the device). Losses are
+        recorded as (frame index, sample number, samples lost) in losses.
+
+        Times count from the host time at which the first frame was received,
+        less the frame's duration, at the header sample rate. If the headers
+        carry no sequence information, valid is False.
+
+        After resume() (the device was reconnected, so its frame indices
+        start again), the next frame is placed by host time, and the samples
+        since the last frame before it are recorded as lost.
+    """
+    def __init__(self, samples_per_frame, count_gaps=True):
+        self.samples_per_frame = samples_per_frame
+        self.count_gaps = count_gaps
+        self.valid = None
+        self.rate = None
+        self.t0_ns = None
+        self.first_index = None
+        self.next_index = None
+        # Sample number of first_index, and of the sample after the last frame
+        self.first_sample = 0
+        self.next_sample = 0
+        self.resuming = False
+        self.device_lost = 0
+        self.lost_samples = 0
+        self.losses = []
+
+
+    def update(self, header, t_host_ns):
+        """ Account for a received frame: returns its first sample number, or
+        None if the headers carry no sequence information.
+        """
+        if self.valid is None:
+            self.valid = bool(header_valid(header))
+            self.rate = int(header['rate'])
+            self.t0_ns = t_host_ns - (self.samples_per_frame * 1000000000) // max(self.rate, 1)
+            self.first_index = self.next_index = int(header['index'])
+        if not self.valid:
+            return None
+
+        index = int(header['index'])
+        lost = int(header['lost'])
+        if self.resuming:
+            # Re-anchor on host time, at the first sample of this frame
+            self.resuming = False
+            sample = (t_host_ns - self.t0_ns) * self.rate // 1000000000 - self.samples_per_frame
+            gap = max(sample - self.next_sample, 0)
+            self.first_index = self.next_index = index
+            self.first_sample = self.next_sample + gap - self.device_lost
+            lost += gap
+        self.device_lost += int(header['lost'])
+        if self.count_gaps and index > self.next_index:
+            lost += (index - self.next_index) * self.samples_per_frame
+        sample = self.first_sample + (index - self.first_index) * self.samples_per_frame + self.device_lost
+        if lost:
+            self.losses.append((index, sample - lost, lost))
+            self.lost_samples += lost
+        self.next_index = index + 1
+        self.next_sample = sample + self.samples_per_frame
+        return sample
+
+
+    def resume(self):
+        """ The device was reconnected: place its next frame by host time.
+        """
+        self.resuming = self.valid is not None
+
+
+    def time_ns(self, sample):
+        """ Time of a sample number, in ns since the epoch.
+        """
+        return self.t0_ns + (sample * 1000000000) // self.rate
@@ -0,0 +1,362 @@
+"""
+02/22, R James
+
+Metrics of the acquisition pipeline, recorded into a registry (by default
+the shared one given by metrics()) that can be read at any time:
+
+    rp.metrics().snapshot()                      # {'rp_frames_received{device="dev0"}': 1234, ...}
+    server = rp.MetricsServer(port=9464)         # text at http://127.0.0.1:9464/metrics
+    logger = rp.MetricsLogger(interval_s=10.)    # a JSON line every 10 s
+
+Counters, gauges and histograms are plain attributes updated without locks:
+each is updated by one thread (the socket thread, the consumer or a writer),
+and a snapshot reads whatever values they hold. Gauges may instead be
+functions, or sums over the objects they are added for, evaluated only
+when read.
+
+Metrics recorded:
+
+    rp_frames_received, rp_bytes_received          counters per device
+    rp_recv_seconds                                histogram per device of the
+                                                   time to receive a frame once
+                                                   readable (select engine)
+    rp_select_wakeups                              counter
+    rp_reply_queue_depth, rp_frames_dropped        gauges of the replies
+                                                   queued, and frames dropped,
+                                                   summed over the device
+                                                   collections in use
+    rp_consumer_lag_seconds                        histogram of the time from
+                                                   receipt to consumption
+    rp_conversion_seconds                          histogram per device of the
+                                                   time converting or appending
+                                                   a block
+    rp_write_seconds, rp_segments_written,         per writer
+    rp_bytes_written
+    rp_segments_rotated                            counter per device
+    rp_command_seconds                             histogram per command of
+                                                   the time until the socket
+                                                   client handles it
+    rp_connect_seconds, rp_disconnect_seconds,     histograms of the time to
+    rp_start_seconds                               connect, disconnect, and
+                                                   from starting a stream to
+                                                   its first data
+    rp_devices_lost, rp_devices_reconnected        counters per device of
+                                                   devices lost while streaming
+                                                   and reconnected
+    rp_ring_fill, rp_ring_dropped                  gauges per device of the
+                                                   frames held in its shared
+                                                   memory ring, and discarded
+                                                   when it was full (engine
+                                                   'rings')
+"""
+
+import bisect
+import http.server
+import json
+import threading
+import time
+import weakref
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+# Histogram bucket upper bounds: 1 us to 10 s, four per decade
+DEFAULT_BOUNDS = [10. ** (exponent / 4.) for exponent in range(-24, 5)]
+__all__.extend(['DEFAULT_BOUNDS'])
+
+
+@export
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+
+    def inc(self, n=1):
+        self.value += n
+
+
+
+@export
+class Gauge:
+    """ A value that is set, or a function giving it when read, or the sum
+        of read(source) over the sources added (held by weak reference, so
+        each counts until it is garbage collected).
+    """
+    def __init__(self, function=None):
+        self.function = function
+        self.value = 0
+        self.sources = weakref.WeakKeyDictionary()
+
+
+    def set(self, value):
+        self.value = value
+
+
+    def add_source(self, source, read):
+        """ Add read(source) to the value read. read should not hold a
+        reference to source, which would keep it alive.
+        """
+        self.sources[source] = read
+
+
+    def read(self):
+        if self.function is not None:
+            return self.function()
+        if len(self.sources):
+            return sum(read(source) for source, read in list(self.sources.items()))
+        return self.value
+
+
+
+@export
+class Histogram:
+    """ Counts of observations in buckets with upper bounds bounds (and one
+        more above them), with their count, sum and maximum.
+    """
+    def __init__(self, bounds=None):
+        self.bounds = DEFAULT_BOUNDS if bounds is None else sorted(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding quantile q (the maximum, above
+        the last bucket).
+        """
+        if not self.count:
+            return 0.
+        target = q * self.count
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            if total >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count if self.count else 0.,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99), 'max': self.max}
+
+
+
+@export
+class MetricsRegistry:
+    """ Named metrics, each with any labels, e.g.
+        registry.counter('rp_frames_received', device='dev0').inc(). Metrics
+        are created on first use; callers keep them to update cheaply.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+
+    def _metric(self, cls, name, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(key, cls(*args))
+        return metric
+
+
+    def counter(self, name, **labels):
+        return self._metric(Counter, name, labels)
+
+
+    def gauge(self, name, function=None, **labels):
+        """ Gauge name, read from function if given (replacing any earlier
+        function).
+        """
+        gauge = self._metric(Gauge, name, labels)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+
+    def histogram(self, name, bounds=None, **labels):
+        return self._metric(Histogram, name, labels, bounds)
+
+
+    def snapshot(self):
+        """ Current values, keyed by name and labels, e.g.
+        'rp_bytes_received{device="dev0"}'. Histograms are summarised by
+        count, sum, mean, p50, p99 and max.
+        """
+        with self.lock:
+            metrics = list(self.metrics.items())
+        snapshot = {}
+        for (name, labels), metric in sorted(metrics, key=lambda item: item[0]):
+            key = name + _label_string(labels)
+            if isinstance(metric, Histogram):
+                snapshot[key] = metric.summary()
+            elif isinstance(metric, Gauge):
+                snapshot[key] = metric.read()
+            else:
+                snapshot[key] = metric.value
+        return snapshot
+
+
+    def text(self):
+        """ Current values in the Prometheus text exposition format.
+        """
+        with self.lock:
+            metrics = list(self.metrics.items())
+        lines = []
+        typed = set()
+        for (name, labels), metric in sorted(metrics, key=lambda item: item[0]):
+            kind = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}[type(metric)]
+            if name not in typed:
+                lines.append('# TYPE ' + name + ' ' + kind)
+                typed.add(name)
+            if isinstance(metric, Histogram):
+                total = 0
+                for bound, count in zip(metric.bounds + [float('inf')], metric.counts):
+                    total += count
+                    le = '+Inf' if bound == float('inf') else '%g' % bound
+                    lines.append(name + '_bucket' + _label_string(labels + (('le', le),)) + ' ' + str(total))
+                lines.append(name + '_sum' + _label_string(labels) + ' ' + repr(metric.sum))
+                lines.append(name + '_count' + _label_string(labels) + ' ' + str(metric.count))
+            else:
+                lines.append(name + _label_string(labels) + ' ' + str(metric.read() if isinstance(metric, Gauge) else metric.value))
+        return '\n'.join(lines) + '\n'
+
+
+    def clear(self):
+        with self.lock:
+            self.metrics = {}
+
+
+
+@export
+class ReceiveMetrics:
+    """ The metrics of frames received from one device, kept by socket
+        clients to update.
+    """
+    def __init__(self, registry, device_name):
+        self.frames = registry.counter('rp_frames_received', device=device_name)
+        self.bytes = registry.counter('rp_bytes_received', device=device_name)
+        self.recv = registry.histogram('rp_recv_seconds', device=device_name)
+
+
+    def record(self, n_bytes, recv_s=None):
+        self.frames.inc()
+        self.bytes.inc(n_bytes)
+        if recv_s is not None:
+            self.recv.observe(recv_s)
+
+
+
+@export
+class WriteMetrics:
+    """ The metrics of segments saved by one writer.
+    """
+    def __init__(self, registry, writer):
+        self.segments = registry.counter('rp_segments_written', writer=writer)
+        self.bytes = registry.counter('rp_bytes_written', writer=writer)
+        self.write = registry.histogram('rp_write_seconds', writer=writer)
+
+
+    def record(self, n_bytes, write_s):
+        self.segments.inc()
+        self.bytes.inc(n_bytes)
+        self.write.observe(write_s)
+
+
+def _label_string(labels):
+    return '{' + ','.join(key + '="' + str(value) + '"' for key, value in labels) + '}' if labels else ''
+
+
+_registry = MetricsRegistry()
+
+
+@export
+def metrics():
+    """ The shared MetricsRegistry, used unless another is given.
+    """
+    return _registry
+
+
+
+@export
+class MetricsServer:
+    """ Local HTTP endpoint serving registry (by default metrics()) as text
+        at /metrics and as JSON at /metrics.json, from a background thread.
+    """
+    def __init__(self, registry=None, port=9464, address='127.0.0.1'):
+        registry = metrics() if registry is None else registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = registry.text().encode(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = json.dumps(registry.snapshot()).encode(), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((address, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+
+@export
+class MetricsLogger:
+    """ Writes a JSON line of the snapshot of registry (by default
+        metrics()), with the time in ns, every interval_s seconds: to file
+        (an open text file) if given, otherwise printed.
+    """
+    def __init__(self, registry=None, interval_s=10., file=None):
+        self.registry = metrics() if registry is None else registry
+        self.interval_s = interval_s
+        self.file = file
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+
+    def _run(self):
+        while not self.stop.wait(self.interval_s):
+            self.log()
+
+
+    def log(self):
+        line = json.dumps({'t_ns': time.time_ns(), **self.registry.snapshot()})
+        if self.file is not None:
+            self.file.write(line + '\n')
+            self.file.flush()
+        else:
+            print(line)
+
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
@@ -0,0 +1,278 @@
+"""
+02/22, R James
+"""
+
+import glob
+import json
+import os
+import re
+import numpy as np
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+# Segment files written by RPDeviceCollection.acquire: channel, device name, timestamp of the first sample, and type
+SEGMENT_PATTERN = re.compile(r'red_pitaya_data_ch([12])_(.+)_(\d+)\.(bin|rps)$')
+
+
+@export
+class ChannelArray:
+    """ The segment files of one device channel as one virtual array, memory
+        mapped lazily: files are only mapped, and data only read, when
+        indexed. Segments are made of pieces of consecutive samples (whole
+        .bin files, or container chunks), each with the timestamp of its
+        first sample. Indices count stored samples, skipping losses.
+
+        Values are returned as stored, or converted to V in dtype where the
+        stored values are raw ADC values with known calibration.
+
+        Compressed container chunks cannot be mapped: each is decompressed
+        whole when indexed, and the last kept for the next read.
+    """
+    def __init__(self, device_name, channel, dtype=None):
+        self.device_name = device_name
+        self.channel = channel
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.rate = None
+        self.stored_dtype = None
+        self.calibration = None
+        # Time origin for time_slice, set by RunReader to the start of the run
+        self.t_origin_ns = None
+        # Pieces: (filename, byte offset, number of samples, timestamp of the first sample)
+        self.pieces = []
+        self.maps = {}
+        # Readers of compressed containers, with the chunk number of each piece offset, and the last chunk decompressed
+        self.containers = {}
+        self._cached = (None, None)
+        self._starts = None
+
+
+    def add_bin(self, filename, t_file, stored_dtype, rate=None, calibration=None):
+        self._add_segment(stored_dtype, rate, calibration)
+        n_samples = os.path.getsize(filename) // self.stored_dtype.itemsize
+        self.pieces.append((filename, 0, n_samples, t_file))
+        self._starts = None
+
+
+    def add_container(self, filename):
+        with rp.ContainerReader(filename) as container:
+            self._add_segment(container.dtype, container.rate, container.calibration)
+            for offset, _, n_samples, timestamp in container.index:
+                self.pieces.append((filename, int(offset), int(n_samples), int(timestamp)))
+            if container.compressor is not None:
+                self.containers[filename] = {int(offset): i for i, offset in enumerate(container.index['offset'])}
+        self._starts = None
+
+
+    def _add_segment(self, stored_dtype, rate, calibration):
+        stored_dtype = np.dtype(stored_dtype)
+        try:
+            assert self.stored_dtype is None or self.stored_dtype == stored_dtype
+        except:
+            raise ValueError('Segments of ' + self.device_name + ' channel ' + str(self.channel) + ' have different dtypes')
+        self.stored_dtype = stored_dtype
+        self.rate = rate if rate else self.rate
+        self.calibration = calibration if calibration is not None else self.calibration
+
+
+    def _index(self):
+        if self._starts is None:
+            self.pieces.sort(key=lambda piece: piece[3])
+            lengths = np.array([piece[2] for piece in self.pieces], dtype=np.int64)
+            self._starts = np.concatenate([[0], np.cumsum(lengths)])
+            self._timestamps = np.array([piece[3] for piece in self.pieces], dtype=np.int64)
+        return self._starts
+
+
+    def __len__(self):
+        return int(self._index()[-1])
+
+
+    @property
+    def t_start_ns(self):
+        self._index()
+        return int(self._timestamps[0]) if len(self.pieces) else None
+
+
+    def _piece(self, i):
+        """ Memory mapped samples of piece i.
+        """
+        filename, offset, n_samples, _ = self.pieces[i]
+        if filename in self.containers:
+            if self._cached[0] != (filename, offset):
+                if not isinstance(self.containers[filename], tuple):
+                    self.containers[filename] = (rp.ContainerReader(filename), self.containers[filename])
+                container, chunks = self.containers[filename]
+                self._cached = ((filename, offset), container.chunk(chunks[offset]))
+            return self._cached[1]
+        if filename not in self.maps:
+            self.maps[filename] = np.memmap(filename, dtype=np.uint8, mode='r')
+        return self.maps[filename][offset:offset + n_samples * self.stored_dtype.itemsize].view(self.stored_dtype)
+
+
+    def _convert(self, data):
+        if self.dtype is None or self.dtype == self.stored_dtype:
+            return data
+        if self.stored_dtype.kind == 'i' and self.calibration is not None:
+            return rp.AdcConverter(dtype=self.dtype, **self.calibration).convert(data)
+        return data.astype(self.dtype)
+
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            return self.read(start, max(start, stop))[::step]
+        index = key + len(self) if key < 0 else key
+        if index < 0 or index >= len(self):
+            raise IndexError('index out of range')
+        return self.read(index, index + 1)[0]
+
+
+    def read(self, start, stop):
+        """ Stored samples start to stop. Within one piece, this is a view of
+        the mapped file unless converted.
+        """
+        starts = self._index()
+        i_start = max(np.searchsorted(starts, start, side='right') - 1, 0)
+        i_stop = np.searchsorted(starts, stop, side='left')
+        parts = [self._piece(i)[max(start - starts[i], 0):min(stop, starts[i + 1]) - starts[i]] for i in range(i_start, i_stop)]
+        if not parts:
+            return self._convert(np.empty(0, dtype=self.stored_dtype))
+        return self._convert(parts[0] if len(parts) == 1 else np.concatenate(parts))
+
+
+    def index_at(self, t_ns):
+        """ Index of the first sample at or after time t_ns. Without a sample
+        rate, this is the first sample of the piece holding t_ns.
+        """
+        starts = self._index()
+        i = np.searchsorted(self._timestamps, t_ns, side='right') - 1
+        if i < 0:
+            return 0
+        if not self.rate:
+            return int(starts[i])
+        n_samples = starts[i + 1] - starts[i]
+        return int(starts[i] + min(n_samples, -((-(int(t_ns) - int(self._timestamps[i])) * self.rate) // 1000000000)))
+
+
+    def time_slice(self, t0_s, t1_s):
+        """ Samples from t0_s to t1_s seconds after t_origin_ns (by default,
+        the first sample).
+        """
+        t_origin_ns = self.t_origin_ns if self.t_origin_ns is not None else self.t_start_ns
+        return self.read(self.index_at(t_origin_ns + round(t0_s * 1e9)), self.index_at(t_origin_ns + round(t1_s * 1e9)))
+
+
+    def chunks(self, chunk_samples=1048576):
+        """ Iterate over (index, samples) chunk_samples at a time, for
+        processing arrays larger than memory.
+        """
+        for start in range(0, len(self), chunk_samples):
+            yield start, self.read(start, min(start + chunk_samples, len(self)))
+
+
+    def close(self):
+        """ Unmap all files.
+        """
+        self.maps = {}
+        self._cached = (None, None)
+        for filename, container in self.containers.items():
+            if isinstance(container, tuple):
+                container[0].close()
+                self.containers[filename] = container[1]
+
+
+
+@export
+class RunReader:
+    """ Reader for the segment files written by RPDeviceCollection.acquire in
+        directory, as one ChannelArray per device channel:
+
+            run = RunReader('data', dtype=np.float32)
+            run['dev0', 1][:1000]          # first 1000 samples of dev0 channel 1
+            run[0.5:0.6]                   # {(device, channel): samples} from 0.5 s to 0.6 s
+            for t_s, window in run.chunks(1.):
+                ...                        # one second of every channel at a time
+
+        Times are in seconds from the earliest first sample of any channel,
+        and are aligned across devices by the timestamps of their pieces.
+
+        .bin files do not record their dtype or sample rate. Those with
+        calibration metadata ('lazy' data_format) are raw ADC values; others
+        are read as bin_dtype (by default utils.DTYPE). rate is used for .bin
+        files, and for container files that have no rate of their own.
+    """
+    def __init__(self, directory='.', dtype=None, rate=None, bin_dtype=None):
+        self.directory = directory
+        self.dtype = dtype
+        self.channels = {}
+
+        for filename in sorted(glob.glob(os.path.join(directory, 'red_pitaya_data_ch*'))):
+            match = SEGMENT_PATTERN.search(os.path.basename(filename))
+            if match is None:
+                continue
+            channel, device_name, t_file, kind = int(match.group(1)), match.group(2), int(match.group(3)), match.group(4)
+            array = self.channels.setdefault((device_name, channel), ChannelArray(device_name, channel, dtype))
+            if kind == 'rps':
+                array.add_container(filename)
+            elif os.path.isfile(rp.calibration_filename(filename)):
+                with open(rp.calibration_filename(filename), 'r') as file:
+                    calibration = json.load(file)
+                array.add_bin(filename, t_file, rp.sample_dtype(calibration.get('input_bits', 16)), rate, calibration)
+            else:
+                array.add_bin(filename, t_file, rp.dtype() if bin_dtype is None else bin_dtype, rate)
+            if not array.rate:
+                array.rate = rate
+
+        starts = [array.t_start_ns for array in self.channels.values()]
+        self.t_start_ns = min(starts) if starts else None
+        for array in self.channels.values():
+            array.t_origin_ns = self.t_start_ns
+
+
+    @property
+    def devices(self):
+        return sorted({device_name for device_name, _ in self.channels})
+
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return {name: array.time_slice(key.start or 0., key.stop) for name, array in self.channels.items()}
+        return self.channels[key]
+
+
+    def duration_s(self):
+        """ Time from the start of the run to the end of the last channel, by
+        sample rate.
+        """
+        ends = []
+        for array in self.channels.values():
+            array._index()
+            _, _, n_samples, timestamp = array.pieces[-1]
+            ends.append(timestamp + (n_samples * 1000000000) // array.rate if array.rate else timestamp)
+        return (max(ends) - self.t_start_ns) / 1e9 if ends else 0.
+
+
+    def chunks(self, chunk_s, t0_s=0., t1_s=None):
+        """ Iterate over (t_s, {(device, channel): samples}) windows of chunk_s
+        seconds from t0_s to t1_s (by default, the end of the run).
+        """
+        t1_s = self.duration_s() if t1_s is None else t1_s
+        # Count windows, rather than add up floats, so that windows neither overlap nor leave gaps
+        for i in range(int(np.ceil((t1_s - t0_s) / chunk_s))):
+            t_s = t0_s + i * chunk_s
+            yield t_s, self[t_s:min(t0_s + (i + 1) * chunk_s, t1_s)]
+
+
+    def close(self):
+        for array in self.channels.values():
+            array.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,510 @@
+"""
+02/22, R James
+
+Replay of recorded data through the acquisition pipeline in place of live
+devices. ReplayClient is a drop-in alternative to SocketClientThread whose
+frames are read from files, so that stream(), acquire() (segmenting and
+conversion) and triggered mode run unchanged on production data, at real
+time or as fast as possible:
+
+    replay = rp.Replay('data', speed=None, loop=True, bin_dtype=np.float16)
+    collection = rp.RPDeviceCollection(engine='replay', replay=replay)
+    for device_name in replay.device_names():
+        collection.add_device(device_name, '127.0.0.1', 0)    # address unused
+    collection.initialise()
+    collection.connect()
+    collection.acquire(60.)
+
+Two kinds of recording are replayed, per device:
+
+    frame captures  red_pitaya_frames_<device>_<timestamp>.frames: whole
+                    frames as received, headers included (see
+                    capture_frames), replayed as they are
+    segment files   the .bin or .rps segment files written by acquire
+                    (see RunReader), cut into frames whose headers give the
+                    sample rate of the recording; samples after the last
+                    whole frame are not replayed. Segments in volts are
+                    converted back to raw ADC values, with the calibration
+                    of the container or else of the device replayed, which
+                    is only exact for raw formats (see AdcConverter.to_adc)
+
+Where a device has both, its frame captures are replayed.
+"""
+
+import glob
+import os
+import re
+import queue
+import select
+import socket
+import threading
+import time
+import numpy as np
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+# Frame captures written by capture_frames: device name and timestamp of the first frame
+FRAMES_PATTERN = re.compile(r'red_pitaya_frames_(.+)_(\d+)\.frames$')
+
+
+@export
+def capture_frames(address_port, duration_s, directory='.', device_name=None, header_size=60, channel_size=32768, timeout_s=5.):
+    """ Record the frames streamed by the device at address_port for
+    duration_s seconds, as received, to a frame capture file in directory
+    for replay. Returns the file name.
+    """
+    device_name = address_port[0] if device_name is None else device_name
+    filename = os.path.join(directory, 'red_pitaya_frames_' + device_name + '_' + str(time.time_ns()) + '.frames')
+    frame_size = header_size + 2 * channel_size
+    frame = bytearray(frame_size)
+    view = memoryview(frame)
+    sock = socket.create_connection(address_port, timeout_s)
+    t_end = time.monotonic() + duration_s
+    try:
+        with open(filename, 'wb') as file:
+            while time.monotonic() < t_end:
+                n_read = 0
+                while n_read < frame_size:
+                    n_packet = sock.recv_into(view[n_read:], frame_size - n_read)
+                    if not n_packet:
+                        raise OSError('Empty packet from socket.recv_into()')
+                    n_read += n_packet
+                file.write(frame)
+    finally:
+        sock.close()
+    return filename
+
+
+
+class _CaptureFrames:
+    """ The frames of one device's capture files, in order. Frame indices
+        are renumbered to run on across files and loops, keeping any gaps
+        recorded within a file.
+    """
+    def __init__(self, filenames, header_size, channel_size):
+        self.header_size = header_size
+        self.channel_size = channel_size
+        self.frame_size = header_size + 2 * channel_size
+        # Per file: the mapped frames, the index of its first frame, and the indices it spans
+        self.files = []
+        for filename in sorted(filenames, key=lambda filename: int(FRAMES_PATTERN.search(filename).group(2))):
+            n_frames = os.path.getsize(filename) // self.frame_size
+            if not n_frames:
+                continue
+            frames = np.memmap(filename, dtype=np.uint8, mode='r', shape=(n_frames, self.frame_size))
+            first = int(rp.parse_header(frames[0, :header_size])['index'])
+            last = int(rp.parse_header(frames[-1, :header_size])['index'])
+            self.files.append((frames, first, max(last - first + 1, n_frames)))
+        self.n_frames = sum(len(frames) for frames, _, _ in self.files)
+        self.span = sum(span for _, _, span in self.files)
+        header = rp.parse_header(self.files[0][0][0, :header_size]) if self.files else None
+        self.rate = int(header['rate']) if header is not None and rp.header_valid(header) else None
+
+
+    def frame(self, i, loop=0):
+        """ Header, channel 1 and channel 2 of frame i, on loop loop.
+        """
+        base = loop * self.span
+        for frames, first, span in self.files:
+            if i < len(frames):
+                break
+            i -= len(frames)
+            base += span
+        view = memoryview(frames[i])
+        header = rp.parse_header(view[:self.header_size])
+        header['index'] = base + int(header['index']) - first
+        ch2_start = self.header_size + self.channel_size
+        return header, view[self.header_size:ch2_start], view[ch2_start:]
+
+
+
+class _SegmentFrames:
+    """ The samples of one device's segment files (ChannelArrays), as raw
+        ADC values cut into frames of samples_per_frame with made up headers.
+        Segments in volts are converted back with the calibration of their
+        container, or else with converters (the AdcConverters of channels 1
+        and 2 of the device). A last part frame is not replayed; channel 2
+        is replayed as zeros if only channel 1 was recorded.
+    """
+    def __init__(self, ch1, ch2, samples_per_frame, resolution_bits, channel_size, converters=None):
+        self.unconverters = []
+        for channel, array in enumerate((ch1, ch2), 1):
+            unconverter = None
+            if array is not None and array.stored_dtype.kind != 'i':
+                if array.calibration is not None:
+                    unconverter = rp.AdcConverter(**array.calibration)
+                elif converters is not None:
+                    unconverter = converters[channel - 1]
+                else:
+                    raise ValueError('Cannot replay ' + array.device_name + ': segments hold volts, and there is no calibration'
+                                     ' to convert them back to raw ADC values with')
+                if unconverter.sample_dtype != rp.sample_dtype(resolution_bits):
+                    raise ValueError('Cannot replay ' + array.device_name + ': calibration is for ' + str(unconverter.input_bits)
+                                     + ' bit samples, not ' + str(resolution_bits))
+            self.unconverters.append(unconverter)
+        self.ch1 = ch1
+        self.ch2 = ch2
+        self.samples_per_frame = samples_per_frame
+        self.resolution_bits = resolution_bits
+        self.channel_size = channel_size
+        self.zeros = bytes(channel_size)
+        self.n_frames = min(len(array) for array in (ch1, ch2) if array is not None) // samples_per_frame
+        self.span = self.n_frames
+        self.rate = int(ch1.rate) if ch1.rate else None
+
+
+    def frame(self, i, loop=0):
+        """ Header, channel 1 and channel 2 of frame i, on loop loop.
+        """
+        header = np.array([(rp.HEADER_PREFIX, loop * self.span + i, 0, self.rate or 0, self.resolution_bits, 0,
+                            self.channel_size, self.channel_size)], dtype=rp.HEADER_DTYPE)[0]
+        start = i * self.samples_per_frame
+        channels = []
+        for array, unconverter in zip((self.ch1, self.ch2), self.unconverters):
+            if array is None:
+                channels.append(self.zeros)
+                continue
+            samples = array.read(start, start + self.samples_per_frame)
+            if unconverter is not None:
+                samples = unconverter.to_adc(samples)
+            channels.append(memoryview(np.ascontiguousarray(samples)).cast('B'))
+        return header, channels[0], channels[1]
+
+
+
+@export
+class Replay:
+    """ Recorded data to replay from directory, and how:
+
+        speed:       multiple of the recorded sample rate to replay at, or
+                     None for as fast as the consumer takes the frames
+        loop:        replay from the start again at the end, with frame
+                     indices running on, rather than end the stream
+        interleave:  'lockstep', for a frame of every device in each reply
+                     (as when all devices are received at once), or
+                     'staggered', for one device per reply with the devices
+                     in turn (as when frames arrive at different times)
+        rate:        sample rate of .bin segment files, which do not record
+                     it (as RunReader), needed for speed other than None
+        bin_dtype:   dtype of .bin segment files, which do not record it
+                     either (as RunReader; np.float16 for volts saved by
+                     default), needed unless they are in 'lazy' format
+    """
+    def __init__(self, directory='.', speed=1., loop=False, interleave='lockstep', rate=None, bin_dtype=None):
+        try:
+            assert speed is None or speed > 0
+        except:
+            raise ValueError('speed must be positive, or None')
+
+        try:
+            assert interleave in ('lockstep', 'staggered')
+        except:
+            raise ValueError("interleave must be 'lockstep' or 'staggered'")
+
+        self.directory = directory
+        self.speed = speed
+        self.loop = loop
+        self.interleave = interleave
+        self.rate = rate
+        self.bin_dtype = None if bin_dtype is None else np.dtype(bin_dtype)
+
+
+    def device_names(self):
+        """ Names of the devices with recorded data, in order.
+        """
+        names = set()
+        for filename in glob.glob(os.path.join(self.directory, 'red_pitaya_*')):
+            for pattern in (FRAMES_PATTERN, rp.reader.SEGMENT_PATTERN):
+                match = pattern.search(os.path.basename(filename))
+                if match is not None:
+                    names.add(match.group(1 if pattern is FRAMES_PATTERN else 2))
+        return sorted(names)
+
+
+    def sources(self, resolution_bits=16, header_size=60, channel_size=32768, device_names=None, converters=None):
+        """ The frames of each device with recorded data (of device_names, if
+        given), by name. converters, if given, are the AdcConverters of
+        channels 1 and 2 of each device, by name, to convert segments in
+        volts without calibration back with.
+        """
+        sources = {}
+        captures = {}
+        for filename in glob.glob(os.path.join(self.directory, 'red_pitaya_frames_*.frames')):
+            match = FRAMES_PATTERN.search(os.path.basename(filename))
+            if match is not None and (device_names is None or match.group(1) in device_names):
+                captures.setdefault(match.group(1), []).append(filename)
+        for device_name, filenames in captures.items():
+            sources[device_name] = _CaptureFrames(filenames, header_size, channel_size)
+
+        if self.bin_dtype is None:
+            for filename in glob.glob(os.path.join(self.directory, 'red_pitaya_data_ch*.bin')):
+                match = rp.reader.SEGMENT_PATTERN.search(os.path.basename(filename))
+                device_name = match.group(2) if match is not None else None
+                if (device_name is not None and device_name not in sources and (device_names is None or device_name in device_names)
+                        and not os.path.isfile(rp.calibration_filename(filename))):
+                    raise ValueError('Cannot replay ' + device_name + ' without the dtype of its .bin segment files: give bin_dtype'
+                                     ' (np.float16 for volts saved by default, or the raw dtype with acquire_raw)')
+
+        sample_dtype = rp.sample_dtype(resolution_bits)
+        run = rp.RunReader(self.directory, rate=self.rate, bin_dtype=self.bin_dtype)
+        for device_name in run.devices:
+            if device_name in sources or (device_names is not None and device_name not in device_names):
+                continue
+            if (device_name, 1) in run.channels:
+                sources[device_name] = _SegmentFrames(run.channels[device_name, 1], run.channels.get((device_name, 2)),
+                                                      channel_size // sample_dtype.itemsize, resolution_bits, channel_size,
+                                                      None if converters is None else converters.get(device_name))
+
+        if self.speed is not None:
+            for device_name, source in sources.items():
+                if not source.rate:
+                    raise ValueError('Cannot replay ' + device_name + ' at a speed without its sample rate: give rate, or speed=None')
+        return sources
+
+
+
+@export
+class ReplayClient(threading.Thread):
+    """ Drop-in alternative to SocketClientThread that replays recorded
+        frames (see Replay) rather than receiving them, into the same DATA
+        replies, in untriggered or triggered mode. CONNECT connects each
+        device that has recorded data, ignoring addresses; restart(), which
+        stream() calls as it begins, starts the replay from the beginning,
+        so each stream replays the recording from its start. Once the
+        recording of every device has been replayed (without loop), an END
+        reply is sent.
+
+        Segment files in volts are converted back to raw ADC values, with
+        the calibration of their container or else with converters (the
+        AdcConverters of channels 1 and 2 of each device, by name), as
+        RPDeviceCollection gives from the devices added.
+
+        Replies hold views of the mapped files. reply_q holds at most
+        reply_q_size replies (64 if 0), so a replay faster than its
+        consumer is held back (or drops frames, by the overflow policy).
+        Frames and bytes replayed are recorded in metrics (by default
+        rp.metrics()).
+    """
+    def __init__(self, device_names, replay, triggered=False, reply_q_size=0, overflow='block', spill_dir=None, metrics=None,
+                 resolution_bits=16, converters=None):
+        super(ReplayClient, self).__init__()
+
+        # Command and reply queues for communicating with the replay thread
+        self.cmd_q = rp.CommandQueue()
+        self.reply_q = rp.BoundedReplyQueue(reply_q_size or 64, overflow, spill_dir)
+        # Thread run control, and whether the replay has been started, or has ended, since connecting
+        self.alive = threading.Event()
+        self.alive.set()
+        self.started = threading.Event()
+        self.running = False
+        self.connected = [False] * len(device_names)
+        self.device_names = device_names
+        # Buffer reading attributes
+        self.header_size = 60
+        self.channel_size = 32768
+        self.sample_dtype = rp.sample_dtype(resolution_bits)
+        # Triggered or untriggered mode
+        self.triggered = triggered
+        # Triggering value for channel 2 for triggered mode (raw ADC counts, 30000 at 16 bits)
+        self.trigger_value = 30000 >> (16 - resolution_bits)
+        # Recorded frames of each device, and the replay position of each device connected
+        self.replay = replay
+        self.sources = replay.sources(resolution_bits, self.header_size, self.channel_size, device_names, converters)
+        self.positions = {}
+        self.t_start = None
+        # Metrics
+        self.metrics = rp.metrics() if metrics is None else metrics
+        self.receive_metrics = {device_name: rp.ReceiveMetrics(self.metrics, device_name) for device_name in device_names}
+        # Thread control handlers
+        self.handlers = {
+            'CONNECT': self._handle_CONNECT,
+            'START': self._handle_START,
+            'CLOSE': self._handle_CLOSE
+        }
+
+        print('Starting replay with ' + str(len(device_names)) + ' devices')
+
+
+    def run(self):
+        """ Thread control function. Waiting for the next frame to be due is
+        interrupted by commands, so they are handled as soon as they are sent.
+        """
+        while self.alive.isSet():
+            if self.running:
+                timeout_s = self._replay()
+                if timeout_s:
+                    select.select([self.cmd_q], [], [], timeout_s)
+            else:
+                # Don't do anything until a command is sent if not replaying
+                select.select([self.cmd_q], [], [])
+            # Commands last, so that the end of the thread is seen before waiting again
+            self._handle_commands()
+        self.cmd_q.close()
+
+
+    def _handle_commands(self):
+        """ Handle every command sent to the thread.
+        """
+        self.cmd_q.clear_wakeups()
+        while True:
+            try:
+                command = self.cmd_q.get(block=False)
+            except queue.Empty:
+                return
+            if command is not None:
+                self.metrics.histogram('rp_command_seconds', command=command.key).observe(time.perf_counter() - command.t_sent)
+                self.handlers[command.key](command)
+
+
+    def join(self, timeout=None):
+        """ Invoking this will end the thread.
+        """
+        print('Ending replay with ' + str(len(self.device_names)) + ' devices')
+
+        self.alive.clear()
+        # Wake the thread to see that it should end
+        self.cmd_q.put(None)
+        threading.Thread.join(self, timeout)
+
+
+    def _handle_CONNECT(self, client_command):
+        """ Connect each device with recorded data. client_command should be
+        an array of (host, port) tuples, which are not used.
+        """
+        try:
+            assert len(self.device_names) == len(self.connected) == len(client_command.command)
+        except:
+            raise ValueError('All arguments must be of the same length')
+
+        for i, device_name in enumerate(self.device_names):
+            if self.connected[i]:
+                # We are already connected, do nothing
+                self.reply_q.put(rp.ClientReply('MESSAGE', 'Replay for ' + device_name + ' already connected'))
+            elif device_name not in self.sources or not self.sources[device_name].n_frames:
+                self.reply_q.put(rp.ClientReply('ERROR', 'No recorded frames for ' + device_name + '. Problem device: ' + device_name))
+            else:
+                self.connected[i] = True
+                self.reply_q.put(rp.ClientReply('MESSAGE', 'Replay for ' + device_name + ' connected: '
+                                                + str(self.sources[device_name].n_frames) + ' frames'))
+
+
+    def _handle_START(self, client_command):
+        """ Start the replay of every connected device from the beginning,
+        discarding any replies queued.
+        """
+        self.reply_q.clear()
+        replayed = [device_name for device_name, connected in zip(self.device_names, self.connected) if connected]
+        # With staggered interleaving, devices take turns, a fraction of a frame apart
+        self.positions = {device_name: {'frame': 0, 'loop': 0, 'offset': i / len(replayed) if self.replay.interleave == 'staggered' else 0}
+                          for i, device_name in enumerate(replayed)}
+        self.t_start = time.monotonic()
+        self.running = bool(self.positions)
+        self.started.set()
+
+
+    def _handle_CLOSE(self, client_command):
+        """ End the replay of every device.
+        """
+        devices_closed = ''
+        for i in range(len(self.device_names)):
+            if self.connected[i]:
+                devices_closed += (self.device_names[i] + ', ')
+        self.connected = [False] * len(self.device_names)
+        self.positions = {}
+        self.running = False
+        self.reply_q.clear()
+        self.reply_q.put(rp.ClientReply('MESSAGE', 'Replay closed for: ' + devices_closed))
+
+
+    def _due(self, device_name):
+        """ When the next frame of a device is due: in frames (at speed None)
+        or in seconds of time.monotonic.
+        """
+        position = self.positions[device_name]
+        source = self.sources[device_name]
+        frame = position['loop'] * source.n_frames + position['frame'] + position['offset']
+        if self.replay.speed is None:
+            return frame
+        return self.t_start + frame * (self.channel_size // self.sample_dtype.itemsize) / (source.rate * self.replay.speed)
+
+
+    def _replay(self):
+        """ Put a DATA reply of the frames now due, returning how long to wait
+        for the next to be due, if none are.
+        """
+        dues = {device_name: self._due(device_name) for device_name in self.positions}
+        if not dues:
+            # Every recording has been replayed
+            self.running = False
+            self.reply_q.put(rp.ClientReply('END', 'Replay ended'))
+            return None
+        now = min(dues.values()) if self.replay.speed is None else time.monotonic()
+        ready = sorted((due, device_name) for device_name, due in dues.items() if due <= now)
+        if not ready:
+            return min(dues.values()) - now
+        if self.replay.interleave == 'staggered':
+            ready = ready[:1]
+
+        reply = {}
+        replied = []
+        for _, device_name in ready:
+            source = self.sources[device_name]
+            position = self.positions[device_name]
+            header, ch1_bytes, ch2_bytes = source.frame(position['frame'], position['loop'])
+            self.receive_metrics[device_name].record(self.header_size + 2 * self.channel_size)
+            position['frame'] += 1
+            if position['frame'] == source.n_frames:
+                if self.replay.loop:
+                    position['frame'] = 0
+                    position['loop'] += 1
+                else:
+                    del self.positions[device_name]
+
+            if self.triggered:
+                start = rp.trigger_start(ch2_bytes, self.trigger_value, self.sample_dtype)
+                if start is None:
+                    # Nothing kept from this frame
+                    continue
+                # Keep everything on channel 1 since the first point the threshold was exceeded
+                ch1_bytes = ch1_bytes[self.sample_dtype.itemsize * start:]
+            reply.update({device_name + '_header': header})
+            reply.update({device_name + '_ch1': ch1_bytes})
+            if not self.triggered:
+                reply.update({device_name + '_ch2': ch2_bytes})
+            replied.append(device_name)
+
+        if replied:
+            # Store the names of all devices that replied, and the time of the reply, as for live frames
+            reply.update({'replied_devices': replied})
+            reply.update({'timestamp': time.time_ns()})
+            self.reply_q.put(rp.ClientReply('DATA', reply), block=True)
+        return None
+
+
+    def release(self, client_reply):
+        """ Replies do not reference pooled buffers: nothing to release.
+        """
+        pass
+
+
+    def clear_replies(self):
+        """ Discard all queued replies.
+        """
+        self.reply_q.clear()
+
+
+    def restart(self):
+        """ Start the replay of every connected device from the beginning,
+        and wait until it has. The replay is started by the replay thread
+        (with a START command), which also discards the replies queued
+        before, so that none is left.
+        """
+        if not self.alive.isSet():
+            return
+        self.started.clear()
+        self.cmd_q.put(rp.ClientCommand('START'))
+        # The replay thread puts at most one more reply before it handles the command: make room for it
+        self.reply_q.clear()
+        self.started.wait()
@@ -0,0 +1,152 @@
+"""
+02/22, R James
+"""
+
+import collections
+import os
+import pickle
+import queue
+import tempfile
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+@export
+class BoundedReplyQueue(queue.Queue):
+    """ Reply queue between a socket client and its consumer, holding at most
+        maxsize replies in memory (unbounded if maxsize is 0). When it is full,
+        DATA replies are handled according to policy:
+
+        'block':        put() blocks until the consumer catches up
+        'drop-oldest':  the oldest queued DATA reply is discarded
+        'drop-newest':  the new DATA reply is discarded
+        'spill':        DATA replies are written to a temporary file in
+                        spill_dir and read back, in order, as the queue drains
+
+        ERROR and MESSAGE replies are never dropped. Per-device counts of
+        dropped, spilled and cleared frames are given by counters(). on_drop,
+        if given, is called with each DATA reply that leaves the queue other
+        than through get(), e.g. to release pooled receive buffers.
+    """
+    policies = ('block', 'drop-oldest', 'drop-newest', 'spill')
+
+    def __init__(self, maxsize=0, policy='block', spill_dir=None, on_drop=None):
+        try:
+            assert policy in self.policies
+        except:
+            raise ValueError('policy must be one of ' + ', '.join(self.policies))
+
+        # Only the block policy makes put() wait for space
+        super(BoundedReplyQueue, self).__init__(maxsize if policy == 'block' else 0)
+        self.capacity = maxsize
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.on_drop = on_drop
+        # Per-device frame counters
+        self.dropped = collections.Counter()
+        self.spilled = collections.Counter()
+        self.cleared = collections.Counter()
+        # Spill file and the (offset, length, replied devices) of each reply in it, or the reply itself if not DATA
+        self.spill_file = None
+        self.spill = collections.deque()
+
+
+    def _qsize(self):
+        return len(self.queue) + len(self.spill)
+
+
+    def _put(self, item):
+        if self.spill:
+            # Keep replies in order while anything is spilled
+            self._spill(item)
+            return
+
+        if self.capacity and len(self.queue) >= self.capacity and item.key == 'DATA':
+            if self.policy == 'drop-oldest':
+                for i, queued in enumerate(self.queue):
+                    if queued.key == 'DATA':
+                        del self.queue[i]
+                        self._drop(queued, self.dropped)
+                        break
+            elif self.policy == 'drop-newest':
+                self._drop(item, self.dropped)
+                return
+            elif self.policy == 'spill':
+                self._spill(item)
+                return
+
+        self.queue.append(item)
+
+
+    def _get(self):
+        if not self.queue:
+            self._unspill()
+        item = self.queue.popleft()
+        # Move spilled replies back into memory as space frees up
+        while self.spill and len(self.queue) < self.capacity:
+            self._unspill()
+        return item
+
+
+    def _drop(self, item, counter):
+        for device_name in item.reply['replied_devices']:
+            counter[device_name] += 1
+        if self.on_drop is not None:
+            self.on_drop(item)
+
+
+    def _spill(self, item):
+        if item.key != 'DATA':
+            self.spill.append(item)
+            return
+
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(dir=self.spill_dir)
+        # Spilled data no longer references pooled buffers
+        reply = {key: bytes(value) if isinstance(value, (memoryview, bytearray)) else value
+                 for key, value in item.reply.items() if key != 'frames'}
+        data = pickle.dumps(reply, protocol=pickle.HIGHEST_PROTOCOL)
+        self.spill_file.seek(0, os.SEEK_END)
+        self.spill.append((self.spill_file.tell(), len(data), reply['replied_devices']))
+        self.spill_file.write(data)
+        self._drop(item, self.spilled)
+
+
+    def _unspill(self):
+        entry = self.spill.popleft()
+        if isinstance(entry, rp.ClientReply):
+            self.queue.append(entry)
+        else:
+            offset, length, _ = entry
+            self.spill_file.seek(offset)
+            self.queue.append(rp.ClientReply('DATA', pickle.loads(self.spill_file.read(length))))
+        if not self.spill and self.spill_file is not None:
+            # Everything has been read back: start the spill file again
+            self.spill_file.truncate(0)
+
+
+    def clear(self):
+        """ Discard all queued replies, counting the frames discarded.
+        """
+        with self.mutex:
+            for item in self.queue:
+                if item.key == 'DATA':
+                    self._drop(item, self.cleared)
+            # Spilled replies are counted without reading them back
+            for entry in self.spill:
+                if not isinstance(entry, rp.ClientReply):
+                    for device_name in entry[2]:
+                        self.cleared[device_name] += 1
+            self.queue.clear()
+            self.spill.clear()
+            if self.spill_file is not None:
+                self.spill_file.truncate(0)
+            self.not_full.notify_all()
+
+
+    def counters(self):
+        """ Per-device counts of frames dropped, spilled to disk and cleared.
+        """
+        with self.mutex:
+            return {'dropped': dict(self.dropped), 'spilled': dict(self.spilled), 'cleared': dict(self.cleared)}
@@ -0,0 +1,517 @@
+"""
+02/22, R James
+
+Multi-process acquisition through shared memory. Devices are split into
+groups, each read by its own worker process, which receives every frame
+straight into a ring buffer of its device in shared memory. The coordinator
+(RingSocketClient) hands out numpy views of the ring slots in its replies,
+so frame data is never copied or pickled between processes.
+
+Each ring has one producer (the worker) and one consumer (the coordinator):
+the producer only advances head, after a frame and its metadata are
+written, and the consumer only advances tail, once the frame has been
+released. Both are aligned 8-byte counters on their own cache lines, so
+each is written in one store. A coordinator with nothing to read sets the
+ring's waiting flag and sleeps on the worker event pipes; publishing a frame
+and reading the flag, and setting the flag and looking for frames, are each
+done holding the ring's lock, so either the coordinator sees the frame or
+the worker sees the flag and wakes it, and no wakeup is lost. The lock is
+taken once per frame by the producer, and only before sleeping by the
+consumer.
+
+Other processes can attach to the ring of a device in a live run with
+SharedFrameRing.attach(name, n_slots, frame_size), with its name from
+RingSocketClient.ring_names, and look at frames with peek(), without
+copying them and without disturbing the coordinator.
+"""
+
+import multiprocessing
+import queue
+import select
+import socket
+import threading
+import time
+from multiprocessing import shared_memory
+import numpy as np
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+# Control block: head, tail, waiting flag and dropped frames, each on its own 64-byte cache line
+_HEAD, _TAIL, _WAITING, _DROPPED = 0, 8, 16, 24
+_CONTROL_SIZE = 256
+# Metadata of each slot: host receive time (ns), offset of the kept part of channel 1 (bytes), whether channel 2 is kept
+_META_FIELDS = 3
+
+
+@export
+class SharedFrameRing:
+    """ Ring of n_slots frames of frame_size bytes in shared memory, with one
+        producer and one consumer (see the module docstring). Frames are
+        numbered from 0 in the order written: frame n is in slot
+        n % n_slots.
+
+        Producer:   reserve() a slot, receive into it, publish() it
+        Consumer:   read() the next frame, release() it once consumed, in
+                    any order, and wait() before sleeping when there is none
+        Observers:  peek() at frames still held
+
+        The producer and consumer share lock (a multiprocessing.Lock, made
+        for a created ring if not given), which observers do not need.
+    """
+    def __init__(self, n_slots, frame_size, name=None, create=True, lock=None):
+        self.n_slots = n_slots
+        self.frame_size = frame_size
+        self.lock = multiprocessing.Lock() if lock is None and create else lock
+        meta_size = n_slots * _META_FIELDS * 8
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=_CONTROL_SIZE + meta_size + n_slots * frame_size)
+        self.name = self.shm.name
+        self.created = create
+        self.control = np.ndarray(_CONTROL_SIZE // 8, dtype=np.uint64, buffer=self.shm.buf)
+        self.meta = np.ndarray((n_slots, _META_FIELDS), dtype=np.int64, buffer=self.shm.buf, offset=_CONTROL_SIZE)
+        self.frames = np.ndarray((n_slots, frame_size), dtype=np.uint8, buffer=self.shm.buf, offset=_CONTROL_SIZE + meta_size)
+        if create:
+            self.control[:] = 0
+        # Consumer side: next frame to read, and frames released ahead of tail
+        self.next_read = int(self.control[_TAIL])
+        self.released = set()
+
+
+    @classmethod
+    def attach(cls, name, n_slots, frame_size, lock=None):
+        """ Open the existing ring name, e.g. in a worker (with the ring's
+        lock) or observer process.
+        """
+        return cls(n_slots, frame_size, name=name, create=False, lock=lock)
+
+
+    def reserve(self):
+        """ Producer: (frame number, writable memoryview) of the next slot,
+        or None if the ring is full.
+        """
+        head = int(self.control[_HEAD])
+        if head - int(self.control[_TAIL]) >= self.n_slots:
+            return None
+        return head, memoryview(self.frames[head % self.n_slots])
+
+
+    def publish(self, t_ns, ch1_offset=0, has_ch2=True):
+        """ Producer: make the reserved frame available to the consumer.
+        Returns whether the consumer is waiting to be woken.
+        """
+        head = int(self.control[_HEAD])
+        self.meta[head % self.n_slots] = (t_ns, ch1_offset, has_ch2)
+        with self.lock:
+            self.control[_HEAD] = head + 1
+            return bool(self.control[_WAITING])
+
+
+    def drop(self):
+        """ Producer: count a frame discarded because the ring was full.
+        """
+        self.control[_DROPPED] += 1
+
+
+    def available(self):
+        """ Consumer: number of frames published but not yet read.
+        """
+        return int(self.control[_HEAD]) - self.next_read
+
+
+    def read(self):
+        """ Consumer: (frame number, frame view, t_ns, ch1_offset, has_ch2) of
+        the next frame, which stays valid until released.
+        """
+        n = self.next_read
+        self.next_read += 1
+        t_ns, ch1_offset, has_ch2 = self.meta[n % self.n_slots]
+        return n, self.frames[n % self.n_slots], int(t_ns), int(ch1_offset), bool(has_ch2)
+
+
+    def release(self, n):
+        """ Consumer: frame n has been consumed. The producer may reuse slots
+        once every earlier frame has been released too.
+        """
+        self.released.add(n)
+        tail = int(self.control[_TAIL])
+        while tail in self.released:
+            self.released.discard(tail)
+            tail += 1
+        self.control[_TAIL] = tail
+
+
+    def wait(self):
+        """ Consumer: ask to be woken by the next publish(). Returns whether
+        a frame is available already, in which case no wakeup may come.
+        """
+        with self.lock:
+            self.control[_WAITING] = 1
+            return self.available() > 0
+
+
+    def stop_waiting(self):
+        self.control[_WAITING] = 0
+
+
+    def peek(self, n=None):
+        """ Observer: view of frame n (by default the latest published), or
+        None if it is not held. A view stays valid while holds(n).
+        """
+        n = int(self.control[_HEAD]) - 1 if n is None else n
+        if not self.holds(n):
+            return None
+        return self.frames[n % self.n_slots]
+
+
+    def holds(self, n):
+        """ Whether frame n is published and not yet free to be overwritten.
+        """
+        return int(self.control[_TAIL]) <= n < int(self.control[_HEAD])
+
+
+    def fill(self):
+        """ Number of slots in use.
+        """
+        return int(self.control[_HEAD]) - int(self.control[_TAIL])
+
+
+    def dropped(self):
+        return int(self.control[_DROPPED])
+
+
+    def reset(self):
+        """ Empty the ring, with no producer running.
+        """
+        self.control[:] = 0
+        self.next_read = 0
+        self.released = set()
+
+
+    def close(self):
+        """ Detach, and free the shared memory if this ring created it.
+        """
+        self.control = self.meta = self.frames = None
+        self.shm.close()
+        if self.created:
+            self.shm.unlink()
+
+
+
+def _read_group(device_names, addresses, ring_names, ring_locks, n_slots, triggered, trigger_value, header_size, channel_size, sample_dtype, events,
+                stop, connect_timeout_s):
+    """ Worker process entry point: read the devices of one group into their
+    rings until stop (the read end of a pipe) becomes readable. Connection
+    status and errors are sent on events as ('MESSAGE' / 'ERROR',
+    device_name, string); None is sent to wake the coordinator.
+    """
+    frame_size = header_size + 2 * channel_size
+    rings = {}
+    sockets = {}
+    for device_name, address_port, ring_name, ring_lock in zip(device_names, addresses, ring_names, ring_locks):
+        rings[device_name] = SharedFrameRing.attach(ring_name, n_slots, frame_size, ring_lock)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(connect_timeout_s)
+        try:
+            sock.connect(address_port)
+        except OSError as e:
+            events.send(('ERROR', device_name, str(e) + '. Problem device: ' + device_name))
+            sock.close()
+            continue
+        sock.settimeout(None)
+        sockets[sock] = device_name
+        events.send(('MESSAGE', device_name, 'Socket for ' + device_name + ' connected'))
+
+    # Frames that do not fit in a full ring are received here and discarded
+    scratch = memoryview(bytearray(frame_size))
+    try:
+        while sockets and not stop.poll():
+            # Wait on stop too, so that it is seen at once even if the devices stall
+            readable, _, _ = select.select(list(sockets) + [stop], [], [])
+            wake = False
+            for sock in readable:
+                if sock is stop:
+                    continue
+                device_name = sockets[sock]
+                ring = rings[device_name]
+                slot = ring.reserve()
+                frame = scratch if slot is None else slot[1]
+                try:
+                    n_read = 0
+                    while n_read < frame_size:
+                        n_packet = sock.recv_into(frame[n_read:], frame_size - n_read)
+                        if not n_packet:
+                            raise OSError('Empty packet from socket.recv_into()')
+                        n_read += n_packet
+                except OSError as e:
+                    events.send(('ERROR', device_name, str(e) + '. Problem device: ' + device_name))
+                    del sockets[sock]
+                    sock.close()
+                    continue
+                t_ns = time.time_ns()
+                if slot is None:
+                    # The coordinator is behind: the gap shows in the frame indices
+                    ring.drop()
+                    continue
+
+                if not triggered:
+                    wake |= ring.publish(t_ns)
+                    continue
+                start = rp.trigger_start(frame[header_size + channel_size:], trigger_value, sample_dtype)
+                if start is not None:
+                    # Keep everything on channel 1 since the first point the threshold was exceeded
+                    wake |= ring.publish(t_ns, sample_dtype.itemsize * start, False)
+            if wake:
+                events.send(None)
+    finally:
+        for sock in sockets:
+            sock.close()
+        for ring in rings.values():
+            ring.close()
+        events.close()
+
+
+
+@export
+class RingSocketClient(threading.Thread):
+    """ Drop-in alternative to SocketClientThread for many devices: devices
+        are read in groups of group_size by worker processes, into a
+        SharedFrameRing of n_slots frames per device, so receiving is spread
+        over cores without contending for the GIL. This thread gathers the
+        frames into the same DATA replies as SocketClientThread, at most one
+        frame per device each, whose arrays view the rings; frames are
+        handed back with release(). A worker that finds its device's ring
+        full discards the frame, which shows as a gap in the frame indices,
+        and counts it in the rp_ring_dropped metric. Samples are of
+        resolution_bits bits, as SocketClientThread.
+    """
+    def __init__(self, device_names, triggered=False, group_size=8, n_slots=64, reply_q_size=0, overflow='block', spill_dir=None,
+                 metrics=None, connect_timeout_s=5., resolution_bits=16):
+        super(RingSocketClient, self).__init__()
+
+        # Command and reply queues for communicating with the coordinator thread
+        self.cmd_q = rp.CommandQueue()
+        self.reply_q = rp.BoundedReplyQueue(reply_q_size, overflow, spill_dir, on_drop=self.release)
+        # Thread run control
+        self.alive = threading.Event()
+        self.alive.set()
+        self.connected = [False] * len(device_names)
+        self.device_names = device_names
+        self.group_size = group_size
+        self.connect_timeout_s = connect_timeout_s
+        # Buffer reading attributes
+        self.header_size = 60
+        self.channel_size = 32768
+        self.sample_dtype = rp.sample_dtype(resolution_bits)
+        # Triggered or untriggered mode
+        self.triggered = triggered
+        # Triggering value for channel 2 for triggered mode (raw ADC counts, 30000 at 16 bits)
+        self.trigger_value = 30000 >> (16 - resolution_bits)
+        # A ring per device, released into from the consumer and the reply queue
+        self.n_slots = n_slots
+        self.rings = [SharedFrameRing(n_slots, self.header_size + 2 * self.channel_size) for _ in device_names]
+        self.ring_names = {device_name: ring.name for device_name, ring in zip(device_names, self.rings)}
+        self.release_lock = threading.Lock()
+        # Worker processes, their event pipes and the pipe that stops them
+        self.workers = []
+        self.events = []
+        self.stop, self.stop_w = multiprocessing.Pipe(duplex=False)
+        # Metrics
+        self.metrics = rp.metrics() if metrics is None else metrics
+        self.receive_metrics = {device_name: rp.ReceiveMetrics(self.metrics, device_name) for device_name in device_names}
+        for device_name, ring in zip(device_names, self.rings):
+            self.metrics.gauge('rp_ring_fill', lambda ring=ring: ring.fill() if ring.control is not None else 0, device=device_name)
+            self.metrics.gauge('rp_ring_dropped', lambda ring=ring: ring.dropped() if ring.control is not None else 0, device=device_name)
+        # Thread control handlers
+        self.handlers = {
+            'CONNECT': self._handle_CONNECT,
+            'CLOSE': self._handle_CLOSE
+        }
+
+        print('Starting ring readers with ' + str(len(device_names)) + ' devices in groups of ' + str(group_size))
+
+
+    def run(self):
+        """ Thread control function. Waiting for frames is interrupted by
+        commands, so they are handled as soon as they are sent.
+        """
+        while self.alive.isSet():
+            if all(self.connected) and self.connected:
+                self._collect()
+            else:
+                # Don't do anything until a command is sent if all devices not connected
+                select.select([self.cmd_q], [], [])
+            # Commands last, so that the end of the thread is seen before waiting again
+            self._handle_commands()
+        self.cmd_q.close()
+
+
+    def _handle_commands(self):
+        """ Handle every command sent to the thread.
+        """
+        self.cmd_q.clear_wakeups()
+        while True:
+            try:
+                command = self.cmd_q.get(block=False)
+            except queue.Empty:
+                return
+            if command is not None:
+                self.metrics.histogram('rp_command_seconds', command=command.key).observe(time.perf_counter() - command.t_sent)
+                self.handlers[command.key](command)
+
+
+    def join(self, timeout=None):
+        """ Invoking this will end the thread and the workers, and free the
+        rings.
+        """
+        print('Ending ring readers with ' + str(len(self.device_names)) + ' devices')
+
+        self.alive.clear()
+        # Wake the thread to see that it should end
+        self.cmd_q.put(None)
+        threading.Thread.join(self, timeout)
+        self._stop_workers()
+        for ring in self.rings:
+            ring.close()
+
+
+    def _handle_CONNECT(self, client_command):
+        """ Start a worker process for each group of devices, unless already
+        connected. client_command should be an array of (host, port) tuples.
+        """
+        try:
+            assert len(self.device_names) == len(self.connected) == len(client_command.command)
+        except:
+            raise ValueError('All arguments must be of the same length')
+
+        if self.workers:
+            # Workers own their groups' sockets: connect again only after CLOSE
+            for device_name in self.device_names:
+                self.reply_q.put(rp.ClientReply('MESSAGE', 'Socket for ' + device_name + ' already connected'))
+            return
+
+        for ring in self.rings:
+            ring.reset()
+        for start in range(0, len(self.device_names), self.group_size):
+            group = slice(start, start + self.group_size)
+            events, events_w = multiprocessing.Pipe(duplex=False)
+            args = (self.device_names[group], [tuple(address) for address in client_command.command[group]],
+                    [ring.name for ring in self.rings[group]], [ring.lock for ring in self.rings[group]], self.n_slots, self.triggered, self.trigger_value,
+                    self.header_size, self.channel_size, self.sample_dtype, events_w, self.stop, self.connect_timeout_s)
+            worker = multiprocessing.Process(target=_read_group, args=args, daemon=True)
+            worker.start()
+            events_w.close()
+            self.workers.append(worker)
+            self.events.append(events)
+
+        # Each worker reports whether each of its devices connected
+        starting = set(self.device_names)
+        while starting:
+            for events in select.select(self.events, [], [])[0]:
+                event = self._event(events)
+                if event is not None:
+                    starting.discard(event[1])
+
+
+    def _event(self, events):
+        """ Handle an event from a worker: a status reply is passed on.
+        """
+        try:
+            event = events.recv()
+        except EOFError:
+            # The worker has ended
+            self.events.remove(events)
+            return None
+        if event is not None:
+            self.connected[self.device_names.index(event[1])] = (event[0] == 'MESSAGE')
+            self.reply_q.put(rp.ClientReply(event[0], event[2]))
+        return event
+
+
+    def _collect(self):
+        """ Gather the next frame of each device with one waiting into a
+        single DATA reply, waiting for frames if there are none.
+        """
+        # Errors are passed on at once, even while other devices keep sending frames
+        for events in list(self.events):
+            while events in self.events and events.poll():
+                self._event(events)
+
+        ready = [i for i, ring in enumerate(self.rings) if ring.available()]
+        if not ready:
+            # Ask the workers to wake this thread, unless a frame came in meanwhile
+            if not any(ring.wait() for ring in self.rings):
+                select.select(self.events + [self.cmd_q], [], [])
+            for ring in self.rings:
+                ring.stop_waiting()
+            return
+
+        reply = {}
+        replied = []
+        frames = []
+        t_ns = None
+        for i in ready:
+            device_name = self.device_names[i]
+            n, frame, t_ns_frame, ch1_offset, has_ch2 = self.rings[i].read()
+            frames.append((i, n))
+            replied.append(device_name)
+            self.receive_metrics[device_name].record(self.header_size + 2 * self.channel_size)
+            view = memoryview(frame)
+            ch1_start = self.header_size + ch1_offset
+            reply.update({device_name + '_header': rp.parse_header(view[:self.header_size])})
+            reply.update({device_name + '_ch1': view[ch1_start:self.header_size + self.channel_size]})
+            if has_ch2:
+                reply.update({device_name + '_ch2': view[self.header_size + self.channel_size:]})
+            t_ns = t_ns_frame if t_ns is None else max(t_ns, t_ns_frame)
+
+        # Store the names of all devices that replied, the latest frame timestamp, and the ring frames to release, in the reply
+        reply.update({'replied_devices': replied})
+        reply.update({'timestamp': t_ns})
+        reply.update({'frames': frames})
+        self.reply_q.put(rp.ClientReply('DATA', reply), block=True)
+
+
+    def _stop_workers(self, timeout=2.):
+        """ Stop and join all worker processes.
+        """
+        self.stop_w.send_bytes(b'stop')
+        t_end = time.time() + timeout
+        for worker in self.workers:
+            worker.join(max(0., t_end - time.time()))
+            if worker.is_alive():
+                worker.terminate()
+        for events in self.events:
+            events.close()
+        self.workers = []
+        self.events = []
+        self.connected = [False] * len(self.device_names)
+        while self.stop.poll():
+            self.stop.recv_bytes()
+
+
+    def _handle_CLOSE(self, client_command):
+        """ Stop all worker processes, closing their sockets.
+        """
+        devices_closed = ''
+        for i in range(len(self.device_names)):
+            if self.connected[i]:
+                devices_closed += (self.device_names[i] + ', ')
+        self._stop_workers()
+        self.clear_replies()
+        self.reply_q.put(rp.ClientReply('MESSAGE', 'Sockets closed for: ' + devices_closed))
+
+
+    def release(self, client_reply):
+        """ Hand the ring frames referenced by a DATA reply back to their
+        workers.
+        """
+        if client_reply.key == 'DATA':
+            with self.release_lock:
+                for i, n in client_reply.reply.pop('frames', []):
+                    self.rings[i].release(n)
+
+
+    def clear_replies(self):
+        """ Discard all queued replies, releasing the ring frames they hold.
+        """
+        self.reply_q.clear()
@@ -0,0 +1,364 @@
+"""
+02/22, R James
+
+Local stand-in for Red Pitaya streaming servers, for testing and benchmarking
+without hardware. Each simulated device listens on its own loopback address
+(devices are identified by peer address) and streams frames of a 60-byte
+header (see header.py) followed by 32768-byte channel 1 and channel 2 blocks
+of int16 samples, or int8 samples at 8-bit resolution.
+StreamingManagerSimulator stands in for the web interface through which the
+streaming_manager app is started and configured (see control.py).
+"""
+
+import base64
+import hashlib
+import http.server
+import json
+import multiprocessing
+import select
+import socket
+import struct
+import threading
+import time
+import numpy as np
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+def _frame_bank(waveform, n_frames, channel_size, noise_sigma, trigger_value, pulse_probability, rng, resolution_bits=16):
+    """ Pregenerate n_frames frames (header space left empty) to cycle through,
+    so that generating samples does not limit the streaming rate. Waveforms
+    are in 16-bit ADC counts, scaled down for 8-bit samples.
+    """
+    sample_dtype = rp.sample_dtype(resolution_bits)
+    n_samples = channel_size // sample_dtype.itemsize
+    ch1 = rng.normal(0., noise_sigma, (n_frames, n_samples))
+    ch2 = rng.normal(0., noise_sigma, (n_frames, n_samples))
+
+    if waveform == 'sine':
+        phase = 2. * np.pi * np.arange(n_frames * n_samples).reshape(n_frames, n_samples) / 1000.
+        ch1 += 0.5 * trigger_value * np.sin(phase)
+        ch2 += 0.5 * trigger_value * np.cos(phase)
+    elif waveform == 'pulses':
+        # Exponentially decaying pulses, crossing trigger_value on channel 2, correlated on channel 1
+        shape = np.exp(-np.arange(256) / 40.)
+        for i in np.flatnonzero(rng.random(n_frames) < pulse_probability):
+            start = rng.integers(0, n_samples - len(shape))
+            amplitude = rng.uniform(trigger_value + 500, 32000)
+            ch2[i, start:start + len(shape)] += amplitude * shape
+            ch1[i, start:start + len(shape)] += 0.5 * amplitude * shape
+    elif waveform != 'noise':
+        raise ValueError("waveform must be 'noise', 'pulses' or 'sine'")
+
+    header_size = rp.HEADER_DTYPE.itemsize
+    frames = np.zeros((n_frames, header_size + 2 * channel_size), dtype=np.uint8)
+    scale = 2. ** (resolution_bits - 16)
+    limits = np.iinfo(sample_dtype)
+    frames[:, header_size:header_size + channel_size] = np.clip(ch1 * scale, limits.min, limits.max).astype(sample_dtype).view(np.uint8)
+    frames[:, header_size + channel_size:] = np.clip(ch2 * scale, limits.min, limits.max).astype(sample_dtype).view(np.uint8)
+    return frames
+
+
+def _serve_device(index, server, config, stop, frames_sent, frames_dropped, disconnects):
+    """ Serve one simulated device: accept a connection, stream frames until
+    the client goes away, stop is set or the configured disconnect time is
+    reached, then accept again.
+    """
+    channel_size = config['channel_size']
+    resolution_bits = config['resolution_bits']
+    n_samples = channel_size // rp.sample_dtype(resolution_bits).itemsize
+    sample_rate = config['sample_rate']
+    frame_period_s = 0. if sample_rate is None else n_samples / sample_rate
+    pulse_probability = min(1., config['pulse_rate_Hz'] * n_samples / (sample_rate or 125e6))
+    rng = np.random.default_rng(None if config['seed'] is None else config['seed'] + index)
+    bank = _frame_bank(config['waveform'], config['n_bank_frames'], channel_size, config['noise_sigma'],
+                       config['trigger_value'], pulse_probability, rng, resolution_bits)
+
+    frame_index = 0
+    while not stop.is_set():
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+
+        # Give up on a client that stops reading altogether, so that stop is still honoured
+        conn.settimeout(5.)
+        lost = 0
+        t_connect = time.perf_counter()
+        t_next = t_connect
+        try:
+            while not stop.is_set():
+                if config['disconnect_every_s'] is not None and time.perf_counter() - t_connect > config['disconnect_every_s']:
+                    disconnects[index] += 1
+                    break
+
+                if frame_period_s:
+                    t_send = t_next + (abs(rng.normal(0., config['jitter_s'])) if config['jitter_s'] else 0.)
+                    t_next += frame_period_s
+                    delay_s = t_send - time.perf_counter()
+                    if delay_s > 0:
+                        time.sleep(delay_s)
+                    # Like the hardware, drop the frame if the client is not keeping up
+                    _, writable, _ = select.select([], [conn], [], 0)
+                    if not writable:
+                        frames_dropped[index] += 1
+                        lost += n_samples
+                        continue
+
+                frame = bank[frame_index % len(bank)]
+                rp.pack_header(frame, frame_index, lost, int(sample_rate or 0), resolution_bits, 0, channel_size, channel_size)
+                conn.sendall(frame)
+                frames_sent[index] += 1
+                frame_index += 1
+                lost = 0
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    server.close()
+
+
+def _serve(addresses, config, stop, ready, frames_sent, frames_dropped, disconnects):
+    servers = []
+    for address_port in addresses:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(address_port)
+        server.listen(1)
+        server.settimeout(0.1)
+        servers.append(server)
+    ready.set()
+
+    threads = [threading.Thread(target=_serve_device, args=(i, server, config, stop, frames_sent, frames_dropped, disconnects), daemon=True)
+               for i, server in enumerate(servers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+@export
+class RPStreamSimulator:
+    """ Simulated Red Pitaya streaming servers for n_devices boards, served from
+        a separate process on 127.0.0.(i + 1):(base_port + i).
+
+        sample_rate:        samples/s per channel (None: as fast as possible)
+        waveform:           'noise', 'pulses' (channel 2 crosses trigger_value
+                            pulse_rate_Hz times per second) or 'sine'
+        jitter_s:           standard deviation of the delay added to each frame
+        disconnect_every_s: drop the connection after this long (None: never)
+        resolution_bits:    bits per sample, 8 or 16 (trigger_value and
+                            noise_sigma are in 16-bit ADC counts regardless)
+
+        frames_sent(), frames_dropped() and disconnects() give per-device
+        counters; a frame is dropped when the client is not keeping up.
+    """
+    def __init__(self, n_devices=1, base_port=8900, sample_rate=None, waveform='noise', noise_sigma=100.,
+                 trigger_value=30000, pulse_rate_Hz=100., jitter_s=0., disconnect_every_s=None, seed=None,
+                 channel_size=32768, n_bank_frames=64, resolution_bits=16):
+        self.addresses = [('127.0.0.' + str(i + 1), base_port + i) for i in range(n_devices)]
+        self.config = {'sample_rate': sample_rate, 'waveform': waveform, 'noise_sigma': noise_sigma,
+                       'trigger_value': trigger_value, 'pulse_rate_Hz': pulse_rate_Hz, 'jitter_s': jitter_s,
+                       'disconnect_every_s': disconnect_every_s, 'seed': seed, 'channel_size': channel_size,
+                       'n_bank_frames': n_bank_frames, 'resolution_bits': resolution_bits}
+        self.stop_event = multiprocessing.Event()
+        self.ready_event = multiprocessing.Event()
+        self._frames_sent = multiprocessing.Array('q', n_devices, lock=False)
+        self._frames_dropped = multiprocessing.Array('q', n_devices, lock=False)
+        self._disconnects = multiprocessing.Array('q', n_devices, lock=False)
+        self.process = None
+
+
+    def start(self):
+        """ Start serving, and wait until the servers are listening.
+        """
+        self.stop_event.clear()
+        self.ready_event.clear()
+        self.process = multiprocessing.Process(target=_serve, args=(self.addresses, self.config, self.stop_event, self.ready_event,
+                                               self._frames_sent, self._frames_dropped, self._disconnects), daemon=True)
+        self.process.start()
+        if not self.ready_event.wait(10.):
+            self.stop()
+            raise OSError('Simulated streaming servers failed to start')
+        return self
+
+
+    def stop(self):
+        """ Stop serving and close all connections.
+        """
+        self.stop_event.set()
+        if self.process is not None:
+            self.process.join(5.)
+            self.process = None
+
+
+    def frames_sent(self):
+        return list(self._frames_sent)
+
+
+    def frames_dropped(self):
+        return list(self._frames_dropped)
+
+
+    def disconnects(self):
+        return list(self._disconnects)
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+
+# Key from which a websocket handshake accept is derived (RFC 6455)
+_WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def _receive_exactly(conn, n):
+    data = b''
+    while len(data) < n:
+        packet = conn.recv(n - len(data))
+        if not packet:
+            raise OSError('Connection closed')
+        data += packet
+    return data
+
+
+def _read_websocket_message(conn):
+    """ Payload and opcode of the next frame from a websocket client (whose
+    frames are masked).
+    """
+    first, second = _receive_exactly(conn, 2)
+    length = second & 0x7f
+    if length == 126:
+        length = struct.unpack('>H', _receive_exactly(conn, 2))[0]
+    elif length == 127:
+        length = struct.unpack('>Q', _receive_exactly(conn, 8))[0]
+    mask = _receive_exactly(conn, 4) if second & 0x80 else b'\0\0\0\0'
+    payload = np.frombuffer(_receive_exactly(conn, length), dtype=np.uint8)
+    payload = payload ^ np.resize(np.frombuffer(mask, dtype=np.uint8), length)
+    return first & 0x0f, payload.tobytes()
+
+
+def _send_websocket_message(conn, payload, opcode=1):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('>BB', 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack('>BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+    conn.sendall(header + payload)
+
+
+
+@export
+class StreamingManagerSimulator:
+    """ Simulated web interfaces of n_devices boards, for StreamingControl:
+        each serves the streaming_manager app start over HTTP and its
+        parameters over a websocket, from threads of this process, on
+        127.0.0.(i + 1):(base_port + i). Every reply is delayed by delay_s,
+        as if from a board over a network.
+
+        hosts gives the host of each device, parameters its current SS_*
+        parameters and app_started whether its app has been started.
+    """
+    default_parameters = {'SS_RESOLUTION': 2, 'SS_RATE': 1, 'SS_CHANNEL': 3, 'SS_START': 0, 'SS_PROTOCOL': 1, 'SS_USE_FILE': 0}
+
+    def __init__(self, n_devices=1, base_port=8080, delay_s=0.):
+        self.addresses = [('127.0.0.' + str(i + 1), base_port + i) for i in range(n_devices)]
+        self.hosts = [address + ':' + str(port) for address, port in self.addresses]
+        self.delay_s = delay_s
+        self.parameters = [dict(self.default_parameters) for _ in range(n_devices)]
+        self.app_started = [False] * n_devices
+        self.servers = []
+        self.threads = []
+
+
+    def _handler(self, index):
+        simulator = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(simulator.delay_s)
+                if self.path.startswith('/bazaar?start=streaming_manager'):
+                    simulator.app_started[index] = True
+                    body = json.dumps({'status': 'OK'}).encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                elif self.path == '/wss' and self.headers.get('Upgrade', '').lower() == 'websocket':
+                    accept = base64.b64encode(hashlib.sha1((self.headers['Sec-WebSocket-Key'] + _WEBSOCKET_GUID).encode()).digest())
+                    self.send_response(101)
+                    self.send_header('Upgrade', 'websocket')
+                    self.send_header('Connection', 'Upgrade')
+                    self.send_header('Sec-WebSocket-Accept', accept.decode())
+                    self.end_headers()
+                    self.wfile.flush()
+                    self._serve_websocket()
+                else:
+                    self.send_error(404)
+
+            def _serve_websocket(self):
+                try:
+                    while True:
+                        opcode, payload = _read_websocket_message(self.connection)
+                        if opcode == 8:
+                            _send_websocket_message(self.connection, b'', 8)
+                            return
+                        if opcode == 9:
+                            _send_websocket_message(self.connection, payload, 10)
+                            continue
+                        parameters = json.loads(payload.decode()).get('parameters', {})
+                        command = parameters.pop('in_command', {}).get('value')
+                        for name, value in parameters.items():
+                            simulator.parameters[index][name] = value['value']
+                        if command == 'send_all_params':
+                            time.sleep(simulator.delay_s)
+                            reply = {'parameters': {name: {'value': value} for name, value in simulator.parameters[index].items()}}
+                            _send_websocket_message(self.connection, json.dumps(reply).encode())
+                except OSError:
+                    pass
+                finally:
+                    self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+    def start(self):
+        for i, address_port in enumerate(self.addresses):
+            server = http.server.ThreadingHTTPServer(address_port, self._handler(i))
+            server.daemon_threads = True
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self.servers.append(server)
+            self.threads.append(thread)
+        return self
+
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        for thread in self.threads:
+            thread.join()
+        self.servers = []
+        self.threads = []
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *args):
+        self.stop()
@@ -4,12 +4,15 @@
 Adapted from script by https://github.com/awmlee
 """
 
+import errno
+import os
 import socket
 import threading
 import queue
 import numpy as np
 import time
 import select
+import collections
 
 import PyRPStream as rp
 export, __all__ = rp.exporter()
@@ -22,11 +25,64 @@ class ClientCommand:
 
         'CONNECT':    (host, port) tuple
         'RECEIVE':    None
+        'PAUSE':      None: stop receiving, staying connected
+        'RESUME':     None: receive again after PAUSE
         'CLOSE':      None
+        'START':      None: (ReplayClient) start the replay from the beginning
+
+        t_sent is the time (time.perf_counter) the command was made, from
+        which the client measures how long commands wait to be handled.
     """
     def __init__(self, key, command=None):
         self.key = key
         self.command = command
+        self.t_sent = time.perf_counter()
+
+
+
+@export
+class CommandQueue(queue.Queue):
+    """ Command queue that wakes the thread it commands: each put() makes the
+        read end of a socket pair (fileno()) readable, so the thread can wait
+        in select on its sockets and its commands at once, and calls
+        on_put, if set. A put() of None only wakes the thread.
+    """
+    def __init__(self):
+        super(CommandQueue, self).__init__()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.on_put = None
+
+
+    def _put(self, item):
+        super(CommandQueue, self)._put(item)
+        try:
+            self.wakeup_w.send(b'\0')
+        except BlockingIOError:
+            # Already woken many times over
+            pass
+        if self.on_put is not None:
+            self.on_put()
+
+
+    def fileno(self):
+        return self.wakeup_r.fileno()
+
+
+    def clear_wakeups(self):
+        """ Consume pending wakeups, before taking the commands that caused them.
+        """
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+    def close(self):
+        self.wakeup_r.close()
+        self.wakeup_w.close()
 
 
 
@@ -39,6 +95,10 @@ class ClientReply:
         'DATA':       Depends on the command - for RECEIVE it's the received
                       data string, for others None
         'MESSAGE':    Status message
+        'LOST':       (device name, error string) of a device lost while
+                      streaming, which is being reconnected
+        'END':        Status message: (ReplayClient) every recording has
+                      been replayed, so no more DATA will follow
     """
     def __init__(self, key, reply=None):
         self.key = key
@@ -46,39 +106,164 @@ class ClientReply:
 
 
 
+@export
+def trigger_start(ch2_bytes, trigger_value, dtype=np.int16):
+    """ Index of the first channel 2 sample (of dtype, int8 or int16) above
+    trigger_value, or None if the threshold was not exceeded in this frame.
+    Frames may trigger any number of times: see EventBuilder for event
+    records with pre-trigger samples.
+    """
+    # Find the first point in channnel 2 where the acquisition trigger threshold has been exceeded
+    above = np.frombuffer(ch2_bytes, dtype=dtype) > trigger_value
+    start = int(np.argmax(above))
+    return start if above[start] else None
+
+
+
+@export
+class FramePool:
+    """ Preallocated, reusable receive buffers for the zero-copy receive path.
+        Each frame holds the header and both channel blocks contiguously, so a
+        whole frame is filled by recv_into without intermediate copies. If all
+        frames are in use (consumer behind), a temporary frame is allocated
+        instead and counted in misses.
+    """
+    def __init__(self, n_frames, header_size, channel_size):
+        self.header_size = header_size
+        self.channel_size = channel_size
+        self.frame_size = header_size + 2 * channel_size
+        self.buffer = np.empty((n_frames, self.frame_size), dtype=np.uint8)
+        # deque append/popleft are thread-safe, no lock needed between socket thread and consumer
+        self.free = collections.deque(range(n_frames))
+        self.misses = 0
+
+
+    def get(self):
+        """ Returns (index, memoryview) for a free frame. index is None for
+        a temporary frame.
+        """
+        try:
+            index = self.free.popleft()
+            return index, memoryview(self.buffer[index])
+        except IndexError:
+            self.misses += 1
+            return None, memoryview(bytearray(self.frame_size))
+
+
+    def release(self, index):
+        """ Return a frame to the pool once its data has been consumed.
+        """
+        if index is not None:
+            self.free.append(index)
+
+
+    def reset(self):
+        """ Mark all frames as free.
+        """
+        self.free = collections.deque(range(len(self.buffer)))
+
+
+    def split(self, frame):
+        """ Split a frame into (header, ch1, ch2) memoryviews without copying.
+        """
+        ch1_start = self.header_size
+        ch2_start = self.header_size + self.channel_size
+        return frame[:ch1_start], frame[ch1_start:ch2_start], frame[ch2_start:]
+
+
+
+@export
+class ReconnectPolicy:
+    """ Reconnection of a device lost while streaming: the first attempt is
+        made initial_s after the loss, and each failure delays the next by
+        factor times longer, up to max_s, until max_attempts attempts (or
+        forever, if None) have failed.
+    """
+    def __init__(self, initial_s=0.5, factor=2., max_s=30., max_attempts=None):
+        self.initial_s = initial_s
+        self.factor = factor
+        self.max_s = max_s
+        self.max_attempts = max_attempts
+
+
+    def delay_s(self, attempt):
+        """ Delay before attempt (counting from 0).
+        """
+        return min(self.initial_s * self.factor ** attempt, self.max_s)
+
+
+
 @export
 class SocketClientThread(threading.Thread):
     """ Implements the threading (run, join, etc.): the thread can be
         controlled via the cmd_q queue attribute. Replies are placed in
         the reply_q queue attribute.
+
+        With zero_copy=True, frames are received with recv_into into a
+        FramePool and DATA replies hold memoryviews into the pool: the
+        consumer must hand each reply back via release() once done with it.
+
+        reply_q holds at most reply_q_size replies (unbounded if 0), with
+        overflow handled by the BoundedReplyQueue policy.
+
+        Frames and bytes received, receive times and select wakeups are
+        recorded in metrics (a MetricsRegistry, by default rp.metrics()).
+
+        Devices are connected in parallel, with non-blocking connects each
+        given connect_timeout_s. With a ReconnectPolicy reconnect, a device
+        lost while streaming is reported with a LOST reply and reconnected
+        in the background, with a new socket, while the others keep
+        streaming; without, an ERROR reply is sent.
+
+        Devices stream samples of resolution_bits (8 or 16) bits: channel
+        blocks are channel_size bytes either way, so 8-bit frames hold
+        twice the samples.
     """
-    def __init__(self, device_names, triggered=False):
+    def __init__(self, device_names, triggered=False, zero_copy=False, n_buffers=64, reply_q_size=0, overflow='block', spill_dir=None,
+                 metrics=None, connect_timeout_s=5., reconnect=None, resolution_bits=16):
         super(SocketClientThread, self).__init__()
 
         # Command and reply queues for communicating with the socket thread
-        self.cmd_q = queue.Queue()
-        self.reply_q = queue.Queue()
+        self.cmd_q = CommandQueue()
+        self.reply_q = rp.BoundedReplyQueue(reply_q_size, overflow, spill_dir, on_drop=self.release)
         # Thread run control
         self.alive = threading.Event()
         self.alive.set()
+        self.paused = False
         # Socket connection attributes
         self.sockets = [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(len(device_names))]
         self.connected = [False] * len(device_names)
         self.device_names = device_names
         self.name_address_dict = {}
+        self.socket_names = {}
+        self.addresses = [None] * len(device_names)
+        self.connect_timeout_s = connect_timeout_s
+        # Reconnection: whether all devices have connected since the last CLOSE, and the state of each device being reconnected
+        self.reconnect = reconnect
+        self.started = False
+        self.reconnecting = {}
         # Buffer reading attributes
         self.header_size = 60
         self.channel_size = 32768
+        self.sample_dtype = rp.sample_dtype(resolution_bits)
         # Triggered or untriggered mode
         self.triggered = triggered
-        self.has_triggered = {}
-        # Triggering value for channel 2 for triggered mode (raw ADC counts)
-        self.trigger_value = 30000
+        # Triggering value for channel 2 for triggered mode (raw ADC counts, 30000 at 16 bits)
+        self.trigger_value = 30000 >> (16 - resolution_bits)
+        # Zero-copy receive mode: n_buffers reusable frames per device
+        self.zero_copy = zero_copy
+        self.frame_pool = FramePool(n_buffers * len(device_names), self.header_size, self.channel_size) if zero_copy else None
+        # Metrics
+        self.metrics = rp.metrics() if metrics is None else metrics
+        self.receive_metrics = {device_name: rp.ReceiveMetrics(self.metrics, device_name) for device_name in device_names}
+        self.select_wakeups = self.metrics.counter('rp_select_wakeups')
         # Thread control handlers
         self.handlers = {
             'CONNECT': self._handle_CONNECT,
             'RECEIVE': self._handle_RECEIVE,
             'RECEIVE_TRIGGERED': self._handle_RECEIVE_TRIGGERED,
+            'PAUSE': self._handle_PAUSE,
+            'RESUME': self._handle_RESUME,
             'CLOSE': self._handle_CLOSE
         }
 
@@ -86,26 +271,45 @@ class SocketClientThread(threading.Thread):
 
 
     def run(self):
-        """ Thread control function.
+        """ Thread control function. Receiving waits in select on the sockets
+        and cmd_q together, so commands are handled as soon as they are
+        sent, between frames.
         """
         while self.alive.isSet():
-            if all(self.connected) and self.connected:
+            if self._streaming():
                 # Default is to RECEIVE (triggered or untriggered)
                 if self.triggered:
-                    command = ClientCommand('RECEIVE_TRIGGERED')
+                    self._handle_RECEIVE_TRIGGERED(None)
                 else:
-                    command = ClientCommand('RECEIVE')
-                self.handlers[command.key](command)
+                    self._handle_RECEIVE(None)
             else:
-                # Don't do anything if all devices not connected
-                time.sleep(0.1)
+                # Don't do anything until a command is sent if all devices not connected
+                select.select([self.cmd_q], [], [])
+            self._handle_commands()
+        self.cmd_q.close()
+
+
+    def _streaming(self):
+        if self.paused or not self.connected:
+            return False
+        if self.reconnect is None:
+            return all(self.connected)
+        # Keep streaming from the other devices while any are reconnected
+        return self.started
+
+
+    def _handle_commands(self):
+        """ Handle every command sent to the thread.
+        """
+        self.cmd_q.clear_wakeups()
+        while True:
             try:
-                # Check if any commands have been sent to the thread
                 command = self.cmd_q.get(block=False)
-                self.handlers[command.key](command)
             except queue.Empty:
-                # Do nothing if no commands sent
-                continue
+                return
+            if command is not None:
+                self.metrics.histogram('rp_command_seconds', command=command.key).observe(time.perf_counter() - command.t_sent)
+                self.handlers[command.key](command)
 
 
     def join(self, timeout=None):
@@ -114,59 +318,112 @@ class SocketClientThread(threading.Thread):
         print('Ending socket thread with ' + str(len(self.sockets)) + ' devices')
 
         self.alive.clear()
+        # Wake the thread to see that it should end
+        self.cmd_q.put(None)
         threading.Thread.join(self, timeout)
 
 
     def _handle_CONNECT(self, client_command):
         """ Attempt to connect to the sockets, if not already connected
-        client_command should be an array of (host, port) tuples.
+        client_command should be an array of (host, port) tuples. All
+        connects are made at once, and each device replies once connected,
+        or once it fails or connect_timeout_s passes.
         """
         try:
             assert len(self.device_names) == len(self.sockets) == len(self.connected) == len(client_command.command)
         except:
             raise ValueError('All arguments must be of the same length')
+        self.addresses = [(address[0], address[1]) for address in client_command.command]
+
+        pending = {}
         for i in range(len(self.device_names)):
+            if self.connected[i]:
+                # We are already connected, do nothing
+                self.reply_q.put(self._message_reply('Socket for ' + self.device_names[i] +  ' already connected'))
+                continue
             try:
-                if not self.connected[i]:
-                    # Attempt to connect if not already connected
-                    self.sockets[i].connect((client_command.command[i][0], client_command.command[i][1]))
-                    self.reply_q.put(self._message_reply('Socket for ' + self.device_names[i] +  ' connected'))
-                    self.connected[i] = True
-                    self.name_address_dict[self.sockets[i].getpeername()[0]] = self.device_names[i]
-                    self.has_triggered[self.device_names[i]] = False
-                else:
-                    # We are already connected, do nothing
-                    self.reply_q.put(self._message_reply('Socket for ' + self.device_names[i] +  ' already connected'))
+                self._start_connect(i)
+                pending[self.sockets[i]] = i
             except OSError as e:
                 # Return error if we can't connect
                 self.reply_q.put(self._error_reply(str(e) + '. Problem device: ' + self.device_names[i]))
-                self.connected[i] = False
+
+        t_end = time.monotonic() + self.connect_timeout_s
+        while pending:
+            remaining_s = t_end - time.monotonic()
+            writable = select.select([], list(pending), [], remaining_s)[1] if remaining_s > 0 else []
+            if not writable and remaining_s <= 0:
+                for sock, i in pending.items():
+                    sock.close()
+                    self.reply_q.put(self._error_reply('Connection timed out. Problem device: ' + self.device_names[i]))
+                break
+            for sock in writable:
+                i = pending.pop(sock)
+                try:
+                    self._finish_connect(i)
+                    self.reply_q.put(self._message_reply('Socket for ' + self.device_names[i] +  ' connected'))
+                except OSError as e:
+                    sock.close()
+                    self.reply_q.put(self._error_reply(str(e) + '. Problem device: ' + self.device_names[i]))
+        self.started = all(self.connected)
+
+
+    def _start_connect(self, i):
+        """ Start a non-blocking connect to device i, with a new socket.
+        """
+        self.sockets[i].close()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        self.sockets[i] = sock
+        error = sock.connect_ex(self.addresses[i])
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise OSError(error, os.strerror(error))
+
+
+    def _finish_connect(self, i):
+        """ Complete the connect to device i, once its socket is writable.
+        """
+        sock = self.sockets[i]
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise OSError(error, os.strerror(error))
+        sock.setblocking(True)
+        self.connected[i] = True
+        self.socket_names[sock] = self.device_names[i]
+        self.name_address_dict[sock.getpeername()[0]] = self.device_names[i]
 
 
     def _handle_RECEIVE(self, client_command):
-        """ Read from the socket: discard the header information, then send
-        data from channel 1 and channel 2 to the reply queue.
+        """ Read from the socket: send the decoded header, and data from
+        channel 1 and channel 2, to the reply queue.
         """
+        frames = []
         try:
             reply = {}
             replied = []
 
-            socks, _, _ = select.select(self.sockets, [], [])
+            socks = self._select()
             # Receieve from each socket when it becomes available
             for sock in socks:
-                # Take the header information from the socket, then discard
-                header_bytes = self._receieve_bytes(self.header_size, sock)
+                device_name = self.socket_names[sock]
+                frame = self._receive_frame(sock)
+                if frame is None:
+                    continue
+                index, header_bytes, ch1_bytes, ch2_bytes = frame
+                frames.append(index)
 
-                # Store name of device socket is associated with
-                replied.append(self.name_address_dict[sock.getpeername()[0]])
+                # Store name of device socket is associated with
+                replied.append(device_name)
 
-                # Take channel 1 data from the socket, store in reply
-                ch1_bytes = self._receieve_bytes(self.channel_size, sock)
-                reply.update({self.name_address_dict[sock.getpeername()[0]] + '_ch1': ch1_bytes})
+                # Store the decoded header, and channel 1 and channel 2 data, in reply
+                reply.update({device_name + '_header': rp.parse_header(header_bytes)})
+                reply.update({device_name + '_ch1': ch1_bytes})
+                reply.update({device_name + '_ch2': ch2_bytes})
 
-                # Take channel 2 data from the socket, store in reply
-                ch2_bytes = self._receieve_bytes(self.channel_size, sock)
-                reply.update({self.name_address_dict[sock.getpeername()[0]] + '_ch2': ch2_bytes})
+            if not replied:
+                # Woken by a command or a reconnect, or only lost devices were readable
+                return
 
             # Store the names of all sockets that replied in the reply
             reply.update({'replied_devices': replied})
@@ -174,43 +431,52 @@ class SocketClientThread(threading.Thread):
             # Store the timestamp in the reply
             reply.update({'timestamp': time.time_ns()})
 
+            if self.zero_copy:
+                # Pool frames referenced by this reply, returned by release()
+                reply.update({'frames': frames})
+
             # Put reply in the reply queue
             self.reply_q.put(self._data_reply(reply), block=True)
 
         except OSError as e:
+            self._release_frames(frames)
             self.reply_q.put(self._error_reply(str(e)))
 
 
     def _handle_RECEIVE_TRIGGERED(self, client_command):
-        """ Read from the socket: discard the header information, then send
-        data from channel 1 and channel 2 to the reply queue.
+        """ Read from the socket: send the decoded header, and channel 1 data
+        from the first point channel 2 exceeds the trigger value, to the reply
+        queue.
         """
+        frames = []
         try:
             reply = {}
             replied = []
 
-            socks, _, _ = select.select(self.sockets, [], [])
+            socks = self._select()
+            if not socks:
+                # Woken by a command or a reconnect
+                return
             # Receieve from each socket when it becomes available
             for sock in socks:
-                # Take the header information from the socket, then discard
-                header_bytes = self._receieve_bytes(self.header_size, sock)
-
-                # Take channel 1 data from the socket
-                ch1_bytes = self._receieve_bytes(self.channel_size, sock)
-                # Take channel 2 data from the socket
-                ch2_bytes = self._receieve_bytes(self.channel_size, sock)
-
-                # Find the points in channnel 2 where the acquisition trigger threshold has been exceeded
-                acquire = np.where(np.frombuffer(ch2_bytes, dtype=np.int16) > self.trigger_value)
-                if len(acquire[0] > 0):
-                    if self.has_triggered[self.name_address_dict[sock.getpeername()[0]]] == True:
-                        assert(len(acquire[0]) == self.channel_size / 2)
-                    self.has_triggered[self.name_address_dict[sock.getpeername()[0]]] = True
+                device_name = self.socket_names[sock]
+                frame = self._receive_frame(sock)
+                if frame is None:
+                    continue
+                index, header_bytes, ch1_bytes, ch2_bytes = frame
+
+                start = trigger_start(ch2_bytes, self.trigger_value, self.sample_dtype)
+                if start is not None:
                     # We surpassed the channel 2 acquisition trigger threshold during this acquisition - save everything on channel 1 since the first point this happened
-                    reply.update({self.name_address_dict[sock.getpeername()[0]] + '_ch1': ch1_bytes[2 * acquire[0][0]::]}) # one int16 is 2 bytes
+                    reply.update({device_name + '_ch1': ch1_bytes[self.sample_dtype.itemsize * start::]})
+                    reply.update({device_name + '_header': rp.parse_header(header_bytes)})
 
-                    # Store name of device socket is associated with
-                    replied.append(self.name_address_dict[sock.getpeername()[0]])
+                    # Store name of device socket is associated with
+                    replied.append(device_name)
+                    frames.append(index)
+                else:
+                    # Nothing kept from this frame
+                    self._release_frames([index])
 
             # Store the names of all sockets that replied in the reply
             reply.update({'replied_devices': replied})
@@ -218,13 +484,125 @@ class SocketClientThread(threading.Thread):
             # Store the timestamp in the reply - this will not be accurate up to the level of the synchronisation correction
             reply.update({'timestamp': time.time_ns()})
 
+            if self.zero_copy:
+                # Pool frames referenced by this reply, returned by release()
+                reply.update({'frames': frames})
+
             # Put reply in the reply queue
             self.reply_q.put(self._data_reply(reply), block=True)
 
         except OSError as e:
+            self._release_frames(frames)
             self.reply_q.put(self._error_reply(str(e)))
 
 
+    def _receive_frame(self, sock):
+        """ Receive a frame from sock, returning (pool index, header, ch1,
+        ch2). With reconnect, a device that fails is handed to _lost() and
+        None returned; otherwise the OSError is raised.
+        """
+        index = None
+        t_recv = time.perf_counter()
+        try:
+            if self.zero_copy:
+                # Receive the whole frame into a pooled buffer, hand out views of the channels
+                index, frame = self.frame_pool.get()
+                self._receive_into(frame, sock)
+                header_bytes, ch1_bytes, ch2_bytes = self.frame_pool.split(frame)
+            else:
+                # Take the header information from the socket
+                header_bytes = self._receieve_bytes(self.header_size, sock)
+                # Take channel 1 and channel 2 data from the socket
+                ch1_bytes = self._receieve_bytes(self.channel_size, sock)
+                ch2_bytes = self._receieve_bytes(self.channel_size, sock)
+        except OSError as e:
+            self._release_frames([index])
+            if self.reconnect is None:
+                raise
+            self._lost(sock, e)
+            return None
+        self.receive_metrics[self.socket_names[sock]].record(self.header_size + 2 * self.channel_size, time.perf_counter() - t_recv)
+        return index, header_bytes, ch1_bytes, ch2_bytes
+
+
+    def _select(self):
+        """ Wait until any connected socket or cmd_q is readable, or until
+        the next reconnect event, returning the readable sockets. Devices
+        being reconnected are connected in the same select.
+        """
+        timeout_s = self._reconnect_devices()
+        receiving = [sock for sock, connected in zip(self.sockets, self.connected) if connected]
+        connecting = [self.sockets[i] for i, state in self.reconnecting.items() if state['t_timeout'] is not None]
+        readable, writable, _ = select.select(receiving + [self.cmd_q], connecting, [], timeout_s)
+        self.select_wakeups.inc()
+        for sock in writable:
+            self._reconnected(self.sockets.index(sock))
+        return [sock for sock in readable if sock is not self.cmd_q]
+
+
+    def _lost(self, sock, error):
+        """ Device of sock failed while streaming: close its socket and
+        schedule reconnecting it.
+        """
+        i = self.sockets.index(sock)
+        device_name = self.device_names[i]
+        sock.close()
+        self.connected[i] = False
+        self.socket_names.pop(sock, None)
+        self.reconnecting[i] = {'attempt': 0, 't_retry': time.monotonic() + self.reconnect.delay_s(0), 't_timeout': None}
+        self.metrics.counter('rp_devices_lost', device=device_name).inc()
+        self.reply_q.put(ClientReply('LOST', (device_name, str(error))))
+
+
+    def _reconnect_devices(self):
+        """ Start the reconnects that are due and time out those taking too
+        long, returning the time until the next is due (None if none are
+        being reconnected).
+        """
+        now = time.monotonic()
+        timeout_s = None
+        for i, state in list(self.reconnecting.items()):
+            if state['t_timeout'] is not None and now >= state['t_timeout']:
+                self.sockets[i].close()
+                self._retry(i, 'Connection timed out')
+            if i in self.reconnecting and state['t_timeout'] is None and now >= state['t_retry']:
+                try:
+                    self._start_connect(i)
+                    state['t_timeout'] = now + self.connect_timeout_s
+                except OSError as e:
+                    self._retry(i, str(e))
+            if i in self.reconnecting:
+                t_next = state['t_timeout'] if state['t_timeout'] is not None else state['t_retry']
+                timeout_s = t_next - now if timeout_s is None else min(timeout_s, t_next - now)
+        return None if timeout_s is None else max(timeout_s, 0.)
+
+
+    def _retry(self, i, error):
+        """ A reconnect of device i failed: schedule the next attempt, or give
+        up after the last.
+        """
+        state = self.reconnecting[i]
+        state['attempt'] += 1
+        state['t_timeout'] = None
+        if self.reconnect.max_attempts is not None and state['attempt'] >= self.reconnect.max_attempts:
+            del self.reconnecting[i]
+            self.reply_q.put(self._message_reply('Gave up reconnecting ' + self.device_names[i] + ': ' + error))
+            return
+        state['t_retry'] = time.monotonic() + self.reconnect.delay_s(state['attempt'])
+
+
+    def _reconnected(self, i):
+        try:
+            self._finish_connect(i)
+        except OSError as e:
+            self.sockets[i].close()
+            self._retry(i, str(e))
+            return
+        del self.reconnecting[i]
+        self.metrics.counter('rp_devices_reconnected', device=self.device_names[i]).inc()
+        self.reply_q.put(self._message_reply('Socket for ' + self.device_names[i] + ' reconnected'))
+
+
     def _receieve_bytes(self, n, socket):
         """ Receive n bytes from socket.
         """
@@ -238,6 +616,51 @@ class SocketClientThread(threading.Thread):
         return tdata
 
 
+    def _receive_into(self, buffer, socket):
+        """ Fill the writable memoryview buffer from socket, without copying.
+        """
+        n = len(buffer)
+        n_read = 0
+        while n_read < n:
+            n_packet = socket.recv_into(buffer[n_read:], n - n_read)
+            if not n_packet:
+                raise OSError('Empty packet from socket.recv_into()')
+            n_read += n_packet
+
+
+    def release(self, client_reply):
+        """ Hand the pooled buffers referenced by a DATA reply back to the
+        socket thread. Does nothing outside zero-copy mode.
+        """
+        if client_reply.key == 'DATA':
+            self._release_frames(client_reply.reply.pop('frames', []))
+
+
+    def clear_replies(self):
+        """ Discard all queued replies, releasing any pooled buffers they hold.
+        """
+        self.reply_q.clear()
+
+
+    def _release_frames(self, frames):
+        if self.zero_copy:
+            for index in frames:
+                self.frame_pool.release(index)
+
+
+    def _handle_PAUSE(self, client_command):
+        """ Stop receiving: devices are left connected, and held back by their
+        socket buffers filling.
+        """
+        self.paused = True
+        self.reply_q.put(self._message_reply('Paused'))
+
+
+    def _handle_RESUME(self, client_command):
+        self.paused = False
+        self.reply_q.put(self._message_reply('Resumed'))
+
+
     def _handle_CLOSE(self, client_command):
         """ Close connection to the socket.
         """
@@ -248,7 +671,14 @@ class SocketClientThread(threading.Thread):
                 self.sockets[i].close()
                 self.connected[i] = False
                 devices_closed += (self.device_names[i] + ', ')
-        self.reply_q.queue.clear()
+            elif i in self.reconnecting:
+                # Give up reconnecting
+                self.sockets[i].close()
+        self.reconnecting = {}
+        self.socket_names = {}
+        self.started = False
+        self.paused = False
+        self.clear_replies()
         self.reply_q.put(self._message_reply('Sockets closed for: ' + devices_closed))
 
 
@@ -0,0 +1,146 @@
+"""
+02/22, R James
+"""
+
+import numpy as np
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+@export
+class StreamBlock:
+    """ Samples from one device, as yielded by RPDeviceCollection.stream().
+
+        device_name:  Name of the device
+        ch1, ch2:     numpy arrays of raw ADC values (int8 or int16, by
+                      resolution), or volts if calibrated (ch2 is None in
+                      triggered mode)
+        sample:       Number of the first sample since the stream started,
+                      or None if the frame headers carry no sequence information
+        rate:         Sample rate from the frame headers, or None
+        timestamp:    Time of the first sample (ns since the epoch)
+        losses:       (frame index, sample number, samples lost) of each loss
+                      since the previous block
+        resumed:      Whether this is the first block after the device was
+                      reconnected
+    """
+    def __init__(self, device_name, ch1, ch2=None, sample=None, rate=None, timestamp=None, losses=(), resumed=False):
+        self.device_name = device_name
+        self.ch1 = ch1
+        self.ch2 = ch2
+        self.sample = sample
+        self.rate = rate
+        self.timestamp = timestamp
+        self.losses = list(losses)
+        self.resumed = resumed
+
+
+    def __len__(self):
+        return len(self.ch1)
+
+
+    def split(self, n):
+        """ Split into the first n samples and the rest.
+        """
+        offset_ns = (n * 1000000000) // self.rate if self.rate else 0
+        head = StreamBlock(self.device_name, self.ch1[:n], None if self.ch2 is None else self.ch2[:n],
+                           self.sample, self.rate, self.timestamp, self.losses, self.resumed)
+        tail = StreamBlock(self.device_name, self.ch1[n:], None if self.ch2 is None else self.ch2[n:],
+                           None if self.sample is None else self.sample + n, self.rate, self.timestamp + offset_ns)
+        return head, tail
+
+
+    def copy(self):
+        """ The block with copies of its arrays, which no longer view receive
+        buffers.
+        """
+        return StreamBlock(self.device_name, self.ch1.copy(), None if self.ch2 is None else self.ch2.copy(),
+                           self.sample, self.rate, self.timestamp, self.losses, self.resumed)
+
+
+
+@export
+class BlockBatcher:
+    """ Gathers the StreamBlocks of each device into batches of batch_samples
+        samples, or of batch_time_s seconds (by sample rate where the frame
+        headers give one, otherwise by block timestamps). Batches are copies,
+        and the samples of a block left pending are copied before add()
+        returns, so the blocks they were made from may be reused.
+
+        Blocks are concatenated as received: losses, and in triggered mode the
+        untriggered parts of frames, are not filled in.
+    """
+    def __init__(self, batch_samples=None, batch_time_s=None):
+        try:
+            assert (batch_samples is None) != (batch_time_s is None)
+        except:
+            raise ValueError('Exactly one of batch_samples and batch_time_s must be given')
+
+        self.batch_samples = batch_samples
+        self.batch_time_s = batch_time_s
+        # Blocks waiting to be batched, for each device
+        self.pending = {}
+
+
+    def _batch_size(self, block):
+        if self.batch_samples is not None:
+            return self.batch_samples
+        if block.rate:
+            return max(1, round(self.batch_time_s * block.rate))
+        return None
+
+
+    def add(self, block):
+        """ Add a block, returning the list of batches completed by it.
+        """
+        pending = self.pending.setdefault(block.device_name, [])
+        pending.append(block)
+        batch_size = self._batch_size(block)
+        batches = []
+
+        if batch_size is None:
+            # No sample rate: batch on timestamps
+            if block.timestamp - pending[0].timestamp >= self.batch_time_s * 1e9:
+                batches.append(self._join(pending[:-1]))
+                pending = self.pending[block.device_name] = [block]
+            self._keep(pending)
+            return batches
+
+        n_pending = sum(len(pending_block) for pending_block in pending)
+        while n_pending >= batch_size:
+            # Take batch_size samples, leaving the rest of the last block needed pending
+            taken, n_taken = [], 0
+            while pending and n_taken + len(pending[0]) <= batch_size:
+                n_taken += len(pending[0])
+                taken.append(pending.pop(0))
+            if n_taken < batch_size:
+                head, pending[0] = pending[0].split(batch_size - n_taken)
+                taken.append(head)
+            batches.append(self._join(taken))
+            n_pending -= batch_size
+        self._keep(pending)
+        return batches
+
+
+    def _keep(self, pending):
+        # Blocks are appended last, and earlier ones are kept already, so only
+        # the last pending block (or what is left of it) can view the block added
+        if pending:
+            pending[-1] = pending[-1].copy()
+
+
+    def flush(self):
+        """ Return the incomplete batch of each device, emptying the batcher.
+        """
+        batches = [self._join(pending) for pending in self.pending.values() if pending]
+        self.pending = {}
+        return batches
+
+
+    def _join(self, blocks):
+        first = blocks[0]
+        ch2 = None if first.ch2 is None else np.concatenate([block.ch2 for block in blocks])
+        return StreamBlock(first.device_name, np.concatenate([block.ch1 for block in blocks]), ch2, first.sample,
+                           first.rate, first.timestamp, [loss for block in blocks for loss in block.losses],
+                           any(block.resumed for block in blocks))
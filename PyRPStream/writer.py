@@ -0,0 +1,357 @@
+"""
+02/22, R James
+"""
+
+import collections
+import concurrent.futures
+import mmap
+import multiprocessing.util
+import os
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+import numpy as np
+
+import PyRPStream as rp
+export, __all__ = rp.exporter()
+
+
+@export
+class SegmentWriter:
+    """ Background writer pipeline: segments submitted by the acquisition loop
+        are converted and written to disk by a pool of n_threads threads, so
+        acquisition continues while the previous segment is written. At most
+        max_queued segments wait to be written; submit() blocks beyond that.
+
+        save is called as save(data_bytes, **kwargs) for each segment, and
+        on_done (if given) once the segment's buffer may be reused. Writes
+        are also recorded in metrics (by default rp.metrics()).
+    """
+    def __init__(self, save, n_threads=1, max_queued=2, metrics=None):
+        self.save = save
+        self.jobs = queue.Queue(maxsize=max_queued)
+        self.errors = []
+        self.write_metrics = rp.WriteMetrics(rp.metrics() if metrics is None else metrics, 'threads')
+        # Statistics, for sizing disks
+        self.lock = threading.Lock()
+        self.max_queue_depth = 0
+        self.segments_written = 0
+        self.bytes_written = 0
+        self.write_times_s = collections.deque(maxlen=1000)
+        self.latencies_s = collections.deque(maxlen=1000)
+
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(n_threads)]
+        for thread in self.threads:
+            thread.start()
+
+
+    def submit(self, data_bytes, on_done=None, **kwargs):
+        """ Queue a segment to be written, blocking if max_queued are waiting.
+        """
+        self.jobs.put((time.perf_counter(), data_bytes, on_done, kwargs))
+        with self.lock:
+            self.max_queue_depth = max(self.max_queue_depth, self.jobs.qsize())
+
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            t_submit, data_bytes, on_done, kwargs = job
+            t_start = time.perf_counter()
+            try:
+                self.save(data_bytes, **kwargs)
+            except Exception as e:
+                self.errors.append(e)
+            t_end = time.perf_counter()
+            with self.lock:
+                self.segments_written += 1
+                self.bytes_written += len(data_bytes)
+                self.write_times_s.append(t_end - t_start)
+                self.latencies_s.append(t_end - t_submit)
+                self.write_metrics.record(len(data_bytes), t_end - t_start)
+            if on_done is not None:
+                on_done()
+
+
+    def stats(self):
+        """ Snapshot of queue depth, segments and bytes written, and write
+        duration / latency from submission (mean and max over recent segments).
+        """
+        with self.lock:
+            write_times_s = list(self.write_times_s)
+            latencies_s = list(self.latencies_s)
+            return {'queue_depth': self.jobs.qsize(),
+                    'max_queue_depth': self.max_queue_depth,
+                    'segments_written': self.segments_written,
+                    'bytes_written': self.bytes_written,
+                    'mean_write_s': sum(write_times_s) / len(write_times_s) if write_times_s else 0.,
+                    'max_write_s': max(write_times_s, default=0.),
+                    'mean_latency_s': sum(latencies_s) / len(latencies_s) if latencies_s else 0.,
+                    'max_latency_s': max(latencies_s, default=0.)}
+
+
+    def close(self):
+        """ Wait for all queued segments to be written and end the threads.
+        Raises the first error met while writing, if any.
+        """
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+
+
+@export
+def save_segment(data_bytes, filename, converter, data_format, compression=None, device_name=None, channel=None,
+                 rate=None, t_file=None):
+    """ Write raw ADC data_bytes to filename in data_format (see
+    RPDeviceCollection.acquire), converted by converter (an AdcConverter) a
+    chunk at a time. With compression (see compression.compressor), they
+    are written to a container file with compressed chunks instead, with
+    device_name, channel, rate and t_file in its header.
+    """
+    data = np.frombuffer(data_bytes, dtype=converter.sample_dtype)
+    if compression is not None:
+        container = rp.ContainerWriter(filename, device_name, channel, converter, data_format, rate, t_file,
+                                       compressor=rp.compressor(compression))
+        container.append(data, 0, t_file)
+        container.finalize()
+        return
+    if converter.dtype == converter.sample_dtype:
+        data.tofile(filename)
+    else:
+        with open(filename, 'wb') as file:
+            for chunk in converter.chunks(data):
+                chunk.tofile(file)
+    if data_format == 'lazy':
+        rp.save_calibration(filename, converter)
+
+
+
+@export
+class SharedSegmentBuffer:
+    """ Segment buffer, as device_interface.SegmentBuffer, held in shared
+        memory so that worker processes can read a full segment without it
+        being copied or pickled. close() frees the memory.
+    """
+    def __init__(self, capacity):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(capacity, 1))
+        self.view = self.shm.buf
+        self.size = 0
+
+
+    def append(self, block):
+        block = memoryview(block).cast('B')
+        n = len(block)
+        self.view[self.size:self.size + n] = block
+        self.size += n
+
+
+    def contents(self):
+        return self.view[:self.size]
+
+
+    def clear(self):
+        self.size = 0
+
+
+    def close(self):
+        self.view = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+# Shared memory attached by this worker process, by name
+_attached = {}
+
+
+def _save_shared(shm_name, n_bytes, kwargs):
+    """ Worker process entry point: save the first n_bytes of shared memory
+    shm_name with save_segment.
+    """
+    if shm_name not in _attached:
+        _attached[shm_name] = shared_memory.SharedMemory(name=shm_name)
+    save_segment(_attached[shm_name].buf[:n_bytes], **kwargs)
+
+
+def _init_worker():
+    """ Worker process initializer: close the shared memory attached once
+    the worker exits (as the pool shuts down).
+    """
+    multiprocessing.util.Finalize(None, _close_attached, exitpriority=0)
+
+
+def _close_attached():
+    for shm in _attached.values():
+        shm.close()
+    _attached.clear()
+
+
+
+@export
+class ProcessSegmentWriter:
+    """ Writer pipeline, as SegmentWriter, whose segments are converted and
+        written by a pool of n_processes worker processes, so conversion of
+        several devices' segments runs on several cores outside the GIL.
+
+        Segments are SharedSegmentBuffers: workers read them in place from
+        shared memory, and only their name, size and the save_segment
+        arguments are sent. At most max_in_flight segments are being saved
+        at once; submit() blocks beyond that. Segments complete in the order
+        they were submitted: on_done (if given) is called for each, in that
+        order, once it is written and its buffer may be reused. Writes are
+        also recorded in metrics (by default rp.metrics()).
+    """
+    def __init__(self, n_processes=2, max_in_flight=2, metrics=None):
+        self.executor = concurrent.futures.ProcessPoolExecutor(n_processes, initializer=_init_worker)
+        self.in_flight = threading.Semaphore(max_in_flight)
+        self.pending = queue.Queue()
+        self.errors = []
+        self.write_metrics = rp.WriteMetrics(rp.metrics() if metrics is None else metrics, 'processes')
+        # Statistics, as SegmentWriter
+        self.lock = threading.Lock()
+        self.max_queue_depth = 0
+        self.segments_written = 0
+        self.bytes_written = 0
+        self.write_times_s = collections.deque(maxlen=1000)
+        self.latencies_s = collections.deque(maxlen=1000)
+
+        self.thread = threading.Thread(target=self._complete, daemon=True)
+        self.thread.start()
+
+
+    def submit(self, segment, on_done=None, **kwargs):
+        """ Queue a SharedSegmentBuffer to be saved by save_segment(contents,
+        **kwargs), blocking if max_in_flight are being saved.
+        """
+        self.in_flight.acquire()
+        t_submit = time.perf_counter()
+        future = self.executor.submit(_save_shared, segment.shm.name, segment.size, kwargs)
+        self.pending.put((t_submit, segment.size, future, on_done))
+        with self.lock:
+            self.max_queue_depth = max(self.max_queue_depth, self.pending.qsize())
+
+
+    def _complete(self):
+        # Wait for segments in submission order, so they complete in order
+        while True:
+            job = self.pending.get()
+            if job is None:
+                break
+            t_submit, n_bytes, future, on_done = job
+            try:
+                future.result()
+            except Exception as e:
+                self.errors.append(e)
+            t_end = time.perf_counter()
+            with self.lock:
+                self.segments_written += 1
+                self.bytes_written += n_bytes
+                # Time from submission, including waiting for a worker
+                self.write_times_s.append(t_end - t_submit)
+                self.latencies_s.append(t_end - t_submit)
+                self.write_metrics.record(n_bytes, t_end - t_submit)
+            self.in_flight.release()
+            if on_done is not None:
+                on_done()
+
+
+    def stats(self):
+        """ Snapshot of statistics, as SegmentWriter.stats(). queue_depth counts
+        segments in flight, and write times include waiting for a worker.
+        """
+        with self.lock:
+            write_times_s = list(self.write_times_s)
+            latencies_s = list(self.latencies_s)
+            return {'queue_depth': self.pending.qsize(),
+                    'max_queue_depth': self.max_queue_depth,
+                    'segments_written': self.segments_written,
+                    'bytes_written': self.bytes_written,
+                    'mean_write_s': sum(write_times_s) / len(write_times_s) if write_times_s else 0.,
+                    'max_write_s': max(write_times_s, default=0.),
+                    'mean_latency_s': sum(latencies_s) / len(latencies_s) if latencies_s else 0.,
+                    'max_latency_s': max(latencies_s, default=0.)}
+
+
+    def close(self):
+        """ Wait for all submitted segments to be saved and end the workers.
+        Raises the first error met while saving, if any.
+        """
+        self.pending.put(None)
+        self.thread.join()
+        self.executor.shutdown()
+        if self.errors:
+            raise self.errors[0]
+
+
+
+@export
+class MemmapSegment:
+    """ Segment file preallocated for capacity samples of dtype and filled in
+        place through a memory map, so no segment data accumulates in memory.
+        Every flush_bytes written, the written pages are synced and dropped
+        from the mapping, keeping resident memory constant. finalize()
+        truncates the file to the samples actually written.
+
+        convert, if given, is called as convert(samples, out) to convert each
+        block of raw ADC samples, of sample_dtype, into its place in the file.
+    """
+    def __init__(self, filename, capacity, dtype, convert=None, flush_bytes=16e6, sample_dtype=np.int16):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.sample_dtype = np.dtype(sample_dtype)
+        # Converts each block of raw ADC samples to dtype in place, if not None
+        self.convert = convert
+        with open(filename, 'wb') as file:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(file.fileno(), 0, capacity * self.dtype.itemsize)
+            else:
+                file.truncate(capacity * self.dtype.itemsize)
+        with open(filename, 'r+b') as file:
+            # The mapping stays valid once the file is closed
+            self.mmap = mmap.mmap(file.fileno(), capacity * self.dtype.itemsize)
+        self.data = np.frombuffer(self.mmap, dtype=self.dtype, count=capacity)
+        self.size = 0
+        self.flush_bytes = int(flush_bytes)
+        self.flushed_bytes = 0
+
+
+    def append(self, block):
+        """ Write a block of raw ADC samples (any buffer) at the end of the segment.
+        """
+        samples = np.frombuffer(block, dtype=self.sample_dtype)
+        n = len(samples)
+        if self.convert is not None:
+            self.convert(samples, self.data[self.size:self.size + n])
+        else:
+            self.data[self.size:self.size + n] = samples
+        self.size += n
+
+        written_bytes = self.size * self.dtype.itemsize
+        if written_bytes - self.flushed_bytes >= self.flush_bytes:
+            self._release_pages(written_bytes)
+
+
+    def _release_pages(self, written_bytes):
+        # Whole pages only: the last page may still be partly written
+        end = written_bytes - written_bytes % mmap.PAGESIZE
+        self.mmap.flush()
+        if hasattr(mmap, 'MADV_DONTNEED') and end > self.flushed_bytes:
+            self.mmap.madvise(mmap.MADV_DONTNEED, self.flushed_bytes, end - self.flushed_bytes)
+        self.flushed_bytes = end
+
+
+    def finalize(self):
+        """ Flush, unmap, and truncate the file to the data written.
+        """
+        self.mmap.flush()
+        # The array must go before the mapping it views can be closed
+        self.data = None
+        self.mmap.close()
+        self.mmap = None
+        os.truncate(self.filename, self.size * self.dtype.itemsize)
@@ -0,0 +1,121 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+
+import PyRPStream as rp
+
+
+RATE = 1000000
+
+
+def _collection(simulator, **kwargs):
+    collection = rp.RPDeviceCollection(**kwargs)
+    for i, (address, port) in enumerate(simulator.addresses):
+        collection.add_device('dev' + str(i), address, port)
+    collection.initialise()
+    collection.connect()
+    return collection
+
+
+def _shared_memory():
+    return set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+
+
+class _Interrupt:
+    """ Stage that interrupts acquisition on the n-th block, as Ctrl-C would.
+    """
+    def __init__(self, n):
+        self.n = n
+        self.closed = False
+
+    def process(self, block):
+        self.n -= 1
+        if not self.n:
+            raise KeyboardInterrupt
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.parametrize('output, options, base_port', [
+    ('container', {'compression': 'zlib'}, 9500),
+    ('memmap', {}, 9510),
+    ('buffer', {'writer_processes': 1, 'acquire_raw': True}, 9520),
+])
+def test_interrupted_acquire_keeps_segments(tmp_path, monkeypatch, output, options, base_port):
+    monkeypatch.chdir(tmp_path)
+    shared_memory = _shared_memory()
+    interrupt = _Interrupt(40)
+    with rp.RPStreamSimulator(2, base_port, sample_rate=RATE, seed=3) as simulator:
+        collection = _collection(simulator)
+        try:
+            with pytest.raises(KeyboardInterrupt):
+                collection.acquire(10., file_size=2.5e5, output=output, catalog='catalog.sqlite', stages=[interrupt], **options)
+        finally:
+            collection.disconnect()
+
+    assert interrupt.closed
+    # Shared segment buffers are freed
+    assert _shared_memory() <= shared_memory
+    # Segments handed to the writer, or open, are complete files
+    run = rp.RunReader(str(tmp_path), rate=RATE, bin_dtype=np.int16)
+    assert run.channels
+    for array in run.channels.values():
+        assert len(array) and len(array) % 16384 == 0
+    for filename in glob.glob(str(tmp_path / '*.rps')):
+        with rp.ContainerReader(filename) as container:
+            assert container.complete
+    # The catalog is closed, with every segment written
+    with rp.RunCatalog('catalog.sqlite') as catalog:
+        assert len(catalog.segments()) == len(glob.glob(str(tmp_path / 'red_pitaya_data_*')))
+
+
+def _losses(filename):
+    """ Rows of frame index, sample number and samples lost of the losses file of segment filename, if any.
+    """
+    t_file = os.path.splitext(filename)[0].rsplit('_', 1)[1]
+    losses = glob.glob(os.path.join(os.path.dirname(filename), 'red_pitaya_losses_*_' + t_file + '.txt'))
+    return np.loadtxt(losses[0], dtype=np.int64, ndmin=2).tolist() if losses else []
+
+
+def test_reconnect_resumes_after_gap(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with rp.RPStreamSimulator(1, 9540, sample_rate=RATE, disconnect_every_s=0.6, seed=4) as simulator:
+        collection = _collection(simulator, reconnect=rp.ReconnectPolicy(initial_s=0.1), connect_timeout_s=1.)
+        try:
+            resumed = []
+            end = None
+            n_stored = 0
+            for block in collection.stream(1.5):
+                if block.resumed:
+                    resumed.append(block)
+                    # Samples missed while reconnecting are a loss, at the end of the last block
+                    [(_, sample, lost)] = block.losses
+                    assert sample == end and lost > 0
+                    assert block.sample == end + lost
+                else:
+                    assert block.sample == (end or 0) and not block.losses
+                end = block.sample + len(block)
+                n_stored += len(block)
+            assert resumed
+            assert n_stored + sum(block.losses[0][2] for block in resumed) == 1.5 * RATE
+
+            # Each reconnection starts a new segment, whose losses begin with the gap
+            collection.acquire(1.5, file_size=1e8, acquire_raw=True)
+        finally:
+            collection.disconnect()
+
+    segments = sorted(glob.glob(str(tmp_path / 'red_pitaya_data_ch1_dev0_*.bin')))
+    assert len(segments) >= 2
+    # Only segments with losses have a losses file
+    assert _losses(segments[0]) == []
+    assert len(glob.glob(str(tmp_path / 'red_pitaya_losses_*'))) == len(segments) - 1
+    n_lost = 0
+    for segment in segments[1:]:
+        [(_, sample, lost)] = _losses(segment)
+        assert lost > 0
+        n_lost += lost
+    n_stored = sum(os.path.getsize(segment) for segment in segments) // 2
+    assert n_stored + n_lost == 1.5 * RATE
@@ -0,0 +1,96 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import PyRPStream as rp
+
+
+def _adc_means(levels_V, gain, offset, input_range_V=2., input_bits=16):
+    """ Mean ADC values read at levels_V, by V = gain * (ADC * input_range_V / 2**input_bits + offset).
+    """
+    return [(level_V / gain - offset) * 2 ** input_bits / input_range_V for level_V in levels_V]
+
+
+@pytest.mark.parametrize('levels_V', [[0., 0.5], [-0.8, 0., 0.3, 0.9]])
+def test_fit_recovers_gain_and_offset(levels_V):
+    gain, offset = rp.fit_gain_offset(levels_V, _adc_means(levels_V, 1.03, -0.012))
+    assert gain == pytest.approx(1.03)
+    assert offset == pytest.approx(-0.012)
+
+
+def test_fit_of_one_level():
+    # Grounded inputs give the offset alone, keeping the gain given
+    gain, offset = rp.fit_gain_offset([0.], _adc_means([0.], 1.03, -0.012), gain=0.9)
+    assert gain == 0.9
+    assert offset == pytest.approx(-0.012)
+    # One DC level gives the gain alone, keeping the offset given
+    gain, offset = rp.fit_gain_offset([0.5, 0.5], _adc_means([0.5, 0.5], 1.03, -0.012), offset=-0.012)
+    assert gain == pytest.approx(1.03)
+    assert offset == -0.012
+    # No levels keep both
+    assert rp.fit_gain_offset([], [], gain=0.9, offset=0.1) == (0.9, 0.1)
+
+
+def test_running_stats_merge_blocks():
+    data = np.random.default_rng(4).normal(1000., 30., 100000).astype(np.int16)
+    stats = rp.RunningStats()
+    for block in np.split(data, [1, 10, 16384, 16384, 50000, 99999]):
+        stats.add(block)
+    assert stats.count == len(data)
+    assert stats.mean == pytest.approx(np.mean(data), rel=1e-12)
+    assert stats.variance() == pytest.approx(np.var(data, ddof=1), rel=1e-9)
+    assert rp.RunningStats().variance() == 0.
+
+
+def test_record_round_trip_loaded_by_device(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    points = [{'level_V': 0., 'ch1': {'mean_adc': 12.5, 'std_adc': 3., 'n_samples': 16384}}]
+    record = rp.CalibrationRecord('dev0', 1.02, -0.01, 0.97, 0.004, points=points)
+    record.save()
+    assert os.path.isfile('dev0_calibration.json')
+
+    loaded = rp.CalibrationRecord.load('dev0')
+    assert vars(loaded) == vars(record)
+    assert rp.CalibrationRecord.load('dev1') is None
+
+    collection = rp.RPDeviceCollection()
+    try:
+        collection.add_device('dev0', '127.0.0.1', 0)
+    finally:
+        collection.disconnect()
+    device = collection.device_collection['dev0']
+    assert (device.ch1_gain, device.ch1_offset, device.ch2_gain, device.ch2_offset) == (1.02, -0.01, 0.97, 0.004)
+    assert device.converter(2).calibration()['gain'] == 0.97
+
+
+def _threads():
+    return [thread for thread in threading.enumerate() if thread is not threading.main_thread() and not thread.daemon]
+
+
+def test_calib_util_streams_only_to_measure(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    threads = _threads()
+    with rp.RPStreamSimulator(1, 9460, sample_rate=1e6, seed=5) as simulator:
+        calib_util = rp.CalibUtil('dev0', *simulator.addresses[0], duration_s=0.2)
+        # Constructing it, e.g. to reset or write a calibration, leaves nothing running
+        assert _threads() == threads
+        calib_util.ground_inputs()
+        assert _threads() == threads
+    assert calib_util.calibrator.points['dev0'][0]['ch1']['n_samples'] > 0
+    calib_util.write_calib()
+    assert rp.CalibrationRecord.load('dev0').ch1_offset == calib_util.ch1_offset
+
+
+def test_save_data_keeps_positional_arguments(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    collection = rp.RPDeviceCollection()
+    try:
+        collection.add_device('dev0', '127.0.0.1', 0)
+        data = np.arange(-500, 500, dtype=np.int16)
+        # data_bytes, channel, calib, acquire_raw
+        collection.save_data(data.tobytes(), 2, False, True, t_file=1, device=collection.device_collection['dev0'])
+    finally:
+        collection.disconnect()
+    assert np.array_equal(np.fromfile('red_pitaya_data_ch2_dev0_1.bin', dtype=np.int16), data)
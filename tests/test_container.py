@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+import pytest
+
+import PyRPStream as rp
+
+
+def _write(filename, blocks, converter, data_format, compression=None, chunk_samples=1000, rate=1000000):
+    writer = rp.ContainerWriter(filename, 'dev0', 1, converter, data_format, rate=rate, t_file=0, chunk_samples=chunk_samples,
+                                compressor=rp.compressor(compression))
+    for sample, samples in blocks:
+        writer.append(samples, sample, sample * 1000)
+    writer.finalize()
+
+
+def _blocks(sample_dtype=np.int16, seed=0):
+    """ Blocks of raw ADC samples, with a gap of lost samples after the second.
+    """
+    rng = np.random.default_rng(seed)
+    limit = np.iinfo(sample_dtype).max // 4
+    samples = [rng.integers(-limit, limit, n).astype(sample_dtype) for n in (1500, 700, 2300)]
+    return [(0, samples[0]), (1500, samples[1]), (5000, samples[2])]
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib', 'lzma:0', 'bz2:9'])
+@pytest.mark.parametrize('input_bits', [8, 16])
+def test_raw_round_trip(tmp_path, compression, input_bits):
+    filename = str(tmp_path / 'raw.rps')
+    sample_dtype = rp.sample_dtype(input_bits)
+    blocks = _blocks(sample_dtype)
+    converter = rp.AdcConverter(input_bits=input_bits, dtype=sample_dtype)
+    _write(filename, blocks, converter, sample_dtype.name, compression)
+
+    with rp.ContainerReader(filename) as reader:
+        assert reader.complete
+        assert reader.dtype == sample_dtype
+        assert len(reader) == sum(len(samples) for _, samples in blocks)
+        assert np.array_equal(reader.read(), np.concatenate([samples for _, samples in blocks]))
+        # Chunks end at the gap, and read() by sample number skips lost samples
+        assert list(reader.index['sample']) == [0, 1000, 2000, 5000, 6000, 7000]
+        assert np.array_equal(reader.read(1400, 5100), np.concatenate([blocks[0][1][1400:], blocks[1][1], blocks[2][1][:100]]))
+        chunks = list(reader.iter_chunks())
+        assert np.array_equal(np.concatenate([samples for _, _, samples in chunks]), reader.read())
+        # Timestamps follow from the sample rate within each block
+        assert reader.sample_at(5000 * 1000 + 1500) == 5002
+
+
+def test_volts_round_trip(tmp_path):
+    filename = str(tmp_path / 'volts.rps')
+    blocks = _blocks()
+    converter = rp.AdcConverter(gain=1.02, offset=-0.01, dtype=np.float32)
+    _write(filename, blocks, converter, 'float32', 'zlib')
+
+    expected = converter.convert(np.concatenate([samples for _, samples in blocks]))
+    with rp.ContainerReader(filename) as reader:
+        assert reader.dtype == np.float32
+        assert np.array_equal(reader.read(), expected)
+
+
+def test_lazy_conversion_matches_converter(tmp_path):
+    filename = str(tmp_path / 'lazy.rps')
+    blocks = _blocks()
+    calibration = {'gain': 0.98, 'offset': 0.003}
+    _write(filename, blocks, rp.AdcConverter(dtype=np.int16, **calibration), 'lazy', 'zlib')
+
+    raw = np.concatenate([samples for _, samples in blocks])
+    with rp.ContainerReader(filename) as reader:
+        assert np.array_equal(reader.read(dtype=np.float32), rp.AdcConverter(dtype=np.float32, **calibration).convert(raw))
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_unfinalized_file_is_scanned(tmp_path, compression):
+    filename = str(tmp_path / 'crash.rps')
+    blocks = _blocks()
+    _write(filename, blocks, rp.AdcConverter(dtype=np.int16), 'int16', compression)
+    with rp.ContainerReader(filename) as reader:
+        index = reader.index
+        # Cut into the last chunk, as if the writer had crashed while writing it
+        end = int(index['offset'][-1]) + 10
+
+    os.truncate(filename, end)
+    with rp.ContainerReader(filename) as reader:
+        assert not reader.complete
+        assert np.array_equal(reader.index, index[:-1])
+        assert np.array_equal(reader.read(), np.concatenate([samples for _, samples in blocks])[:-int(index['n_samples'][-1])])
+
+
+@pytest.mark.parametrize('dtype', [np.int8, np.int16, np.float16, np.float32])
+@pytest.mark.parametrize('delta, shuffle', [(False, False), (True, False), (False, True), (True, True)])
+def test_compressor_round_trip(dtype, delta, shuffle):
+    samples = (np.random.default_rng(1).normal(0, 30, 10000)).astype(dtype)
+    for codec in rp.COMPRESSION_CODECS:
+        compressor = rp.Compressor(codec, delta=delta, shuffle=shuffle)
+        restored = compressor.decompress(compressor.compress(samples), samples.dtype)
+        assert restored.dtype == samples.dtype
+        assert np.array_equal(restored.view(np.uint8), samples.view(np.uint8))
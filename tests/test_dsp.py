@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+
+import PyRPStream as rp
+
+
+RATE = 1000000
+T0 = 1000000000000
+
+
+def _blocks(ch1, sizes, ch2=None, device_name='dev0', start=0):
+    blocks = []
+    i = 0
+    while i < len(ch1):
+        size = sizes[len(blocks) % len(sizes)]
+        blocks.append(rp.StreamBlock(device_name, ch1[i:i + size], None if ch2 is None else ch2[i:i + size], start + i, RATE,
+                                     T0 + (start + i) * 1000))
+        i += size
+    return blocks
+
+
+def _outputs(stage, blocks):
+    outputs = [stage.process(block) for block in blocks]
+    stage.close()
+    return [output for output in outputs if output is not None]
+
+
+SIGNAL = (np.random.default_rng(6).normal(0., 1000., 50000)).astype(np.int16)
+
+
+@pytest.mark.parametrize('sizes', [[50000], [4096], [1000, 7, 333]])
+def test_decimator_is_seamless_across_blocks(sizes):
+    factor = 8
+    whole = _outputs(rp.Decimator(factor, channels=(1,)), _blocks(SIGNAL, [len(SIGNAL)]))[0]
+    outputs = _outputs(rp.Decimator(factor, channels=(1,)), _blocks(SIGNAL, sizes))
+    assert np.allclose(np.concatenate([output.ch1 for output in outputs]), whole.ch1, atol=1e-2)
+    assert len(whole.ch1) == len(SIGNAL) // factor
+    # Each block's output starts at the next input sample on a multiple of factor
+    for output in outputs:
+        assert output.rate == RATE // factor
+        assert output.timestamp == T0 + output.sample * factor * 1000
+    samples = [output.sample for output in outputs if len(output.ch1)]
+    assert samples == sorted(set(samples)) and samples[0] == 0
+
+
+def test_decimator_filters():
+    factor = 10
+    t = np.arange(200000) / RATE
+    # Passed below the output Nyquist frequency (50 kHz), and stopped above it
+    for frequency, gain in ((5000., 1.), (120000., 0.)):
+        tone = (10000. * np.sin(2 * np.pi * frequency * t)).astype(np.int16)
+        output = np.concatenate([output.ch1 for output in _outputs(rp.Decimator(factor, channels=(1,)), _blocks(tone, [16384]))])
+        # Past the filter's start up
+        assert np.abs(output[100:]).max() / 10000. == pytest.approx(gain, abs=0.01)
+
+
+def test_decimator_resets_on_lost_samples():
+    decimator = rp.Decimator(4, channels=(1,))
+    blocks = _blocks(SIGNAL[:8000], [1000])
+    outputs = [decimator.process(block) for block in blocks[:4] + blocks[6:]]
+    fresh = rp.Decimator(4, channels=(1,))
+    expected = [fresh.process(block) for block in blocks[6:]]
+    # After the gap, outputs are as if the stream began there
+    assert np.array_equal(np.concatenate([output.ch1 for output in outputs[4:]]),
+                          np.concatenate([output.ch1 for output in expected]))
+    assert outputs[4].sample == 6000 // 4
+
+
+@pytest.mark.parametrize('sizes', [[50000], [1000], [999, 1, 4096]])
+def test_envelope(sizes):
+    factor = 100
+    outputs = _outputs(rp.Envelope(factor, channels=(1, 2)), _blocks(SIGNAL, sizes, ch2=-SIGNAL))
+    ch1 = np.concatenate([output.ch1 for output in outputs])
+    bins = SIGNAL.reshape(-1, factor)
+    assert np.array_equal(ch1, np.stack([bins.min(axis=1), bins.max(axis=1)], axis=1))
+    assert np.array_equal(np.concatenate([output.ch2 for output in outputs]), np.stack([-bins.max(axis=1), -bins.min(axis=1)], axis=1))
+    # Each output is timed from the first sample of its first bin
+    n = 0
+    for output in outputs:
+        assert output.timestamp == T0 + n * factor * 1000
+        n += len(output.ch1)
+
+
+@pytest.mark.parametrize('sizes', [[1 << 20], [16384], [5000, 123]])
+def test_welch_psd_of_sine_and_noise(sizes):
+    nperseg = 4096
+    n = 1 << 20
+    rng = np.random.default_rng(7)
+    # A sine in the middle of a frequency bin, and white noise of variance 100**2
+    frequency = 100 * RATE / nperseg
+    sine = (5000. * np.sin(2 * np.pi * frequency * np.arange(n) / RATE)).astype(np.int16)
+    noise = rng.normal(0., 100., n).astype(np.int16)
+    welch = rp.WelchPSD(nperseg, channels=(1, 2))
+    _outputs(welch, _blocks(sine, sizes, ch2=noise))
+
+    frequencies, density = welch.psd('dev0', 1)
+    assert frequencies[1] == RATE / nperseg and len(density) == nperseg // 2 + 1
+    # The power of the sine, A**2 / 2, all in the bins about its frequency
+    df = frequencies[1]
+    assert density.sum() * df == pytest.approx(5000. ** 2 / 2, rel=1e-3)
+    assert np.argmax(density) == 100
+    # White noise: 2 * variance / rate, one-sided
+    frequencies, density = welch.psd('dev0', 2)
+    assert np.mean(density[1:-1]) == pytest.approx(2 * 100. ** 2 / RATE, rel=0.02)
+    assert welch.states[('dev0', 2)]['count'] == (n - nperseg) // (nperseg // 2) + 1
+
+
+def test_welch_psd_matches_scipy():
+    signal = pytest.importorskip('scipy.signal')
+    data = SIGNAL.astype(np.float64)
+    welch = rp.WelchPSD(1024, noverlap=256, channels=(1,))
+    _outputs(welch, _blocks(SIGNAL, [3000]))
+    frequencies, density = welch.psd('dev0', 1)
+    expected_frequencies, expected = signal.welch(data, RATE, window='hann', nperseg=1024, noverlap=256)
+    assert np.allclose(frequencies, expected_frequencies)
+    assert np.allclose(density, expected, rtol=1e-6)
+
+
+def test_stage_saves_outputs(tmp_path):
+    prefix = str(tmp_path / 'decimated')
+    outputs = _outputs(rp.Decimator(5, channels=(1,), save_prefix=prefix), _blocks(SIGNAL[:10000], [3000]))
+    saved = np.fromfile(prefix + '_ch1_dev0.bin', dtype=np.float32)
+    assert np.array_equal(saved, np.concatenate([output.ch1 for output in outputs]))
@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+
+import PyRPStream as rp
+
+
+RATE = 1000000
+T0 = 1000000000000
+
+
+def _blocks(ch1, ch2, sizes, device_name='dev0'):
+    """ StreamBlocks of ch1 and ch2 in blocks of sizes (repeated as needed).
+    """
+    blocks = []
+    start = 0
+    while start < len(ch1):
+        size = sizes[len(blocks) % len(sizes)]
+        blocks.append(rp.StreamBlock(device_name, ch1[start:start + size], ch2[start:start + size], start, RATE,
+                                     T0 + start * 1000))
+        start += size
+    return blocks
+
+
+def _pulses(n, positions, height=31000, width=20):
+    ch2 = np.zeros(n, dtype=np.int16)
+    for position in positions:
+        ch2[position:position + width] = height
+    return ch2
+
+
+def _build(builder, blocks):
+    events = []
+    for block in blocks:
+        events.extend(builder.add(block))
+    builder.flush()
+    return events
+
+
+# Ramp on channel 1, so that each record shows where it was read from
+N = 100000
+RAMP = np.arange(N, dtype=np.int64).astype(np.int16)
+
+
+@pytest.mark.parametrize('sizes', [[16384], [1000], [100, 40000, 7]])
+def test_records_span_blocks(sizes):
+    positions = [5000, 16383, 16384, 32000, 50001, 99000]
+    builder = rp.EventBuilder(pre_samples=2000, post_samples=3000, threshold=30000, record_channels=(1, 2))
+    events = _build(builder, _blocks(RAMP, _pulses(N, positions), sizes))
+
+    # The last trigger has too few samples after it, and two are within a pulse of each other
+    assert [event.sample for event in events] == [5000, 16383, 32000, 50001]
+    for event in events:
+        assert event.record.dtype == np.int16
+        assert np.array_equal(event.record[0], RAMP[event.sample - 2000:event.sample + 3000])
+        assert np.array_equal(event.record[1][2000:2020], np.full(20, 31000))
+        assert event.timestamp == T0 + event.sample * 1000
+    assert builder.recorded == {'dev0': 4}
+    assert builder.incomplete == {'dev0': 1}
+
+
+def test_trigger_without_pre_samples_is_incomplete():
+    builder = rp.EventBuilder(pre_samples=2000, post_samples=100)
+    events = _build(builder, _blocks(RAMP[:10000], _pulses(10000, [500, 5000]), [1000]))
+    assert [event.sample for event in events] == [5000]
+    assert builder.incomplete == {'dev0': 1}
+
+
+def test_holdoff():
+    positions = [3000, 3500, 4100, 9000]
+    builder = rp.EventBuilder(pre_samples=100, post_samples=100, holdoff_samples=1000)
+    events = _build(builder, _blocks(RAMP[:20000], _pulses(20000, positions), [700]))
+    # 3500 is held off by 3000, but 4100 is not: holdoff counts from the last accepted trigger
+    assert [event.sample for event in events] == [3000, 4100, 9000]
+
+
+def test_hysteresis():
+    # Noise about the threshold after a rising edge
+    ch2 = np.zeros(5000, dtype=np.int16)
+    ch2[1000:2000] = 30000 + np.tile(np.array([50, -50, 50, -150], dtype=np.int16), 250)
+    ch2[3000:3100] = 30100
+    events = _build(rp.EventBuilder(pre_samples=10, post_samples=10, hysteresis=200), _blocks(RAMP[:5000], ch2, [333]))
+    assert [event.sample for event in events] == [1000, 3000]
+    # Without hysteresis, every return below threshold re-arms
+    events = _build(rp.EventBuilder(pre_samples=10, post_samples=10), _blocks(RAMP[:5000], ch2, [333]))
+    assert len(events) == 501
+
+
+def test_falling_edge():
+    ch2 = np.full(5000, 1000, dtype=np.int16)
+    ch2[2500:2600] = -1000
+    builder = rp.EventBuilder(pre_samples=10, post_samples=10, threshold=0, rising=False, trigger_channel=2, record_channels=(2,))
+    events = _build(builder, _blocks(RAMP[:5000], ch2, [1024]))
+    assert [event.sample for event in events] == [2500]
+    assert np.array_equal(events[0].record[0], ch2[2490:2510])
+
+
+def test_lost_samples():
+    ch2 = _pulses(20000, [4000, 9990, 15000])
+    blocks = _blocks(RAMP[:20000], ch2, [1000])
+    # Samples 10000 to 12000 are lost: the trigger at 9990 cannot be completed
+    blocks = blocks[:10] + blocks[12:]
+    builder = rp.EventBuilder(pre_samples=500, post_samples=500)
+    events = _build(builder, blocks)
+    assert [event.sample for event in events] == [4000, 15000]
+    assert np.array_equal(events[1].record[0], RAMP[14500:15500])
+    assert builder.incomplete == {'dev0': 1}
+
+
+def test_devices_are_separate():
+    blocks = []
+    for device_name, positions in (('dev0', [2000]), ('dev1', [3000, 7000])):
+        blocks.append(_blocks(RAMP[:10000], _pulses(10000, positions), [1000], device_name))
+    builder = rp.EventBuilder(pre_samples=100, post_samples=100)
+    events = _build(builder, [block for pair in zip(*blocks) for block in pair])
+    assert [(event.device_name, event.sample) for event in events] == [('dev0', 2000), ('dev1', 3000), ('dev1', 7000)]
+
+
+def test_ring_buffer_wraps():
+    ring = rp.RingBuffer(10)
+    ring.write(np.arange(7, dtype=np.int16))
+    ring.write(np.arange(7, 15, dtype=np.int16))
+    assert (ring.start, ring.end) == (5, 15)
+    out = np.empty(10, dtype=np.int16)
+    ring.read(5, 10, out)
+    assert np.array_equal(out, np.arange(5, 15))
+    # More than fits keeps the last samples
+    ring.write(np.arange(15, 40, dtype=np.int16))
+    ring.read(30, 10, out)
+    assert (ring.start, ring.end) == (30, 40)
+    assert np.array_equal(out, np.arange(30, 40))
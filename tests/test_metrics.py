@@ -0,0 +1,50 @@
+import gc
+
+import PyRPStream as rp
+
+
+def _collection(registry, n_queued):
+    collection = rp.RPDeviceCollection(metrics=registry)
+    collection.disconnect()
+    for i in range(n_queued):
+        collection.client.reply_q.put(rp.ClientReply('MESSAGE', str(i)))
+    return collection
+
+
+def test_reply_queue_gauges_sum_over_collections():
+    registry = rp.MetricsRegistry()
+    first = _collection(registry, 3)
+    second = _collection(registry, 2)
+    assert registry.snapshot()['rp_reply_queue_depth'] == 5
+
+    # A collection no longer in use is not kept alive by the registry, and stops counting
+    del second
+    gc.collect()
+    assert registry.snapshot()['rp_reply_queue_depth'] == 3
+    del first
+    gc.collect()
+    assert registry.snapshot()['rp_reply_queue_depth'] == 0
+    assert registry.snapshot()['rp_frames_dropped'] == 0
+
+
+def test_dropped_frames_gauge():
+    registry = rp.MetricsRegistry()
+    collection = rp.RPDeviceCollection(metrics=registry, reply_q_size=1, overflow='drop-newest')
+    collection.disconnect()
+    for i in range(4):
+        collection.client.reply_q.put(rp.ClientReply('DATA', {'replied_devices': ['dev0', 'dev1']}))
+    assert registry.snapshot()['rp_frames_dropped'] == 6
+
+
+def test_text_exposition():
+    registry = rp.MetricsRegistry()
+    registry.counter('rp_frames_received', device='dev0').inc(3)
+    registry.histogram('rp_write_seconds', bounds=[0.1, 1.], writer='inline').observe(0.5)
+    registry.gauge('rp_ring_fill', device='dev0').set(7)
+    lines = registry.text().splitlines()
+    assert 'rp_frames_received{device="dev0"} 3' in lines
+    assert 'rp_ring_fill{device="dev0"} 7' in lines
+    assert 'rp_write_seconds_bucket{writer="inline",le="0.1"} 0' in lines
+    assert 'rp_write_seconds_bucket{writer="inline",le="1"} 1' in lines
+    assert 'rp_write_seconds_bucket{writer="inline",le="+Inf"} 1' in lines
+    assert 'rp_write_seconds_count{writer="inline"} 1' in lines
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+import PyRPStream as rp
+
+
+RATE = 1000000
+
+
+def _record(directory, base_port, monkeypatch, **kwargs):
+    """ Record 1 s from two simulated devices into directory.
+    """
+    monkeypatch.chdir(directory)
+    with rp.RPStreamSimulator(2, base_port, sample_rate=RATE, seed=2, waveform='pulses') as simulator:
+        collection = rp.RPDeviceCollection()
+        for i, (address, port) in enumerate(simulator.addresses):
+            collection.add_device('dev' + str(i), address, port)
+        collection.initialise()
+        collection.connect()
+        try:
+            collection.acquire(1., file_size=1e6, **kwargs)
+        finally:
+            collection.disconnect()
+
+
+def _replay_collection(replay):
+    collection = rp.RPDeviceCollection(engine='replay', replay=replay)
+    for device_name in replay.device_names():
+        collection.add_device(device_name, '127.0.0.1', 0)
+    collection.initialise()
+    collection.connect()
+    return collection
+
+
+def _streamed(collection):
+    streamed = {}
+    for block in collection.stream(None):
+        for channel, samples in ((1, block.ch1), (2, block.ch2)):
+            streamed.setdefault((block.device_name, channel), []).append((block.sample, samples.copy()))
+    return streamed
+
+
+def test_replay_matches_recording(tmp_path, monkeypatch):
+    _record(tmp_path, 9420, monkeypatch, acquire_raw=True)
+    recording = rp.RunReader(str(tmp_path), rate=RATE, bin_dtype=np.int16)
+
+    replay = rp.Replay(str(tmp_path), speed=None, rate=RATE, bin_dtype=np.int16)
+    assert sorted(replay.device_names()) == ['dev0', 'dev1']
+    collection = _replay_collection(replay)
+    try:
+        # A second stream restarts the replay from the beginning
+        passes = [_streamed(collection), _streamed(collection)]
+    finally:
+        collection.disconnect()
+
+    assert passes[0].keys() == recording.channels.keys()
+    for streamed in passes:
+        for key, blocks in streamed.items():
+            assert blocks[0][0] == 0
+            samples = np.concatenate([samples for _, samples in blocks])
+            # Only whole frames are replayed
+            assert len(recording.channels[key]) - len(samples) < 16384
+            assert np.array_equal(samples, recording.channels[key].read(0, len(samples)))
+
+
+@pytest.mark.parametrize('compression, bin_dtype, base_port', [(None, np.float16, 9430), ('zlib', None, 9440)])
+def test_volts_recording_is_converted_back(tmp_path, monkeypatch, compression, bin_dtype, base_port):
+    # By default, segments are saved in float16 volts: as .bin files, or containers with their calibration
+    _record(tmp_path, base_port, monkeypatch, compression=compression)
+    recording = rp.RunReader(str(tmp_path), rate=RATE, bin_dtype=bin_dtype)
+
+    collection = _replay_collection(rp.Replay(str(tmp_path), speed=None, rate=RATE, bin_dtype=bin_dtype))
+    try:
+        streamed = _streamed(collection)
+    finally:
+        collection.disconnect()
+
+    for (device_name, channel), blocks in streamed.items():
+        samples = np.concatenate([samples for _, samples in blocks])
+        assert samples.dtype == np.int16
+        volts = recording.channels[device_name, channel].read(0, len(samples)).astype(np.float32)
+        # Each raw value replayed is the nearest to the volts recorded
+        converter = collection.device_collection[device_name].converter(channel, np.float32)
+        assert np.abs(converter.convert(samples) - volts).max() <= converter.scale
+        assert np.abs(samples).max() > 1000
+
+
+def test_bin_recording_needs_its_dtype(tmp_path, monkeypatch):
+    _record(tmp_path, 9450, monkeypatch)
+    collection = rp.RPDeviceCollection(engine='replay', replay=rp.Replay(str(tmp_path), speed=None, rate=RATE))
+    try:
+        for device_name in ('dev0', 'dev1'):
+            collection.add_device(device_name, '127.0.0.1', 0)
+        with pytest.raises(ValueError):
+            collection.initialise()
+    finally:
+        collection.disconnect()
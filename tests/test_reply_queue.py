@@ -0,0 +1,80 @@
+import threading
+
+import pytest
+
+import PyRPStream as rp
+
+
+def _data(i, device_name='dev0'):
+    return rp.ClientReply('DATA', {'replied_devices': [device_name], device_name + '_ch1': bytearray([i]), 'timestamp': i})
+
+
+def _drain(reply_q):
+    replies = []
+    while not reply_q.empty():
+        replies.append(reply_q.get())
+    return replies
+
+
+def test_drop_oldest_keeps_newest_and_messages():
+    dropped = []
+    reply_q = rp.BoundedReplyQueue(3, 'drop-oldest', on_drop=dropped.append)
+    reply_q.put(rp.ClientReply('MESSAGE', 'connected'))
+    for i in range(5):
+        reply_q.put(_data(i))
+    # The message takes up one of the three places, but is never the one discarded
+    replies = _drain(reply_q)
+    assert replies[0].key == 'MESSAGE'
+    assert [reply.reply['timestamp'] for reply in replies[1:]] == [3, 4]
+    assert [reply.reply['timestamp'] for reply in dropped] == [0, 1, 2]
+    assert reply_q.counters()['dropped'] == {'dev0': 3}
+
+
+def test_drop_newest_keeps_oldest():
+    reply_q = rp.BoundedReplyQueue(2, 'drop-newest')
+    for i in range(5):
+        reply_q.put(_data(i))
+    assert [reply.reply['timestamp'] for reply in _drain(reply_q)] == [0, 1]
+    assert reply_q.counters()['dropped'] == {'dev0': 3}
+
+
+def test_spill_returns_every_reply_in_order(tmp_path):
+    released = []
+    reply_q = rp.BoundedReplyQueue(2, 'spill', spill_dir=str(tmp_path), on_drop=released.append)
+    for i in range(6):
+        reply_q.put(_data(i))
+        if i == 3:
+            reply_q.put(rp.ClientReply('ERROR', 'lost'))
+    replies = _drain(reply_q)
+    assert [reply.key for reply in replies] == ['DATA'] * 4 + ['ERROR'] + ['DATA'] * 2
+    data = [reply for reply in replies if reply.key == 'DATA']
+    assert [reply.reply['timestamp'] for reply in data] == list(range(6))
+    # Spilled replies come back as bytes, and their in-memory originals are handed to on_drop
+    assert [bytes(reply.reply['dev0_ch1']) for reply in data] == [bytes([i]) for i in range(6)]
+    assert len(released) == 4
+    assert reply_q.counters()['spilled'] == {'dev0': 4}
+
+
+def test_block_waits_for_the_consumer():
+    reply_q = rp.BoundedReplyQueue(2, 'block')
+    producer = threading.Thread(target=lambda: [reply_q.put(_data(i)) for i in range(4)])
+    producer.start()
+    producer.join(0.2)
+    assert producer.is_alive() and reply_q.qsize() == 2
+    assert [reply_q.get().reply['timestamp'] for _ in range(4)] == [0, 1, 2, 3]
+    producer.join()
+    assert reply_q.counters()['dropped'] == {}
+
+
+def test_clear_counts_queued_and_spilled_frames(tmp_path):
+    reply_q = rp.BoundedReplyQueue(1, 'spill', spill_dir=str(tmp_path))
+    for i in range(3):
+        reply_q.put(_data(i, 'dev' + str(i % 2)))
+    reply_q.clear()
+    assert reply_q.empty()
+    assert reply_q.counters()['cleared'] == {'dev0': 2, 'dev1': 1}
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        rp.BoundedReplyQueue(1, 'drop-all')
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+import PyRPStream as rp
+
+
+# Not dividing the number of receive buffers, so that a reused buffer holds different samples
+N_BANK_FRAMES = 7
+FRAME_SAMPLES = 16384
+
+
+def _collection(simulator, **kwargs):
+    collection = rp.RPDeviceCollection(**kwargs)
+    for i, (address, port) in enumerate(simulator.addresses):
+        collection.add_device('dev' + str(i), address, port)
+    collection.initialise()
+    collection.connect()
+    return collection
+
+
+def _received(collection, acq_time_s, **kwargs):
+    """ Samples of each device and channel streamed, copied as they arrive.
+    """
+    received = {}
+    for block in collection.stream(acq_time_s, **kwargs):
+        assert not block.losses
+        for channel, samples in ((1, block.ch1), (2, block.ch2)):
+            received.setdefault((block.device_name, channel), []).append(samples.copy())
+    return {key: np.concatenate(parts) for key, parts in received.items()}
+
+
+def _assert_continues(samples, reference):
+    """ samples should be the simulator's frame bank repeating, as in
+    reference (at least one pass through it), from some frame on.
+    """
+    period = len(reference)
+    starts = [i for i in range(0, period, FRAME_SAMPLES) if np.array_equal(reference[i:i + FRAME_SAMPLES], samples[:FRAME_SAMPLES])]
+    assert len(starts) == 1
+    expected = np.resize(np.roll(reference, -starts[0]), len(samples))
+    assert np.array_equal(samples, expected)
+
+
+@pytest.mark.parametrize('engine, base_port', [('select', 9400), ('rings', 9410)])
+def test_zero_copy_batches_match_unbatched_stream(engine, base_port):
+    # Batches spanning more frames than receive buffers are pooled for, and not a whole number of
+    # frames, so that parts of blocks stay pending between replies
+    batch_samples = 128 * FRAME_SAMPLES + 1000
+    with rp.RPStreamSimulator(2, base_port, sample_rate=20e6, seed=1, n_bank_frames=N_BANK_FRAMES) as simulator:
+        collection = _collection(simulator, engine=engine, zero_copy=True)
+        try:
+            reference = _received(collection, 0.5)
+            batched = {}
+            for block in collection.stream(0.5, batch_samples=batch_samples):
+                assert not block.losses
+                for channel, samples in ((1, block.ch1), (2, block.ch2)):
+                    batched.setdefault((block.device_name, channel), []).append(samples.copy())
+        finally:
+            collection.disconnect()
+
+    for key, samples in reference.items():
+        period = reference[key][:N_BANK_FRAMES * FRAME_SAMPLES]
+        assert len(period) == N_BANK_FRAMES * FRAME_SAMPLES
+        _assert_continues(samples, period)
+        _assert_continues(np.concatenate(batched[key]), period)